@@ -34,7 +34,20 @@ typeExpr : named=ID | element_type=ID '[' length=POSITIVE_INTEGER ']' ;
 
 integer : '-'? POSITIVE_INTEGER ;
 
-expr : ID | integer | '(' expr ')' ;
+expr : ID
+     | integer
+     | '(' expr ')'
+     | obj=expr '.' field=ID
+     | callee=ID '(' args=exprList? ')'
+     | left=expr op=('*' | '/' | '%') right=expr
+     | left=expr op=('+' | '-') right=expr
+     | left=expr op=('<<' | '>>') right=expr
+     | left=expr op='&' right=expr
+     | left=expr op='^' right=expr
+     | left=expr op='|' right=expr
+     ;
+
+exprList : car=expr (',' cdr=exprList)? ','? ;
 
 assign : assignmentTarget '=' expr ';' ;
 
@@ -42,4 +55,6 @@ assignmentTarget : ID | assignmentTarget '.' ID ;
 
 return_ : 'return' expr? ';' ;
 
-stmt : varDecl | assign | return_ ;
+while_ : 'while' cond=expr '{' body+=stmt* '}' ;
+
+stmt : varDecl | assign | return_ | while_ ;
@@ -1,28 +1,340 @@
 import argparse
-from compiler.compile import Compile
-from compiler.parser import parse
+import contextlib
+import os
+import stat
+import sys
+import tempfile
+from compiler.inline import DEFAULT_THRESHOLD
+from compiler.parser import BACKENDS, parse, read_source
+from compiler import instrument
+
+# Everything else is imported once it's known to be needed, see
+# benchmarks/startup.py
+
+OUTPUT_BUFFER_SIZE = 1024 * 1024
 
 argparser = argparse.ArgumentParser(description="Compiler 37")
-argparser.add_argument("files", metavar="FILE", type=str, nargs="+", help="Input files")
+argparser.add_argument("files", metavar="FILE", type=str, nargs="*", help="Input files")
 argparser.add_argument(
     "-o",
     "--output",
     dest="out",
     type=str,
     default="-",
-    help="Output assembly to a file",
+    help="Output assembly (or with -c, an object file) to a file",
+)
+argparser.add_argument(
+    "--emit",
+    dest="emit",
+    choices=["asm", "obj"],
+    default="asm",
+    help="Write GAS assembly, or encode a relocatable ELF object directly "
+    "(default: asm)",
+)
+argparser.add_argument(
+    "-c",
+    dest="emit",
+    action="store_const",
+    const="obj",
+    help="Same as --emit=obj",
+)
+argparser.add_argument(
+    "--parser",
+    dest="parser",
+    choices=BACKENDS,
+    default="antlr",
+    help="Parser front end to use (default: antlr)",
+)
+argparser.add_argument(
+    "--cache-dir",
+    dest="cache_dir",
+    type=str,
+    default=None,
+    help="Cache parsed files and generated code in this directory",
+)
+argparser.add_argument(
+    "--cache-size",
+    dest="cache_size",
+    type=int,
+    default=64,
+    help="Maximum size of each cache in MiB (default: 64)",
+)
+argparser.add_argument(
+    "--cache-stats",
+    dest="cache_stats",
+    action="store_true",
+    help="Print cache hits and misses to stderr",
+)
+argparser.add_argument(
+    "-j",
+    "--jobs",
+    dest="jobs",
+    type=int,
+    default=1,
+    help="Parse and compile with this many processes",
+)
+argparser.add_argument(
+    "-O",
+    dest="opt_level",
+    choices=["0", "1", "2", "s"],
+    default="0",
+    help="Optimization level: 2 also strength-reduces loops, s is 2 with "
+    "instructions picked for size rather than speed (default: 0)",
+)
+argparser.add_argument(
+    "--opt-stats",
+    dest="opt_stats",
+    action="store_true",
+    help="Print how often each optimization fired to stderr",
+)
+argparser.add_argument(
+    "--dump-regalloc",
+    dest="dump_regalloc",
+    action="store_true",
+    help="Print live intervals and register assignments to stderr",
+)
+argparser.add_argument(
+    "--inline-threshold",
+    dest="inline_threshold",
+    type=int,
+    default=DEFAULT_THRESHOLD,
+    help="Inline callees costing at most this much at -O1, 0 to disable "
+    f"(default: {DEFAULT_THRESHOLD})",
+)
+argparser.add_argument(
+    "--inline-report",
+    dest="inline_report",
+    action="store_true",
+    help="Print which call sites were inlined to stderr",
+)
+argparser.add_argument(
+    "--unroll",
+    dest="unroll",
+    type=int,
+    default=1,
+    metavar="N",
+    help="Run N iterations per trip around innermost loops at -O1 "
+    "(default: 1, no unrolling)",
+)
+argparser.add_argument(
+    "-fomit-frame-pointer",
+    dest="omit_frame_pointer",
+    action="store_true",
+    help="Use RBP like any other register and address the stack frame from RSP; "
+    "functions that call nothing keep their locals in the red zone",
+)
+argparser.add_argument(
+    "-fno-omit-frame-pointer",
+    dest="omit_frame_pointer",
+    action="store_false",
+    help="Set up RBP as the frame pointer in every function (the default)",
+)
+argparser.add_argument(
+    "--reorder-fields",
+    dest="reorder_fields",
+    action="store_true",
+    help="Reorder the fields of every struct to need as little padding as "
+    "possible, except for structs used by exported functions",
+)
+argparser.add_argument(
+    "--reorder-struct",
+    dest="reorder_structs",
+    metavar="NAME",
+    action="append",
+    default=[],
+    help="Reorder the fields of this struct only (can be repeated)",
+)
+argparser.add_argument(
+    "--layout-report",
+    dest="layout_report",
+    action="store_true",
+    help="Print the size, field offsets and padding of every struct to stderr",
+)
+argparser.add_argument(
+    "--time-passes",
+    dest="time_passes",
+    action="store_true",
+    help="Print the time spent in each phase to stderr",
+)
+argparser.add_argument(
+    "--stats",
+    dest="stats",
+    action="store_true",
+    help="Print instructions, blocks and stack bytes per function to stderr",
+)
+argparser.add_argument(
+    "--trace-memory",
+    dest="trace_memory",
+    action="store_true",
+    help="Also report peak memory, measured with tracemalloc (slow)",
+)
+argparser.add_argument(
+    "--report-format",
+    dest="report_format",
+    choices=["table", "json"],
+    default="table",
+    help="Format of the --time-passes and --stats report (default: table)",
+)
+argparser.add_argument(
+    "--server",
+    dest="server",
+    metavar="SOCKET",
+    default=None,
+    help="Serve compile requests on this Unix socket instead "
+    "(see compiler/client.py)",
+)
+argparser.add_argument(
+    "--idle-timeout",
+    dest="idle_timeout",
+    type=float,
+    default=None,
+    help="Stop the server after this many seconds without requests, 0 for "
+    "never (default: 600)",
 )
 args = argparser.parse_args()
+if not args.files and args.server is None:
+    argparser.error("the following arguments are required: FILE")
+optimize_size = args.opt_level == "s"
+opt_level = 2 if optimize_size else int(args.opt_level)
+
+if args.time_passes or args.stats or args.trace_memory:
+    instrument.enable(trace_memory=args.trace_memory)
+
+cache = None
+block_cache = None
+if args.cache_dir is not None:
+    from compiler.cache import BlockCache, ParseCache
+
+    max_bytes = args.cache_size * 1024 * 1024
+    cache = ParseCache(os.path.join(args.cache_dir, "parse"), max_bytes=max_bytes)
+    block_cache = BlockCache(
+        os.path.join(args.cache_dir, "blocks"), max_bytes=max_bytes
+    )
+
+if args.server is not None:
+    from compiler.server import serve
+
+    serve(args.server, args.idle_timeout, cache=cache, block_cache=block_cache)
+    sys.exit(0)
+
+
+def temporary_output():
+    """
+    A new file next to the -o file to write to instead, which replaces it once
+    everything compiled, or None if -o isn't a regular file (or missing).
+    Whatever was there before is left alone if compiling fails.
+    """
+    if args.out == "-":
+        return None
+    try:
+        if not stat.S_ISREG(os.stat(args.out).st_mode):
+            return None
+    except FileNotFoundError:
+        pass
+    directory, name = os.path.split(os.path.abspath(args.out))
+    fd, path = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+    os.close(fd)
+    # mkstemp makes it private, open() would have respected the umask
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(path, 0o666 & ~umask)
+    return path
+
+
+def open_output(path):
+    if args.emit == "obj":
+        if path == "-":
+            return contextlib.nullcontext(sys.stdout.buffer)
+        return open(path, "wb")
+    if path == "-":
+        return contextlib.nullcontext(sys.stdout)
+    return open(path, "w", buffering=OUTPUT_BUFFER_SIZE)
+
+
+temporary = temporary_output()
+try:
+    with open_output(temporary or args.out) as out:
+        if args.jobs > 1:
+            from compiler.parallel import compile_files
+
+            c = compile_files(
+                args.files,
+                args.jobs,
+                backend=args.parser,
+                cache=cache,
+                block_cache=block_cache,
+                opt_level=opt_level,
+                optimize_size=optimize_size,
+                opt_stats=args.opt_stats,
+                dump_regalloc=args.dump_regalloc,
+                inline_threshold=args.inline_threshold,
+                inline_report=args.inline_report,
+                unroll=args.unroll,
+                omit_frame_pointer=args.omit_frame_pointer,
+                reorder_fields=args.reorder_fields,
+                reorder_structs=args.reorder_structs,
+                layout_report=args.layout_report,
+            )
+            if args.emit == "asm":
+                c.finish().write_to(out)
+        else:
+            from compiler.compile import Compile, exported_functions
+
+            trees = []
+            for file in args.files:
+                with instrument.phase("read"):
+                    source = read_source(file)
+                trees.append(parse(source, backend=args.parser, cache=cache))
+            c = Compile(
+                block_cache=block_cache,
+                opt_level=opt_level,
+                optimize_size=optimize_size,
+                report_opt_stats=args.opt_stats,
+                regalloc_log=sys.stderr if args.dump_regalloc else None,
+                inline_threshold=args.inline_threshold,
+                inline_log=sys.stderr if args.inline_report else None,
+                unroll=args.unroll,
+                omit_frame_pointer=args.omit_frame_pointer,
+                reorder_fields=args.reorder_fields,
+                reorder_structs=args.reorder_structs,
+                layout_log=sys.stderr if args.layout_report else None,
+            )
+            # Assembly is written out as soon as each function is compiled
+            if args.emit == "asm":
+                c.stream_to(out, exported_functions(trees))
+            for tree in trees:
+                c.add_file(tree)
+        if args.emit == "obj":
+            from compiler.elf import object_file
+
+            out.write(object_file(c.finish()))
+        elif args.out == "-":
+            out.write("\n")
+except BaseException:
+    if temporary is not None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary)
+    raise
+if temporary is not None:
+    os.replace(temporary, args.out)
 
-c = Compile()
+if args.opt_stats:
+    for pass_name, counts in c.opt_stats().items():
+        for name, count in sorted(counts.items()):
+            print(f"{pass_name}: {name}={count}", file=sys.stderr)
 
-for file in args.files:
-    with open(file, "r") as f:
-        c.add_file(parse(f.read()))
+if instrument.current() is not None:
+    print(
+        instrument.format_report(
+            instrument.current().report(),
+            time_passes=args.time_passes,
+            stats=args.stats,
+            as_json=args.report_format == "json",
+        ),
+        file=sys.stderr,
+    )
 
-asm = str(c.finish())
-if args.out == "-":
-    print(asm)
-else:
-    with open(args.out, "w") as f:
-        f.write(asm)
+if cache is not None and args.cache_stats:
+    for name, cache_ in [("parse", cache), ("codegen", block_cache)]:
+        stats = ", ".join(f"{k}={v}" for k, v in cache_.stats().items())
+        print(f"{name} cache: {stats}", file=sys.stderr)
@@ -0,0 +1,81 @@
+"""
+Microbenchmarks for the instruction and register representation in asm.py.
+
+    python -m benchmarks.asm_micro
+
+Prints the cost per operation in nanoseconds.
+"""
+import timeit
+
+from compiler import asm as s
+
+N = 200_000
+
+
+def bench_with_size():
+    reg = s.Register.r10
+    size = s.Size.word
+    for _ in range(N):
+        reg.with_size(size)
+
+
+def bench_register_size():
+    reg = s.Register.r10d
+    for _ in range(N):
+        reg.size()
+
+
+def bench_from_byte_size():
+    for _ in range(N):
+        s.Size.from_byte_size(4)
+
+
+def bench_family_contains():
+    fam = s.register_families[0]
+    reg = s.Register.eax
+    for _ in range(N):
+        reg in fam
+
+
+def bench_make_mov():
+    src = s.Register.eax
+    dest = s.Address(s.Register.rbp, -8)
+    for _ in range(N):
+        s.Mov(src, dest)
+
+
+def bench_format_mov():
+    inst = s.Mov(s.Register.eax, s.Address(s.Register.rbp, -8))
+    for _ in range(N):
+        str(inst)
+
+
+def bench_emit_block():
+    instructions = [
+        s.Mov(s.Immediate(i), s.Address(s.Register.rbp, -8), size=s.Size.quad_word)
+        for i in range(N // 10)
+    ]
+    block = s.Block("bench", instructions)
+    for _ in range(10):
+        str(block)
+
+
+benchmarks = [
+    ("Register.with_size", bench_with_size),
+    ("Register.size", bench_register_size),
+    ("Size.from_byte_size", bench_from_byte_size),
+    ("RegisterFamily.__contains__", bench_family_contains),
+    ("Mov()", bench_make_mov),
+    ("str(Mov)", bench_format_mov),
+    ("Block.emit per instruction", bench_emit_block),
+]
+
+
+def main():
+    for name, fn in benchmarks:
+        best = min(timeit.repeat(fn, number=1, repeat=5))
+        print(f"{name:30} {best / N * 1e9:8.1f} ns")
+
+
+if __name__ == "__main__":
+    main()
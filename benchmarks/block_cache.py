@@ -0,0 +1,83 @@
+"""
+What the block cache costs and saves on a file of many small functions.
+
+    python -m benchmarks.block_cache
+    python -m benchmarks.block_cache --functions 8000 --max-growth 1.5
+
+The file is compiled without a cache, into an empty cache and from the warm
+cache, and then a quarter of it into another empty cache. Filling the cache
+should cost the same per function however many there are, so the exit status
+is 1 if a function took more than --max-growth times as long to compile and
+store in the full file as in the quarter.
+"""
+import argparse
+import sys
+import tempfile
+import time
+
+from compiler.cache import BlockCache
+from compiler.compile import Compile
+from compiler.parser import parse
+
+
+def source(n):
+    return "\n".join(
+        f"function f{i}(a: int32, b: int16): int32 {{\n"
+        f"    var c: int32;\n"
+        f"    var d: int16;\n"
+        f"    d = b;\n"
+        f"    c = a;\n"
+        f"    return c;\n"
+        f"}}\n"
+        for i in range(n)
+    )
+
+
+def compile_time(tree, block_cache=None):
+    start = time.perf_counter()
+    c = Compile(block_cache=block_cache)
+    c.add_file(tree)
+    return time.perf_counter() - start
+
+
+def cold_time(tree):
+    with tempfile.TemporaryDirectory() as directory:
+        return compile_time(tree, BlockCache(directory))
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument("--functions", type=int, default=2000)
+    argparser.add_argument(
+        "--max-growth",
+        type=float,
+        default=2.0,
+        help="Allowed growth of the time per function filling the cache "
+        "(default: 2)",
+    )
+    args = argparser.parse_args()
+
+    n = args.functions
+    tree = parse(source(n), backend="fast")
+    uncached = compile_time(tree)
+    with tempfile.TemporaryDirectory() as directory:
+        cold = compile_time(tree, BlockCache(directory))
+        warm = compile_time(tree, BlockCache(directory))
+    quarter = cold_time(parse(source(n // 4), backend="fast"))
+    growth = (cold / n) / (quarter / (n // 4))
+    print(f"no cache   {uncached * 1000:8.1f} ms")
+    print(f"cold cache {cold * 1000:8.1f} ms  ({cold / uncached:.2f}x)")
+    print(f"warm cache {warm * 1000:8.1f} ms  ({warm / uncached:.2f}x)")
+    print(f"cold cache {quarter * 1000:8.1f} ms  for {n // 4} functions")
+    print(f"time per function filling the cache grew {growth:.2f}x")
+    if growth > args.max_growth:
+        print(
+            f"regression: storing in the cache slows down as it fills, "
+            f"{growth:.2f}x is more than {args.max_growth}x",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
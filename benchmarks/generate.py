@@ -0,0 +1,97 @@
+"""
+Generators of synthetic programs that stress one dimension of the compiler.
+
+    python -m benchmarks.generate functions 1000 > many.c37
+
+Each generator takes a size and returns source text.
+"""
+import sys
+
+
+def many_functions(n):
+    """n small functions, each with a few locals and assignments."""
+    parts = []
+    for i in range(n):
+        parts.append(
+            f"function f{i}(a: int32, b: int16): int32 {{\n"
+            f"    var c: int32 = {i % 1000};\n"
+            f"    var d: int16 = b;\n"
+            f"    c = a;\n"
+            f"    return c;\n"
+            f"}}\n"
+        )
+    return "\n".join(parts)
+
+
+def wide_struct(n):
+    """A struct with n fields of mixed sizes, and a function setting them all."""
+    types = ["int8", "int16", "int32"]
+    fields = "".join(f"    f{i}: {types[i % 3]},\n" for i in range(n))
+    body = "".join(f"    w.f{i} = {i % 100};\n" for i in range(n))
+    return (
+        f"struct Wide {{\n{fields}}}\n\n"
+        f"function fill(): int32 {{\n"
+        f"    var w: Wide;\n"
+        f"{body}"
+        f"    var r: int32 = 1;\n"
+        f"    return r;\n"
+        f"}}\n"
+    )
+
+
+def nested_struct(n):
+    """n structs each wrapping the previous one, and a store to the innermost."""
+    # A struct is aligned to the size of its fields for now, so a struct
+    # with a nested struct and anything else doubles in size at every level.
+    parts = ["struct N0 {\n    v: int32,\n}\n"]
+    for i in range(1, n):
+        parts.append(f"struct N{i} {{\n    inner: N{i - 1},\n}}\n")
+    path = ".inner" * (n - 1)
+    parts.append(
+        f"function deep(): int32 {{\n"
+        f"    var s: N{n - 1};\n"
+        f"    s{path}.v = 7;\n"
+        f"    var r: int32 = 2;\n"
+        f"    return r;\n"
+        f"}}\n"
+    )
+    return "\n".join(parts)
+
+
+def long_body(n):
+    """One function with n statements."""
+    lines = ["function long(a: int32): int32 {"]
+    for i in range(n):
+        if i % 2 == 0:
+            lines.append(f"    var v{i}: int32 = {i % 1000};")
+        else:
+            lines.append(f"    a = v{i - 1};")
+    lines.append("    return a;")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def many_arguments(n):
+    """A function taking n arguments."""
+    args = ", ".join(f"a{i}: int32" for i in range(n))
+    return f"function wide({args}): int32 {{\n    return a{n - 1};\n}}\n"
+
+
+generators = {
+    "functions": many_functions,
+    "wide_struct": wide_struct,
+    "nested_struct": nested_struct,
+    "long_body": long_body,
+    "arguments": many_arguments,
+}
+
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] not in generators:
+        print(f"usage: {sys.argv[0]} {{{','.join(generators)}}} SIZE", file=sys.stderr)
+        sys.exit(2)
+    sys.stdout.write(generators[sys.argv[1]](int(sys.argv[2])))
+
+
+if __name__ == "__main__":
+    main()
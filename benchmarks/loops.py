@@ -0,0 +1,120 @@
+"""
+Instructions per loop iteration, with each loop optimization.
+
+    python -m benchmarks.loops
+    python -m benchmarks.loops --unroll 4
+
+Every function below is compiled at -O0, at -O1 without the loop passes, with
+loads hoisted out of loops, and with hoisting and unrolling as well. A loop
+is found in the output as the instructions from a label to the last jump
+back to it. They are counted statically, and divided by how many iterations
+one trip around them runs when unrolled.
+"""
+import argparse
+
+from compiler import asm as s
+from compiler.compile import Compile
+from compiler.parser import BACKENDS, parse
+
+SOURCE = """
+struct Config {
+    limit: int32,
+    scale: int32,
+    bias: int32,
+    flags: int32,
+}
+
+function fields(c: Config, n: int32, m: int32): int32 {
+    var a: int32 = 0;
+    var b: int32 = 0;
+    var d: int32 = 0;
+    while n {
+        a = c.limit;
+        b = c.scale;
+        d = c.bias;
+        n = m;
+        m = c.flags;
+    }
+    return d;
+}
+
+function rotate(a: int32, b: int32, c: int32): int32 {
+    var last: int32 = 0;
+    while a {
+        last = a;
+        a = b;
+        b = c;
+        c = last;
+    }
+    return last;
+}
+
+function records(c: Config, n: int32): Config {
+    var out: Config = c;
+    while n {
+        out = c;
+        out.flags = n;
+        n = c.flags;
+    }
+    return out;
+}
+"""
+
+
+def loop_sizes(block):
+    """Instruction counts of the loops in a function's code, outermost only."""
+    instructions = block.instructions
+    positions = {}
+    sizes = []
+    end = -1
+    for i, inst in enumerate(instructions):
+        if isinstance(inst, s.Label):
+            positions[inst.name] = i
+    for i, inst in enumerate(instructions):
+        if i <= end or not isinstance(inst, s.Label):
+            continue
+        back = [
+            j
+            for j in range(i + 1, len(instructions))
+            if isinstance(instructions[j], s.Jmp) and instructions[j].to == inst.name
+        ]
+        if back:
+            end = back[-1]
+            body = instructions[i : end + 1]
+            sizes.append(sum(not isinstance(other, s.Label) for other in body))
+    return sizes
+
+
+def configurations(unroll):
+    return [
+        ("-O0", dict(opt_level=0), 1),
+        ("-O1 no loop opts", dict(opt_level=1, hoist_invariants=False), 1),
+        ("+hoisting", dict(opt_level=1), 1),
+        (f"+unroll {unroll}", dict(opt_level=1, unroll=unroll), unroll),
+    ]
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument("--unroll", type=int, default=2)
+    argparser.add_argument("--parser", choices=BACKENDS, default="fast")
+    args = argparser.parse_args()
+
+    tree = parse(SOURCE, backend=args.parser)
+    columns = configurations(args.unroll)
+    results = {}
+    for name, options, iterations in columns:
+        c = Compile(**options)
+        c.add_file(tree)
+        for block in c.finish().blocks:
+            for i, size in enumerate(loop_sizes(block)):
+                key = f"{block.label}#{i}"
+                results.setdefault(key, []).append(size / iterations)
+
+    print(f"{'loop':12}" + "".join(f"{name:>18}" for name, _, _ in columns))
+    for key, sizes in results.items():
+        print(f"{key:12}" + "".join(f"{size:18.1f}" for size in sizes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Startup time of one-shot invocations of the compiler.
+
+    python -m benchmarks.startup -o startup.json
+    python -m benchmarks.startup --baseline startup.json --threshold 0.2
+    python -m benchmarks.startup --breakdown compile
+
+Each command is run in a fresh interpreter a number of times and the best wall
+time is kept, next to that of an interpreter doing nothing. Bytecode caching
+is turned on for the runs (after one warm-up run) even if it's off here, since
+that's how the compiler normally runs. With --breakdown, `-X importtime` of one
+command is printed instead, the slowest imports first. With --baseline, every
+command that got slower than the baseline by more than the threshold is
+reported and the exit status is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+COMMANDS = {
+    "interpreter": ["-c", "pass"],
+    "help": [".", "--help"],
+    "compile": [".", "--parser", "fast", "test.c37"],
+    "compile_obj": [".", "--parser", "fast", "-c", "-o", os.devnull, "test.c37"],
+    "client": ["-m", "compiler.client", "--help"],
+}
+
+
+def environment(pycache):
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    env["PYTHONPYCACHEPREFIX"] = pycache
+    return env
+
+
+def run(args, env, extra=()):
+    return subprocess.run(
+        [sys.executable, *extra, *args],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+
+
+def best_time(args, env, repeat):
+    run(args, env)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(args, env)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def import_times(args, env):
+    """(module, self microseconds, cumulative microseconds) for every import."""
+    run(args, env)
+    stderr = run(args, env, extra=["-X", "importtime"]).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def compare(results, baseline, threshold, min_time):
+    regressions = []
+    for name, new in results["commands"].items():
+        old = baseline["commands"].get(name)
+        if old is None or new - old < min_time:
+            continue
+        if new > old * (1 + threshold):
+            regressions.append(
+                f"{name}: {old * 1000:.1f} ms -> {new * 1000:.1f} ms "
+                f"(+{(new / old - 1) * 100:.0f}%)"
+            )
+    return regressions
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument("-o", "--output", help="Write results to this file")
+    argparser.add_argument("--baseline", help="Compare against these results")
+    argparser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Allowed slowdown relative to the baseline (default: 0.2)",
+    )
+    argparser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.005,
+        help="Ignore slowdowns smaller than this many seconds (default: 0.005)",
+    )
+    argparser.add_argument("--repeat", type=int, default=10)
+    argparser.add_argument(
+        "--breakdown",
+        choices=COMMANDS,
+        help="Print the import times of this command instead",
+    )
+    argparser.add_argument("--top", type=int, default=25)
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as pycache:
+        env = environment(pycache)
+        if args.breakdown:
+            rows = import_times(COMMANDS[args.breakdown], env)
+            print(f"{'self ms':>8} {'total ms':>9}  module")
+            for name, self_us, cumulative_us in sorted(
+                rows, key=lambda row: row[1], reverse=True
+            )[: args.top]:
+                print(f"{self_us / 1000:8.2f} {cumulative_us / 1000:9.2f}  {name}")
+            total = sum(row[1] for row in rows)
+            print(f"{total / 1000:8.2f} {'':9}  (all {len(rows)} imports)")
+            return
+
+        results = {"python": platform.python_version(), "commands": {}}
+        for name, command in COMMANDS.items():
+            elapsed = best_time(command, env, args.repeat)
+            results["commands"][name] = elapsed
+            print(f"{name:15} {elapsed * 1000:8.1f} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_time)
+        for message in regressions:
+            print(f"regression: {message}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
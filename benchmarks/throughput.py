@@ -0,0 +1,160 @@
+"""
+Throughput of the whole compiler on synthetic programs.
+
+    python -m benchmarks.throughput -o results.json
+    python -m benchmarks.throughput --baseline results.json --threshold 0.2
+
+Parsing, `Compile.add_file` and `str(Program)` are timed separately (best of
+a few runs), and peak memory of one full run is measured with tracemalloc.
+With --baseline, every measurement that got worse than the baseline by more
+than the threshold is reported and the exit status is 1.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from compiler.compile import Compile
+from compiler.parser import BACKENDS, parse
+
+from .generate import generators
+
+# (name, generator, size) for a scale of 1
+CASES = [
+    ("functions", "functions", 2000),
+    ("wide_struct", "wide_struct", 500),
+    ("nested_struct", "nested_struct", 500),
+    ("long_body", "long_body", 5000),
+    ("arguments", "arguments", 200),
+]
+PHASES = ["parse", "compile", "emit"]
+
+
+def run_once(source, backend, opt_level):
+    """Times of each phase for one compilation."""
+    times = {}
+    start = time.perf_counter()
+    tree = parse(source, backend=backend)
+    times["parse"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    c = Compile(opt_level=opt_level)
+    c.add_file(tree)
+    times["compile"] = time.perf_counter() - start
+
+    program = c.finish()
+    start = time.perf_counter()
+    str(program)
+    times["emit"] = time.perf_counter() - start
+    return times
+
+
+def peak_memory(source, backend, opt_level):
+    tracemalloc.start()
+    try:
+        run_once(source, backend, opt_level)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def run_case(source, backend, opt_level, repeat):
+    try:
+        runs = [run_once(source, backend, opt_level) for _ in range(repeat)]
+    except NotImplementedError as e:
+        return {"skipped": f"not implemented: {e}"}
+    result = {phase: min(run[phase] for run in runs) for phase in PHASES}
+    result["peak_memory"] = peak_memory(source, backend, opt_level)
+    result["source_bytes"] = len(source)
+    return result
+
+
+def compare(results, baseline, threshold, min_time):
+    """
+    Messages for every measurement that regressed past the threshold. Times
+    that changed by less than min_time seconds are taken to be noise.
+    """
+    regressions = []
+    for name, result in results["cases"].items():
+        base = baseline["cases"].get(name)
+        if base is None or "skipped" in result or "skipped" in base:
+            continue
+        for metric in PHASES + ["peak_memory"]:
+            old, new = base[metric], result[metric]
+            if metric in PHASES and new - old < min_time:
+                continue
+            if old > 0 and new > old * (1 + threshold):
+                regressions.append(
+                    f"{name} {metric}: {old:.4g} -> {new:.4g} "
+                    f"(+{(new / old - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument("-o", "--output", help="Write results to this file")
+    argparser.add_argument("--baseline", help="Compare against these results")
+    argparser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Allowed slowdown relative to the baseline (default: 0.2)",
+    )
+    argparser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.002,
+        help="Ignore slowdowns smaller than this many seconds (default: 0.002)",
+    )
+    argparser.add_argument(
+        "--scale", type=float, default=1.0, help="Multiply input sizes by this"
+    )
+    argparser.add_argument("--repeat", type=int, default=3)
+    argparser.add_argument("--parser", choices=BACKENDS, default="fast")
+    argparser.add_argument("-O", dest="opt_level", type=int, default=0)
+    argparser.add_argument("--case", action="append", help="Only run these cases")
+    args = argparser.parse_args()
+
+    results = {
+        "python": platform.python_version(),
+        "parser": args.parser,
+        "opt_level": args.opt_level,
+        "scale": args.scale,
+        "cases": {},
+    }
+    for name, generator, size in CASES:
+        if args.case and name not in args.case:
+            continue
+        size = max(1, int(size * args.scale))
+        source = generators[generator](size)
+        result = run_case(source, args.parser, args.opt_level, args.repeat)
+        result["size"] = size
+        results["cases"][name] = result
+        if "skipped" in result:
+            print(f"{name:15} skipped ({result['skipped']})")
+        else:
+            times = "  ".join(f"{p} {result[p] * 1000:8.1f} ms" for p in PHASES)
+            peak = result["peak_memory"] / 1024 / 1024
+            print(f"{name:15} {times}  peak {peak:6.1f} MiB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_time)
+        for message in regressions:
+            print(f"regression: {message}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Where the System V x86-64 calling convention puts arguments and return values.
+
+Every value in the language is of the INTEGER class, split into eightbytes
+that go in general purpose registers, unless it is larger than 16 bytes: then
+it is of the MEMORY class and passed on the stack, or returned through memory
+the caller points RDI at.
+"""
+from .types_ import align
+from . import asm as s
+
+arg_registers = [
+    s.Register.rdi,
+    s.Register.rsi,
+    s.Register.rdx,
+    s.Register.rcx,
+    s.Register.r8,
+    s.Register.r9,
+]
+return_registers = [s.Register.rax, s.Register.rdx]
+# Bytes below RSP that signal handlers leave alone, so a function that calls
+# nothing can keep its locals there without moving RSP
+RED_ZONE = 128
+
+
+def eightbytes(size):
+    """Sizes of the parts a value is split into to go in registers."""
+    return [min(8, size - offset) for offset in range(0, size, 8)]
+
+
+def in_memory(type_):
+    return type_.size() > 16
+
+
+def register_width(size):
+    """The smallest register size that holds size bytes."""
+    return s.Size.from_byte_size(1 << (size - 1).bit_length())
+
+
+class Location:
+    """
+    Where an argument is: the registers holding its eightbytes, in order, or
+    its offset from RSP at the call (so from RBP + 16 in the callee).
+    """
+
+    def __init__(self, registers=(), stack_offset=None):
+        self.registers = registers
+        self.stack_offset = stack_offset
+
+
+def argument_locations(types):
+    """Locations of arguments of these types, in order."""
+    locations = []
+    next_register = 0
+    stack_offset = 0
+    for type_ in types:
+        parts = eightbytes(type_.size())
+        if not in_memory(type_) and next_register + len(parts) <= len(arg_registers):
+            registers = arg_registers[next_register : next_register + len(parts)]
+            next_register += len(parts)
+            locations.append(Location(registers=registers))
+        else:
+            locations.append(Location(stack_offset=stack_offset))
+            stack_offset += align(type_.size(), 8)
+    return locations
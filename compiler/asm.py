@@ -1,5 +1,8 @@
-from abc import ABC, ABCMeta, abstractmethod
-from enum import Enum, EnumMeta
+import io
+from abc import ABC, abstractmethod
+from enum import Enum
+
+from .instrument import phase
 
 
 class Size(Enum):
@@ -8,20 +11,31 @@ class Size(Enum):
     double_word = "l"
     quad_word = "q"
 
+    # Members are singletons, so identity hashing is enough and avoids
+    # Enum.__hash__, which is written in Python.
+    __hash__ = object.__hash__
+
     @classmethod
     def from_byte_size(cls, size):
-        if size == 1:
-            return cls.byte
-        if size == 2:
-            return cls.word
-        if size == 4:
-            return cls.double_word
-        if size == 8:
-            return cls.quad_word
-        raise NotImplementedError(f"Size for byte_size == {size}")
+        try:
+            return sizes_by_byte_size[size]
+        except KeyError:
+            raise NotImplementedError(f"Size for byte_size == {size}") from None
+
+    def byte_size(self):
+        return byte_sizes[self]
 
     def __str__(self):
-        return self.value
+        return self._value_
+
+
+sizes_by_byte_size = {
+    1: Size.byte,
+    2: Size.word,
+    4: Size.double_word,
+    8: Size.quad_word,
+}
+byte_sizes = {size: byte_size for byte_size, size in sizes_by_byte_size.items()}
 
 
 class SizeMismatch(Exception):
@@ -33,6 +47,8 @@ class UnknownSize(Exception):
 
 
 class Operand(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def size(self):
         ...
@@ -68,21 +84,31 @@ class Operand(ABC):
 
 
 class Address(Operand):
-    def __init__(self, register, offset):
+    """register + offset, plus index * scale if there is an index register."""
+
+    __slots__ = ("register", "offset", "index", "scale")
+
+    def __init__(self, register, offset, index=None, scale=1):
         self.register = register
         self.offset = offset
+        self.index = index
+        self.scale = scale
 
     def size(self):
         return None
 
     def with_offset(self, amount):
-        return Address(self.register, self.offset + amount)
+        return Address(self.register, self.offset + amount, self.index, self.scale)
 
     def __str__(self):
-        return f"{self.offset}({self.register})"
+        if self.index is None:
+            return f"{self.offset}({self.register})"
+        return f"{self.offset}({self.register},{self.index},{self.scale})"
 
 
 class Immediate(Operand):
+    __slots__ = ("value",)
+
     def __init__(self, value):
         self.value = value
 
@@ -96,8 +122,9 @@ class Immediate(Operand):
         return f"${self.value}"
 
 
-class RegisterMeta(EnumMeta, ABCMeta):
-    pass
+def fits_imm32(value):
+    """Whether an immediate can be used by anything other than a 64-bit mov."""
+    return -(2 ** 31) <= value < 2 ** 31
 
 
 class RegisterFamily:
@@ -109,117 +136,165 @@ class RegisterFamily:
             Size.quad_word: quad_word,
         }
         self.extra = extra
+        self.members = frozenset(self.sizes.values()).union(extra or ())
+        # Point every member back at its family so lookups don't have to
+        # search. The high byte registers (ah etc.) have no size of their own.
+        for size, reg in self.sizes.items():
+            reg._family = self
+            reg._size = size
+        for reg in extra or ():
+            reg._family = self
+            reg._size = None
 
     def __contains__(self, reg):
-        return reg in set(self.sizes.values()) or (
-            self.extra is not None and reg in self.extra
-        )
+        return reg in self.members
 
     def size_of(self, reg):
-        for size, reg2 in self.sizes.items():
-            if reg is reg2:
-                return size
+        if reg in self.members:
+            return reg._size
 
     def with_size(self, size):
         return self.sizes[size]
 
     @classmethod
     def for_register(cls, reg):
-        for fam in register_families:
-            if reg in fam:
-                return fam
-        raise KeyError(reg)
-
-
-class Register(Operand, Enum, metaclass=RegisterMeta):
-    # 8 byte
-    rax = "%rax"
-    rbx = "%rbx"
-    rcx = "%rcx"
-    rdx = "%rdx"
-    rbp = "%rbp"
-    rsp = "%rsp"
-    rsi = "%rsi"
-    rdi = "%rdi"
-    r8 = "%r8"
-    r9 = "%r9"
-    r10 = "%r10"
-    r11 = "%r11"
-    r12 = "%r12"
-    r13 = "%r13"
-    r14 = "%r14"
-    r15 = "%r15"
-
-    # 4 byte
-    eax = "%eax"
-    ebx = "%ebx"
-    ecx = "%ecx"
-    edx = "%edx"
-    ebp = "%ebp"
-    esp = "%esp"
-    esi = "%esi"
-    edi = "%edi"
-    r8d = "%r8d"
-    r9d = "%r9d"
-    r10d = "%r10d"
-    r11d = "%r11d"
-    r12d = "%r12d"
-    r13d = "%r13d"
-    r14d = "%r14d"
-    r15d = "%r15d"
-
-    # 2 byte
-    ax = "%ax"
-    bx = "%bx"
-    cx = "%cx"
-    dx = "%dx"
-    bp = "%bp"
-    sp = "%sp"
-    si = "%si"
-    di = "%di"
-    r8w = "%r8w"
-    r9w = "%r9w"
-    r10w = "%r10w"
-    r11w = "%r11w"
-    r12w = "%r12w"
-    r13w = "%r13w"
-    r14w = "%r14w"
-    r15w = "%r15w"
-
-    # 1 byte
-    al = "%al"
-    bl = "%bl"
-    cl = "%cl"
-    dl = "%dl"
-    ah = "%ah"
-    bh = "%bh"
-    ch = "%ch"
-    dh = "%dh"
-    bpl = "%bpl"
-    spl = "%spl"
-    sil = "%sil"
-    dil = "%dil"
-    r8b = "%r8b"
-    r9b = "%r9b"
-    r10b = "%r10b"
-    r11b = "%r11b"
-    r12b = "%r12b"
-    r13b = "%r13b"
-    r14b = "%r14b"
-    r15b = "%r15b"
+        try:
+            return reg._family
+        except AttributeError:
+            raise KeyError(reg) from None
+
+
+class Register(Operand):
+    """
+    A register. There is exactly one instance for each, created below, so
+    they compare by identity. A plain class with prebuilt instances is much
+    cheaper to import than an Enum of 84 members.
+    """
+
+    __slots__ = ("name", "_value_", "_family", "_size")
+
+    def __init__(self, name):
+        self.name = name
+        self._value_ = f"%{name}"
+
+    def __reduce__(self):
+        # Unpickle to the same instance
+        return (getattr, (Register, self.name))
+
+    def __repr__(self):
+        return f"<Register.{self.name}>"
 
     def size(self):
-        return RegisterFamily.for_register(self).size_of(self)
+        return self._size
 
     def with_offset(self, amount):
         return Address(self, amount)
 
     def with_size(self, size):
-        return RegisterFamily.for_register(self).with_size(size)
+        return self._family.sizes[size]
 
     def __str__(self):
-        return self.value
-
+        return self._value_
+
+
+# 8 byte
+Register.rax = Register("rax")
+Register.rbx = Register("rbx")
+Register.rcx = Register("rcx")
+Register.rdx = Register("rdx")
+Register.rbp = Register("rbp")
+Register.rsp = Register("rsp")
+Register.rsi = Register("rsi")
+Register.rdi = Register("rdi")
+Register.r8 = Register("r8")
+Register.r9 = Register("r9")
+Register.r10 = Register("r10")
+Register.r11 = Register("r11")
+Register.r12 = Register("r12")
+Register.r13 = Register("r13")
+Register.r14 = Register("r14")
+Register.r15 = Register("r15")
+
+# 4 byte
+Register.eax = Register("eax")
+Register.ebx = Register("ebx")
+Register.ecx = Register("ecx")
+Register.edx = Register("edx")
+Register.ebp = Register("ebp")
+Register.esp = Register("esp")
+Register.esi = Register("esi")
+Register.edi = Register("edi")
+Register.r8d = Register("r8d")
+Register.r9d = Register("r9d")
+Register.r10d = Register("r10d")
+Register.r11d = Register("r11d")
+Register.r12d = Register("r12d")
+Register.r13d = Register("r13d")
+Register.r14d = Register("r14d")
+Register.r15d = Register("r15d")
+
+# 2 byte
+Register.ax = Register("ax")
+Register.bx = Register("bx")
+Register.cx = Register("cx")
+Register.dx = Register("dx")
+Register.bp = Register("bp")
+Register.sp = Register("sp")
+Register.si = Register("si")
+Register.di = Register("di")
+Register.r8w = Register("r8w")
+Register.r9w = Register("r9w")
+Register.r10w = Register("r10w")
+Register.r11w = Register("r11w")
+Register.r12w = Register("r12w")
+Register.r13w = Register("r13w")
+Register.r14w = Register("r14w")
+Register.r15w = Register("r15w")
+
+# 1 byte
+Register.al = Register("al")
+Register.bl = Register("bl")
+Register.cl = Register("cl")
+Register.dl = Register("dl")
+Register.ah = Register("ah")
+Register.bh = Register("bh")
+Register.ch = Register("ch")
+Register.dh = Register("dh")
+Register.bpl = Register("bpl")
+Register.spl = Register("spl")
+Register.sil = Register("sil")
+Register.dil = Register("dil")
+Register.r8b = Register("r8b")
+Register.r9b = Register("r9b")
+Register.r10b = Register("r10b")
+Register.r11b = Register("r11b")
+Register.r12b = Register("r12b")
+Register.r13b = Register("r13b")
+Register.r14b = Register("r14b")
+Register.r15b = Register("r15b")
+
+# 16 byte SSE registers, only used to move memory around. They belong to no
+# family and have no size of their own.
+Register.xmm0 = Register("xmm0")
+Register.xmm1 = Register("xmm1")
+Register.xmm2 = Register("xmm2")
+Register.xmm3 = Register("xmm3")
+Register.xmm4 = Register("xmm4")
+Register.xmm5 = Register("xmm5")
+Register.xmm6 = Register("xmm6")
+Register.xmm7 = Register("xmm7")
+Register.xmm8 = Register("xmm8")
+Register.xmm9 = Register("xmm9")
+Register.xmm10 = Register("xmm10")
+Register.xmm11 = Register("xmm11")
+Register.xmm12 = Register("xmm12")
+Register.xmm13 = Register("xmm13")
+Register.xmm14 = Register("xmm14")
+Register.xmm15 = Register("xmm15")
+xmm_registers = [getattr(Register, f"xmm{i}") for i in range(16)]
+for _reg in xmm_registers:
+    _reg._family = None
+    _reg._size = None
 
 register_families = [
     RegisterFamily(
@@ -250,10 +325,12 @@ register_families = [
 
 
 class Instruction:
-    pass
+    __slots__ = ()
 
 
 class SizedBinaryInstruction(Instruction):
+    __slots__ = ("src", "dest", "size")
+
     def __init__(self, src, dest, size=None):
         if isinstance(src, Address) and isinstance(dest, Address):
             raise TypeError(
@@ -265,32 +342,44 @@ class SizedBinaryInstruction(Instruction):
 
 
 class SizedUnaryInstruction(Instruction):
+    __slots__ = ("operand", "size")
+
     def __init__(self, operand, size=None):
         self.operand = operand
         self.size = size or Operand.unify_size(operand)
 
 
 class Mov(SizedBinaryInstruction):
+    __slots__ = ()
+
     def __str__(self):
         return f"mov{self.size} {self.src}, {self.dest}"
 
 
 class Push(SizedUnaryInstruction):
+    __slots__ = ()
+
     def __str__(self):
         return f"push{self.size} {self.operand}"
 
 
 class Pop(SizedUnaryInstruction):
+    __slots__ = ()
+
     def __str__(self):
         return f"pop{self.size} {self.operand}"
 
 
 class Ret(Instruction):
+    __slots__ = ()
+
     def __str__(self):
         return "ret"
 
 
 class Label(Instruction):
+    __slots__ = ("name",)
+
     def __init__(self, name):
         self.name = name
 
@@ -299,6 +388,8 @@ class Label(Instruction):
 
 
 class Jmp(Instruction):
+    __slots__ = ("to",)
+
     def __init__(self, to):
         self.to = to
 
@@ -306,31 +397,311 @@ class Jmp(Instruction):
         return f"jmp {self.to}"
 
 
+class Jcc(Jmp):
+    """A conditional jump, `condition` being the suffix: "e", "ne" and so on."""
+
+    __slots__ = ("condition",)
+
+    def __init__(self, condition, to):
+        super().__init__(to)
+        self.condition = condition
+
+    def __str__(self):
+        return f"j{self.condition} {self.to}"
+
+
+class Call(Instruction):
+    __slots__ = ("to",)
+
+    def __init__(self, to):
+        self.to = to
+
+    def __str__(self):
+        return f"call {self.to}"
+
+
+class Add(SizedBinaryInstruction):
+    __slots__ = ()
+
+    def __str__(self):
+        return f"add{self.size} {self.src}, {self.dest}"
+
+
 class Sub(SizedBinaryInstruction):
+    __slots__ = ()
+
     def __str__(self):
         return f"sub{self.size} {self.src}, {self.dest}"
 
 
+class Cmp(SizedBinaryInstruction):
+    """Set the flags for dest - src."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return f"cmp{self.size} {self.src}, {self.dest}"
+
+
+class Test(SizedBinaryInstruction):
+    """Set the flags for dest & src."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return f"test{self.size} {self.src}, {self.dest}"
+
+
+class Lea(SizedBinaryInstruction):
+    __slots__ = ()
+
+    def __str__(self):
+        return f"lea{self.size} {self.src}, {self.dest}"
+
+
+class And(SizedBinaryInstruction):
+    __slots__ = ()
+
+    def __str__(self):
+        return f"and{self.size} {self.src}, {self.dest}"
+
+
+class Or(SizedBinaryInstruction):
+    __slots__ = ()
+
+    def __str__(self):
+        return f"or{self.size} {self.src}, {self.dest}"
+
+
+class Xor(SizedBinaryInstruction):
+    __slots__ = ()
+
+    def __str__(self):
+        return f"xor{self.size} {self.src}, {self.dest}"
+
+
+class Imul(SizedBinaryInstruction):
+    """
+    Signed multiplication of dest by src, or with a factor, dest = src *
+    factor. There is no byte form.
+    """
+
+    __slots__ = ("factor",)
+
+    def __init__(self, src, dest, size=None, factor=None):
+        super().__init__(src, dest, size)
+        self.factor = factor
+
+    def __str__(self):
+        if self.factor is None:
+            return f"imul{self.size} {self.src}, {self.dest}"
+        return f"imul{self.size} {self.factor}, {self.src}, {self.dest}"
+
+
+class Shl(SizedBinaryInstruction):
+    """Shift dest left by src, an immediate or %cl."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return f"shl{self.size} {self.src}, {self.dest}"
+
+
+class Shr(SizedBinaryInstruction):
+    """Logical shift right of dest by src, an immediate or %cl."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return f"shr{self.size} {self.src}, {self.dest}"
+
+
+class Sar(SizedBinaryInstruction):
+    """Arithmetic shift right of dest by src, an immediate or %cl."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return f"sar{self.size} {self.src}, {self.dest}"
+
+
+class Movsx(Instruction):
+    """Move src into the wider register dest, sign extended."""
+
+    __slots__ = ("src", "dest", "src_size")
+
+    def __init__(self, src, dest, src_size=None):
+        self.src = src
+        self.dest = dest
+        self.src_size = src_size or Operand.unify_size(src)
+
+    @property
+    def size(self):
+        return self.dest.size()
+
+    def __str__(self):
+        return f"movs{self.src_size}{self.size} {self.src}, {self.dest}"
+
+
+class Neg(SizedUnaryInstruction):
+    __slots__ = ()
+
+    def __str__(self):
+        return f"neg{self.size} {self.operand}"
+
+
+class Idiv(SizedUnaryInstruction):
+    """Divide RDX:RAX (or EDX:EAX) by operand: quotient in RAX, remainder RDX."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return f"idiv{self.size} {self.operand}"
+
+
+class Cltd(Instruction):
+    """Sign extend EAX into EDX, for `idivl`."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return "cltd"
+
+
+class Cqto(Instruction):
+    """Sign extend RAX into RDX, for `idivq`."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return "cqto"
+
+
+class Movdqu(Instruction):
+    """16 byte move between an SSE register and memory or another one."""
+
+    __slots__ = ("src", "dest")
+
+    def __init__(self, src, dest):
+        self.src = src
+        self.dest = dest
+
+    def __str__(self):
+        return f"movdqu {self.src}, {self.dest}"
+
+
+class Movdqa(Movdqu):
+    """Movdqu for memory that is known to be 16 byte aligned."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return f"movdqa {self.src}, {self.dest}"
+
+
+class RepMovsq(Instruction):
+    """Copy RCX quad words from (%rsi) to (%rdi)."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return "rep movsq"
+
+
 class Leave(Instruction):
+    __slots__ = ()
+
     def __str__(self):
         return "leave"
 
 
+# Latency in cycles of the instructions instruction selection chooses between,
+# roughly those of recent Intel and AMD cores (from Agner Fog's instruction
+# tables). Reading a memory operand adds LOAD_LATENCY.
+LATENCIES = {
+    Mov: 1,
+    Movsx: 1,
+    Add: 1,
+    Sub: 1,
+    And: 1,
+    Or: 1,
+    Xor: 1,
+    Neg: 1,
+    Lea: 1,
+    Shl: 1,
+    Shr: 1,
+    Sar: 1,
+    Imul: 3,
+    Idiv: 26,
+    Cltd: 1,
+    Cqto: 1,
+}
+LOAD_LATENCY = 4
+
+
+def cost(instructions, optimize_size=False):
+    """
+    What a sequence of instructions costs, to compare with another one doing
+    the same thing: total latency then code size in bytes, or the other way
+    around when optimizing for size.
+    """
+    from .encode import encode
+
+    latency = size = 0
+    for inst in instructions:
+        latency += LATENCIES[type(inst)]
+        if isinstance(getattr(inst, "src", None), Address) and not isinstance(
+            inst, Lea
+        ):
+            latency += LOAD_LATENCY
+        size += len(encode(inst))
+    return (size, latency) if optimize_size else (latency, size)
+
+
 class Block:
     def __init__(self, label, instructions):
         self.label = label
         self.instructions = instructions
 
+    def emit(self, writer):
+        """Write the block to anything with a `write` method."""
+        write = writer.write
+        write(f"{self.label}:")
+        for inst in self.instructions:
+            if isinstance(inst, Label):
+                write(f"\n{inst}")
+            else:
+                write(f"\n\t{inst}")
+
     def __str__(self):
-        buf = [f"{self.label}:"]
+        buf = io.StringIO()
+        self.emit(buf)
+        return buf.getvalue()
 
-        def maybe_tab(inst):
-            if isinstance(inst, Label):
-                return str(inst)
-            return f"\t{inst}"
 
-        buf.extend(map(maybe_tab, self.instructions))
-        return "\n".join(buf)
+class ProgramWriter:
+    """
+    Writes a program one block at a time, so that blocks can be written (and
+    dropped) as soon as they are generated. The exports go first, so they
+    have to be known up front.
+    """
+
+    def __init__(self, stream, exports):
+        self.stream = stream
+        self.started = False
+        for exp in exports:
+            self._separate()
+            stream.write(f".globl {exp}")
+
+    def _separate(self):
+        if self.started:
+            self.stream.write("\n")
+        self.started = True
+
+    def write_block(self, block):
+        self._separate()
+        self.stream.write("\n")
+        block.emit(self.stream)
 
 
 class Program:
@@ -338,7 +709,13 @@ class Program:
         self.exports = exports
         self.blocks = blocks
 
+    def write_to(self, stream):
+        with phase("emit"):
+            writer = ProgramWriter(stream, self.exports)
+            for block in self.blocks:
+                writer.write_block(block)
+
     def __str__(self):
-        buf = [f".globl {exp}" for exp in self.exports]
-        buf.extend(f"\n{block}" for block in self.blocks)
-        return "\n".join(buf)
+        buf = io.StringIO()
+        self.write_to(buf)
+        return buf.getvalue()
@@ -94,6 +94,16 @@ class ReturnStmt(Stmt):
         return f"return{value};"
 
 
+class WhileStmt(Stmt):
+    def __init__(self, condition, body):
+        self.condition = condition
+        self.body = body
+
+    def __str__(self):
+        body = "\n\t".join(map(str, self.body))
+        return f"while {self.condition} {{\n\t{body}\n}}"
+
+
 class Expr:
     pass
 
@@ -130,9 +140,39 @@ class FieldAccessExpr(Expr):
         return f"{self.obj}.{self.field_name}"
 
 
+class BinaryExpr(Expr):
+    def __init__(self, operator, left, right):
+        self.operator = operator
+        self.left = left
+        self.right = right
+
+    def __str__(self):
+        return f"({self.left} {self.operator} {self.right})"
+
+
+class CallExpr(Expr):
+    def __init__(self, function_name, arguments):
+        self.function_name = function_name
+        self.arguments = arguments
+
+    def __str__(self):
+        arguments = ", ".join(map(str, self.arguments))
+        return f"{self.function_name}({arguments})"
+
+
 class File:
     def __init__(self, decls):
         self.decls = decls
 
     def __str__(self):
         return "\n\n".join(map(str, self.decls))
+
+
+def dump(node):
+    """Nested tuples describing a tree, for comparing and hashing ASTs."""
+    if isinstance(node, (list, tuple)):
+        return tuple(dump(n) for n in node)
+    if hasattr(node, "__dict__"):
+        fields = sorted(vars(node).items())
+        return (type(node).__name__,) + tuple((k, dump(v)) for k, v in fields)
+    return node
@@ -0,0 +1,202 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from pathlib import Path
+
+from . import ast
+from .types_ import Array, Integer, Struct
+
+# Bump this when the pickled representation changes in a way that the
+# fingerprinted sources below wouldn't catch.
+FORMAT_VERSION = 2
+# Eviction makes room down to this fraction of max_bytes, so that the stores
+# right after it don't have to evict again
+LOW_WATER = 0.75
+
+_package_dir = Path(__file__).resolve().parent
+# Everything that decides what AST a source file parses to
+_parser_files = [
+    _package_dir.parent / "Compiler37.g4",
+    _package_dir / "ast.py",
+    _package_dir / "antlr_parser.py",
+    _package_dir / "rd_parser.py",
+]
+# Everything that decides what code a function compiles to. That's most of
+# the package, so all of it is fingerprinted rather than a list that every new
+# pass would have to remember to join.
+_codegen_files = sorted(_package_dir.glob("*.py"))
+_fingerprints = {}
+
+
+def source_fingerprint(paths):
+    """Hash of the contents of some of the compiler's own source files."""
+    paths = tuple(paths)
+    if paths not in _fingerprints:
+        h = hashlib.sha256(f"format {FORMAT_VERSION}\n".encode())
+        for path in paths:
+            h.update(path.name.encode())
+            try:
+                h.update(path.read_bytes())
+            except FileNotFoundError:
+                h.update(b"<missing>")
+        _fingerprints[paths] = h.hexdigest()
+    return _fingerprints[paths]
+
+
+def describe_layout(type_):
+    """
+    Nested tuples describing the memory layout of a type, down to the offset
+    of every field of every nested struct.
+    """
+    if isinstance(type_, Integer):
+        return ("int", type_.size())
+    if isinstance(type_, Array):
+        return ("array", type_.length, describe_layout(type_.element_type))
+    if isinstance(type_, Struct):
+        layout = type_.layout
+        return (
+            "struct",
+            type_.name,
+            layout.size,
+            tuple(
+                (field.name, field.offset, describe_layout(field.type))
+                for field in layout.fields
+            ),
+        )
+    raise NotImplementedError(type(type_))
+
+
+class DiskCache:
+    """
+    Directory of pickled values named by key.
+
+    Entries are touched when read, so the mtime is the last use and eviction
+    drops the least recently used ones once the directory grows past
+    max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Counted once here and then kept up to date by every store, so
+        # storing doesn't have to look at every entry
+        self.total_bytes = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        return self.directory / f"{key}.pickle"
+
+    def load(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def store(self, key, value):
+        path = self._path(key)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+            try:
+                replaced = path.stat().st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.total_bytes += size - replaced
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        """(mtime, size, path) of every entry, least recently used first."""
+        entries = []
+        for path in self.directory.glob("*.pickle"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        """
+        Drop the least recently used entries until the directory is down to
+        LOW_WATER of max_bytes. Counts what's there again, since other
+        processes may have stored and evicted too.
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes * LOW_WATER:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+        self.total_bytes = total
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def merge_stats(self, stats):
+        """Add counters collected by another instance, e.g. in a worker."""
+        self.hits += stats["hits"]
+        self.misses += stats["misses"]
+        self.evictions += stats["evictions"]
+
+
+class ParseCache(DiskCache):
+    """
+    Parsed `ast.File` trees, together with the warnings printed while parsing
+    them, keyed by the source text and the parser backend.
+    """
+
+    def key(self, source, backend):
+        h = hashlib.sha256(source_fingerprint(_parser_files).encode())
+        h.update(f"{backend}\n".encode())
+        h.update(source.encode())
+        return h.hexdigest()
+
+    def get(self, source, backend):
+        return self.load(self.key(source, backend))
+
+    def put(self, source, backend, value):
+        self.store(self.key(source, backend), value)
+
+
+class BlockCache(DiskCache):
+    """
+    Code generated for single functions, keyed by the function's AST, the
+    layout of every type it uses, what it relies on of the functions it calls
+    and the compiler options. Changing a struct therefore only invalidates the
+    functions whose code could depend on it.
+    """
+
+    def key(self, decl, types, options=(), callees=()):
+        h = hashlib.sha256(source_fingerprint(_codegen_files).encode())
+        h.update(repr(options).encode())
+        h.update(repr(ast.dump(decl)).encode())
+        h.update(repr(ast.dump(callees)).encode())
+        for type_ in types:
+            h.update(repr(describe_layout(type_)).encode())
+        return h.hexdigest()
@@ -0,0 +1,109 @@
+"""
+Thin client for `compiler/server.py`.
+
+    python -m compiler.client /tmp/c37.sock -O1 -o out.s test.c37
+
+This only imports what it needs to talk to the server, so it starts about as
+fast as the interpreter does. Options have the same meaning as for
+`python .`; "-" as a file reads the source from stdin.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+
+
+class ServerError(Exception):
+    pass
+
+
+def request_compile(path, inputs, options):
+    """Send a request to the server at path. Returns the output and the log."""
+    request = {"inputs": inputs, "options": options}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        with sock.makefile("rwb") as stream:
+            stream.write(json.dumps(request).encode("utf-8") + b"\n")
+            stream.flush()
+            header = json.loads(stream.readline())
+            if not header["ok"]:
+                raise ServerError(header["error"])
+            output = stream.read(header["length"])
+    return output, header["log"]
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Compiler 37 client")
+    argparser.add_argument("socket", help="Socket the server listens on")
+    argparser.add_argument("files", metavar="FILE", nargs="+", help="Input files")
+    argparser.add_argument("-o", "--output", dest="out", default="-")
+    argparser.add_argument("--parser", default="antlr")
+    argparser.add_argument(
+        "-O", dest="opt_level", choices=["0", "1", "2", "s"], default="0"
+    )
+    argparser.add_argument("--emit", choices=["asm", "obj"], default="asm")
+    argparser.add_argument("-c", dest="emit", action="store_const", const="obj")
+    argparser.add_argument("--inline-threshold", dest="inline_threshold", type=int)
+    argparser.add_argument("--opt-stats", dest="opt_stats", action="store_true")
+    argparser.add_argument("--dump-regalloc", dest="dump_regalloc", action="store_true")
+    argparser.add_argument("--inline-report", dest="inline_report", action="store_true")
+    argparser.add_argument("--unroll", dest="unroll", type=int, default=1)
+    argparser.add_argument(
+        "-fomit-frame-pointer", dest="omit_frame_pointer", action="store_true"
+    )
+    argparser.add_argument(
+        "-fno-omit-frame-pointer", dest="omit_frame_pointer", action="store_false"
+    )
+    argparser.add_argument("--reorder-fields", dest="reorder_fields", action="store_true")
+    argparser.add_argument(
+        "--reorder-struct", dest="reorder_structs", action="append", default=[]
+    )
+    argparser.add_argument("--layout-report", dest="layout_report", action="store_true")
+    args = argparser.parse_args()
+
+    inputs = []
+    for file in args.files:
+        if file == "-":
+            inputs.append({"source": sys.stdin.read()})
+        else:
+            # The server has its own working directory
+            inputs.append({"path": os.path.abspath(file)})
+    options = {
+        "parser": args.parser,
+        # -Os is -O2 tuned for size
+        "opt_level": 2 if args.opt_level == "s" else int(args.opt_level),
+        "optimize_size": args.opt_level == "s",
+        "emit": args.emit,
+        "opt_stats": args.opt_stats,
+        "dump_regalloc": args.dump_regalloc,
+        "inline_report": args.inline_report,
+        "unroll": args.unroll,
+        "omit_frame_pointer": args.omit_frame_pointer,
+        "reorder_fields": args.reorder_fields,
+        "reorder_structs": args.reorder_structs,
+        "layout_report": args.layout_report,
+    }
+    if args.inline_threshold is not None:
+        options["inline_threshold"] = args.inline_threshold
+
+    try:
+        output, log = request_compile(args.socket, inputs, options)
+    except OSError as e:
+        print(f"Can't reach the server at {args.socket}: {e}", file=sys.stderr)
+        sys.exit(2)
+    except ServerError as e:
+        print(str(e).rstrip("\n"), file=sys.stderr)
+        sys.exit(1)
+    sys.stderr.write(log)
+    if args.out != "-":
+        with open(args.out, "wb") as f:
+            f.write(output)
+    elif args.emit == "obj":
+        sys.stdout.buffer.write(output)
+    else:
+        sys.stdout.buffer.write(output + b"\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,237 +1,395 @@
+from collections import Counter, defaultdict
+
 from .ast import (
     ArrayTypeExpr,
     AssignStmt,
+    BinaryExpr,
+    CallExpr,
     FieldAccessExpr,
     FunctionDecl,
-    IdentExpr,
-    IntExpr,
     NamedTypeExpr,
     ReturnStmt,
     StructDecl,
     VarDecl,
+    WhileStmt,
 )
-from .types_ import align, Array, Function, Integer, Struct
+from .constprop import propagate_constants
+from .dce import eliminate_dead_code
+from .inline import DEFAULT_THRESHOLD, Inliner
+from .instrument import count_function, phase
+from .irgen import build as build_ir
+from .isel import Selector
+from .loops import optimize_loops
+from .lower import lower
+from .mem2reg import mem2reg
+from .peephole import Peephole
+from .types_ import Array, Function, Integer, Struct
 from . import asm as s
 
 
-class Binding:
-    def __init__(self, location, type_):
-        self.location = location
-        self.type = type_
+def exported_functions(files):
+    """Names of the exported functions in some parsed files, in order."""
+    return [
+        decl.name
+        for file in files
+        for decl in file.decls
+        if isinstance(decl, FunctionDecl) and decl.export
+    ]
+
+
+def type_name(type_expr):
+    if isinstance(type_expr, ArrayTypeExpr):
+        return type_name(type_expr.element_type)
+    return type_expr.name
+
 
+def abi_structs(ast):
+    """
+    Names of the structs in a file whose layout code outside of it may rely
+    on: those declared export and those passed to or returned from exported
+    functions, with every struct nested in them.
+    """
+    structs = {d.name: d for d in ast.decls if isinstance(d, StructDecl)}
+    pending = [d.name for d in structs.values() if d.export]
+    for decl in ast.decls:
+        if isinstance(decl, FunctionDecl) and decl.export:
+            pending.extend(type_name(t) for _, t in decl.arguments)
+            pending.append(type_name(decl.return_type))
+    found = set()
+    while pending:
+        name = pending.pop()
+        if name in structs and name not in found:
+            found.add(name)
+            pending.extend(type_name(t) for _, t in structs[name].fields)
+    return found
 
-class OutOfRegisters(Exception):
-    pass
 
+def statements(body):
+    """Every statement in a function body, nested ones included."""
+    for stmt in body:
+        yield stmt
+        if isinstance(stmt, WhileStmt):
+            yield from statements(stmt.body)
 
-class Registers:
-    def __init__(self):
-        self.pos = 0
-        self.available_registers = [
-            s.Register.rax,
-            s.Register.rdi,
-            s.Register.rsi,
-            s.Register.rdx,
-            s.Register.rcx,
-            s.Register.r8,
-            s.Register.r9,
-            s.Register.r10,
-            s.Register.r11,
-        ]
 
-    def reserve(self):
-        if self.pos >= len(self.available_registers):
-            raise OutOfRegisters()
-        reg = self.available_registers[self.pos]
-        self.pos += 1
-        this = self
+def expressions(stmt):
+    """The expressions directly in a statement."""
+    if isinstance(stmt, VarDecl):
+        found = [stmt.init]
+    elif isinstance(stmt, AssignStmt):
+        found = [stmt.target, stmt.value]
+    elif isinstance(stmt, ReturnStmt):
+        found = [stmt.value]
+    elif isinstance(stmt, WhileStmt):
+        found = [stmt.condition]
+    else:
+        found = []
+    return [expr for expr in found if expr is not None]
 
-        class RegisterManager:
-            def __enter__(self):
-                return reg
 
-            def __exit__(self, exc_type, exc_value, traceback):
-                this.pos -= 1
+def calls(body):
+    """Names of the functions called in a function body, in order."""
+    pending = [expr for stmt in statements(body) for expr in expressions(stmt)]
+    pending.reverse()
+    while pending:
+        expr = pending.pop()
+        if isinstance(expr, CallExpr):
+            yield expr.function_name
+            pending.extend(reversed(expr.arguments))
+        elif isinstance(expr, FieldAccessExpr):
+            pending.append(expr.obj)
+        elif isinstance(expr, BinaryExpr):
+            pending.extend([expr.right, expr.left])
 
-        return RegisterManager()
+
+def frame_size(block):
+    """
+    Bytes a function's prologue reserves for its frame, or if it reserves
+    none, how far below RSP its locals in the red zone reach.
+    """
+    red_zone = 0
+    for inst in block.instructions:
+        if (
+            isinstance(inst, s.Sub)
+            and inst.dest == s.Register.rsp
+            and isinstance(inst.src, s.Immediate)
+        ):
+            return inst.src.value
+        for operand in (getattr(inst, "src", None), getattr(inst, "dest", None)):
+            if isinstance(operand, s.Address) and operand.register is s.Register.rsp:
+                red_zone = max(red_zone, -operand.offset)
+    return red_zone
 
 
 class Compile:
-    def __init__(self):
+    def __init__(
+        self,
+        block_cache=None,
+        opt_level=0,
+        report_opt_stats=False,
+        regalloc_log=None,
+        inline_threshold=DEFAULT_THRESHOLD,
+        inline_log=None,
+        reorder_fields=False,
+        reorder_structs=(),
+        layout_log=None,
+        unroll=1,
+        hoist_invariants=True,
+        omit_frame_pointer=False,
+        optimize_size=False,
+    ):
+        self.block_cache = block_cache
+        self.opt_level = opt_level
+        self.report_opt_stats = report_opt_stats
+        # Stream to print register allocations to, for debugging
+        self.regalloc_log = regalloc_log
+        self.inline_threshold = inline_threshold
+        # Structs to lay out in the order that needs the least padding: all
+        # of them, or the ones named
+        self.reorder_fields = reorder_fields
+        self.reorder_structs = frozenset(reorder_structs)
+        # Stream to print the layout of every struct to
+        self.layout_log = layout_log
+        # How many iterations one trip around an innermost loop runs, and
+        # whether to hoist loads out of loops
+        self.unroll = unroll
+        self.hoist_invariants = hoist_invariants
+        # Whether RBP is free for values, with the frame addressed from RSP
+        self.omit_frame_pointer = omit_frame_pointer
+        # Whether instruction selection goes for small code over fast code
+        # (-Os), and the idioms it uses from -O1 on
+        self.optimize_size = optimize_size
+        self.selector = Selector(optimize_size, idioms=opt_level >= 1)
+        self.peephole = Peephole() if opt_level >= 1 else None
+        # Counters of what each optimization pass did
+        self.pass_stats = defaultdict(Counter)
+        if self.peephole is not None:
+            self.pass_stats["peephole"] = self.peephole.stats
+        self.inliner = None
+        if opt_level >= 1 and inline_threshold > 0:
+            self.inliner = Inliner(
+                self, inline_threshold, self.pass_stats["inline"], inline_log
+            )
         self.exports = []
         self.blocks = []
+        self.writer = None
         self.types = {
             "int8": Integer(8),
             "int16": Integer(16),
             "int32": Integer(32),
         }
+        self.array_types = {}
         self.functions = {}
+        # Declarations of the functions, for inlining
+        self.function_decls = {}
 
     def get_type(self, type_expr):
         if isinstance(type_expr, NamedTypeExpr):
             return self.types[type_expr.name]
         if isinstance(type_expr, ArrayTypeExpr):
-            return Array(self.get_type(type_expr.element_type), type_expr.length)
+            element_type = self.get_type(type_expr.element_type)
+            key = (element_type, type_expr.length)
+            array = self.array_types.get(key)
+            if array is None:
+                array = self.array_types[key] = Array(element_type, type_expr.length)
+            return array
         raise NotImplementedError()
 
     def add_file(self, ast):
-        # First pass for types
+        with phase("declare"):
+            self.declare_file(ast)
+        with phase("compile"):
+            self.compile_file(ast)
+
+    def declare_file(self, ast):
+        """First pass: collect the types and function signatures in a file."""
+        abi = set()
+        if self.reorder_fields or self.reorder_structs:
+            abi = abi_structs(ast)
         for decl in ast.decls:
             if isinstance(decl, StructDecl):
-                self.types[decl.name] = Struct(
+                wanted = self.reorder_fields or decl.name in self.reorder_structs
+                exported = decl.name in abi
+                struct = self.types[decl.name] = Struct(
                     name=decl.name,
                     fields=[Struct.Field(n, self.get_type(t)) for n, t in decl.fields],
+                    reorder=wanted and not exported,
                 )
+                if self.layout_log is not None:
+                    note = None
+                    if wanted and exported:
+                        note = "exported, declaration order kept"
+                    print(struct.format_layout(note), file=self.layout_log)
             elif isinstance(decl, FunctionDecl):
+                self.function_decls[decl.name] = decl
                 self.functions[decl.name] = Function(
                     argument_types=[self.get_type(t) for _, t in decl.arguments],
                     return_type=self.get_type(decl.return_type),
                 )
-        # Second pass to generate code
+
+    def compile_file(self, ast):
+        """Second pass: generate code for every function in a file."""
         for decl in ast.decls:
             if isinstance(decl, FunctionDecl):
                 self.compile_function(decl)
 
     def compile_function(self, decl):
+        self.add_block(decl, self.function_block(decl))
+
+    def stream_to(self, stream, exports):
+        """
+        Write blocks to stream as soon as they are generated instead of
+        keeping them for finish(). The exported names have to be given up
+        front since they come first in the output.
+        """
+        self.writer = s.ProgramWriter(stream, exports)
+
+    def add_block(self, decl, block):
         if decl.export:
             self.exports.append(decl.name)
+        if self.writer is None:
+            self.blocks.append(block)
+        else:
+            with phase("emit"):
+                self.writer.write_block(block)
 
-        # FIXME: Probably don't need to align all the variables to 8 no matter
-        # what.
-        stack_usage = 0
-        for stmt in decl.body:
-            if isinstance(stmt, VarDecl):
-                stack_usage += align(self.get_type(stmt.type).size(), 8)
-        for arg in decl.arguments:
-            stack_usage += align(self.get_type(arg.type).size(), 8)
-
-        # Prologue
-        instructions = [
-            s.Push(s.Register.rbp),
-            s.Mov(s.Register.rsp, s.Register.rbp),
-            s.Sub(s.Immediate(stack_usage), s.Register.rsp),
-        ]
-
-        registers = Registers()
-        stack_offset = 0
-        need_end_label = False
-        arg_reg = [
-            s.Register.rdi,
-            s.Register.rsi,
-            s.Register.rdx,
-            s.Register.rcx,
-            s.Register.r8,
-            s.Register.r9,
-        ]
-        locals_ = {}
-
-        # FIXME: Arguments are on the stack after the first 6
-        for i, (name, t) in enumerate(decl.arguments):
-            type_ = self.get_type(t)
-            stack_offset -= align(type_.size(), 8)
-            dest = s.Address(s.Register.rbp, stack_offset)
-            instructions.append(
-                s.Mov(arg_reg[i].with_size(s.Size.from_byte_size(type_.size())), dest),
-            )
-            locals_[name] = Binding(location=dest, type_=type_)
-
-        def end_label():
-            nonlocal need_end_label
-            need_end_label = True
-            return f"{decl.name}.end"
-
-        def compile_subexpr(expr):
-            if isinstance(expr, IntExpr):
-                return s.Immediate(expr.value), None
-            if isinstance(expr, IdentExpr):
-                loc = locals_[expr.name]
-                return loc.location, loc.type
-            if isinstance(expr, FieldAccessExpr):
-                target, target_type = compile_subexpr(expr.obj)
-                return (
-                    target.with_offset(target_type.field_offset(expr.field_name)),
-                    target_type.field_type(expr.field_name),
-                )
-            raise NotImplementedError(type(expr))
-
-        def compile_expr(expr, expected_type):
-            value, actual_type = compile_subexpr(expr)
-            if isinstance(expr, IntExpr):
-                if not isinstance(expected_type, Integer):
-                    raise TypeError(
-                        f"{expr.value} is not assignable to {expected_type}"
+    def function_types(self, decl):
+        """The types of a function's arguments, return value and locals."""
+        type_exprs = [t for _, t in decl.arguments]
+        type_exprs.append(decl.return_type)
+        type_exprs.extend(
+            stmt.type for stmt in statements(decl.body) if isinstance(stmt, VarDecl)
+        )
+        return [self.get_type(t) for t in type_exprs]
+
+    def function_block(self, decl):
+        """
+        The code for one function, from the block cache if there is one. This
+        only reads the types and signatures collected by declare_file, so it
+        is safe to run for different functions in separate processes.
+
+        Register allocations, inlining decisions and optimization counters
+        come from generating the code, so when any of them is asked for, the
+        function is always compiled and the cache is only written to.
+        """
+        if self.block_cache is None:
+            block = self.build_function(decl)
+        elif self.reports_codegen():
+            block = self.build_function(decl)
+            with phase("block cache"):
+                self.block_cache.store(self.block_key(decl), block)
+        else:
+            key = self.block_key(decl)
+            with phase("block cache"):
+                block = self.block_cache.load(key)
+            if block is None:
+                block = self.build_function(decl)
+                with phase("block cache"):
+                    self.block_cache.store(key, block)
+        count_function(
+            decl.name,
+            instructions=sum(not isinstance(i, s.Label) for i in block.instructions),
+            blocks=sum(isinstance(i, s.Label) for i in block.instructions) + 1,
+            stack_bytes=frame_size(block),
+        )
+        return block
+
+    def block_key(self, decl):
+        types = self.function_types(decl)
+        callees = self.callees(decl)
+        for callee in callees:
+            types.extend(self.function_types(callee))
+        return self.block_cache.key(
+            decl, types, options=self.options(), callees=callees
+        )
+
+    def reports_codegen(self):
+        """Whether anything is logged or counted while generating code."""
+        return (
+            self.regalloc_log is not None
+            or (self.inliner is not None and self.inliner.log is not None)
+            or self.report_opt_stats
+        )
+
+    def callees(self, decl):
+        """
+        What a function's code depends on of the functions it calls: their
+        signatures, or with inlining, the declarations of those and of
+        whatever they call in turn.
+        """
+        found = {}
+        pending = [decl]
+        while pending:
+            caller = pending.pop()
+            for name in calls(caller.body):
+                callee = self.function_decls.get(name)
+                if callee is None or name in found or callee is decl:
+                    continue
+                if self.inliner is None:
+                    callee = FunctionDecl(
+                        name, callee.arguments, callee.return_type, body=[]
                     )
-                return value
-            if expected_type != actual_type:
-                raise TypeError(f"{actual_type} is not assignable to {expected_type}")
-            return value
-
-        for i, stmt in enumerate(decl.body):
-            if isinstance(stmt, VarDecl):
-                type_ = self.get_type(stmt.type)
-                size = type_.size()
-                stack_offset -= align(size, 8)
-                loc = locals_[stmt.name] = Binding(
-                    s.Address(s.Register.rbp, stack_offset), type_
-                )
-                if stmt.init is not None:
-                    expr = compile_expr(stmt.init, type_)
-                    size = s.Size.from_byte_size(type_.size())
-                    if isinstance(expr, s.Address):
-                        with registers.reserve() as reg:
-                            reg = reg.with_size(size)
-                            instructions.append(s.Mov(expr, reg, size=size))
-                            expr = reg
-                    instructions.append(s.Mov(expr, loc.location, size=size,))
-            elif isinstance(stmt, AssignStmt):
-                if isinstance(stmt.target, IdentExpr):
-                    loc = locals_[stmt.target.name]
-                    dest = loc.location
-                    type_ = loc.type
-                elif isinstance(stmt.target, FieldAccessExpr):
-                    dest, type_ = compile_subexpr(stmt.target)
                 else:
-                    raise NotImplementedError()
-                size = s.Size.from_byte_size(type_.size())
-                src = compile_expr(stmt.value, expected_type=type_)
-                if isinstance(src, s.Address):
-                    with registers.reserve() as reg:
-                        reg = reg.with_size(size)
-                        instructions.append(s.Mov(src, reg, size=size))
-                        src = reg
-                instructions.append(s.Mov(src, dest, size=size))
-            elif isinstance(stmt, ReturnStmt):
-                if stmt.value:
-                    type_ = self.get_type(decl.return_type)
-                    src = compile_expr(stmt.value, expected_type=type_)
-                    instructions.append(
-                        s.Mov(
-                            src,
-                            s.Register.rax.with_size(
-                                s.Size.from_byte_size(min(type_.size(), 8))
-                            ),
-                        )
-                    )
-                    if type_.size() > 16:
-                        raise NotImplementedError("Really big return types")
-                    elif type_.size() > 8:
-                        instructions.append(
-                            s.Mov(
-                                src.with_offset(8),
-                                s.Register.rdx.with_size(
-                                    s.Size.from_byte_size(type_.size() - 8)
-                                ),
-                            )
-                        )
-                if i != len(decl.body) - 1:
-                    instructions.append(s.Jmp(end_label()))
-
-        # Epilogue
-        if need_end_label:
-            instructions.append(s.Label(end_label()))
-        instructions.extend([s.Leave(), s.Ret()])
-
-        self.blocks.append(s.Block(label=decl.name, instructions=instructions))
+                    pending.append(callee)
+                found[name] = callee
+        return list(found.values())
+
+    def options(self):
+        """Everything besides the AST and types that changes generated code."""
+        return (
+            ("opt_level", self.opt_level),
+            ("inline_threshold", self.inline_threshold),
+            ("unroll", self.unroll),
+            ("hoist_invariants", self.hoist_invariants),
+            ("omit_frame_pointer", self.omit_frame_pointer),
+            ("optimize_size", self.optimize_size),
+        )
+
+    def build_function(self, decl):
+        block = self.generate_function(decl)
+        if self.peephole is not None:
+            with phase("peephole"):
+                block = self.peephole.optimize(block)
+        return block
+
+    def opt_stats(self):
+        """How often each optimization fired, by pass."""
+        return {name: dict(counts) for name, counts in self.pass_stats.items()}
+
+    def merge_opt_stats(self, stats):
+        """Add counters collected by another instance, e.g. in a worker."""
+        for name, counts in stats.items():
+            self.pass_stats[name].update(counts)
+
+    def generate_function(self, decl):
+        with phase("irgen"):
+            function = build_ir(self, decl)
+        if self.opt_level >= 1:
+            with phase("mem2reg"):
+                self.pass_stats["mem2reg"]["promoted"] += mem2reg(function)
+            if self.inliner is not None:
+                with phase("inline"):
+                    self.inliner.run(function)
+            with phase("constprop"):
+                propagate_constants(function, self.pass_stats["constprop"])
+            with phase("dce"):
+                eliminate_dead_code(function, self.pass_stats["dce"])
+            with phase("loops"):
+                optimize_loops(
+                    function,
+                    self.pass_stats["loops"],
+                    hoist=self.hoist_invariants,
+                    unroll_factor=self.unroll,
+                    strength_reduction=self.opt_level >= 2,
+                )
+        with phase("lower"):
+            return lower(
+                function,
+                self.regalloc_log,
+                self.omit_frame_pointer,
+                tail_calls=self.opt_level >= 1,
+                selector=self.selector,
+            )
 
     def finish(self):
         return s.Program(self.exports, self.blocks)
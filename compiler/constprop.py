@@ -0,0 +1,241 @@
+"""
+Constant propagation and folding over `ir`.
+
+mem2reg already forwards constants stored to scalar locals. This pass finds
+the rest: loads from stack slots whose bytes were all set by constant stores
+earlier in the same block, and phis whose inputs are all the same constant.
+Arithmetic on constants is folded, and so is arithmetic that doesn't change
+its operand or always gives zero, like `x + 0` or `x * 0`. Branches on a
+constant become jumps, leaving the other target for dce.
+"""
+from .types_ import Integer
+from . import ir
+
+
+def to_bytes(value, size):
+    return (value & ((1 << (size * 8)) - 1)).to_bytes(size, "little")
+
+
+def forward_stores(block, replacements, entry):
+    """
+    Fold loads of known bytes in one block. Returns how many were folded.
+    In the entry block, bytes nothing was stored to yet (padding, for one)
+    are undefined and taken to be zero.
+    """
+
+    def resolve(value):
+        while value in replacements:
+            value = replacements[value]
+        return value
+
+    folded = 0
+    known = {}  # alloca -> {offset: byte or None if unknown}
+    default = 0 if entry else None
+    kept = []
+    for inst in block.instructions:
+        if isinstance(inst, ir.Store):
+            slot = known.setdefault(inst.address, {})
+            size = inst.type.size()
+            value = resolve(inst.value)
+            if isinstance(value, ir.Const) and size <= 8:
+                for i, byte in enumerate(to_bytes(value.value, size)):
+                    slot[inst.offset + i] = byte
+            else:
+                for i in range(size):
+                    slot[inst.offset + i] = None
+        elif (
+            isinstance(inst, ir.Copy)
+            and isinstance(inst.dest, ir.Alloca)
+            and isinstance(inst.src, ir.Alloca)
+        ):
+            src = known.get(inst.src, {})
+            size = inst.type.size()
+            data = [src.get(inst.src_offset + i, default) for i in range(size)]
+            slot = known.setdefault(inst.dest, {})
+            for i, byte in enumerate(data):
+                slot[inst.dest_offset + i] = byte
+        elif isinstance(inst, ir.Load) and inst.type.size() <= 8:
+            slot = known.get(inst.address, {})
+            size = inst.type.size()
+            data = [slot.get(inst.offset + i, default) for i in range(size)]
+            if None not in data:
+                value = int.from_bytes(bytes(data), "little")
+                value = Integer(size * 8).wrap(value)
+                replacements[inst] = ir.Const(value, inst.type)
+                folded += 1
+                continue
+        elif isinstance(inst, ir.Call):
+            # Only the slot it returns a struct to, if any, changes
+            if isinstance(inst.dest, ir.Alloca):
+                slot = known.setdefault(inst.dest, {})
+                for i in range(inst.type.size()):
+                    slot[inst.dest_offset + i] = None
+        elif inst.writes_memory:
+            known.clear()
+            default = None
+        kept.append(inst)
+    block.instructions = kept
+    return folded
+
+
+def fold_phi(phi, replacements):
+    """The constant a phi always has, or None."""
+    values = set()
+    for value in phi.operands():
+        while value in replacements:
+            value = replacements[value]
+        if isinstance(value, ir.Undef) or value is phi:
+            continue
+        if not isinstance(value, ir.Const):
+            return None
+        values.add(value.value)
+    if len(values) != 1:
+        return None
+    return ir.Const(values.pop(), phi.type)
+
+
+def evaluate(operator, a, b, type_):
+    """
+    The result of a BinOp on two constants, as `ir.BinOp` defines it, or None
+    for a division by zero or of the smallest value by -1, which are left to
+    do whatever they do when they run.
+    """
+    a, b = type_.wrap(a), type_.wrap(b)
+    if operator in ("<<", ">>"):
+        b &= 63 if type_.size() == 8 else 31
+    if operator in ("/", "%"):
+        if b == 0 or b == -1 and a == type_.wrap(1 << (8 * type_.size() - 1)):
+            return None
+        quotient = abs(a) // abs(b)
+        if (a < 0) != (b < 0):
+            quotient = -quotient
+        result = quotient if operator == "/" else a - quotient * b
+    elif operator == "+":
+        result = a + b
+    elif operator == "-":
+        result = a - b
+    elif operator == "*":
+        result = a * b
+    elif operator == "<<":
+        result = a << b
+    elif operator == ">>":
+        result = a >> b
+    elif operator == "&":
+        result = a & b
+    elif operator == "|":
+        result = a | b
+    else:
+        result = a ^ b
+    return type_.wrap(result)
+
+
+def fold_binop(inst, resolve):
+    """The constant or operand a BinOp always equals, or None."""
+    left, right = resolve(inst.left), resolve(inst.right)
+    type_ = inst.type
+    operator = inst.operator
+    if isinstance(left, ir.Const) and isinstance(right, ir.Const):
+        value = evaluate(operator, left.value, right.value, type_)
+        return None if value is None else ir.Const(value, type_)
+    if isinstance(left, ir.Const) and operator in ir.BinOp.commutative:
+        left, right = right, left
+    if not isinstance(right, ir.Const):
+        return None
+    value = type_.wrap(right.value)
+    if operator in ("<<", ">>"):
+        value &= 63 if type_.size() == 8 else 31
+    if value == 0 and operator in ("+", "-", "|", "^", "<<", ">>"):
+        return left
+    if value == 0 and operator in ("*", "&"):
+        return ir.Const(0, type_)
+    if value == 1 and operator in ("*", "/") or value == -1 and operator == "&":
+        return left
+    if value in (1, -1) and operator == "%":
+        return ir.Const(0, type_)
+    return None
+
+
+def fold_binops(block, replacements):
+    """Fold the arithmetic in a block. Returns how much was folded."""
+
+    def resolve(value):
+        while value in replacements:
+            value = replacements[value]
+        return value
+
+    kept = []
+    for inst in block.instructions:
+        if isinstance(inst, ir.BinOp):
+            value = fold_binop(inst, resolve)
+            if value is not None:
+                replacements[inst] = value
+                continue
+        kept.append(inst)
+    folded = len(block.instructions) - len(kept)
+    block.instructions = kept
+    return folded
+
+
+def fold_branches(function):
+    """Turn branches on constants into jumps. Returns how many there were."""
+    folded = 0
+    for block in function.blocks:
+        branch = block.terminator
+        if not (isinstance(branch, ir.Branch) and isinstance(branch.cond, ir.Const)):
+            continue
+        if branch.cond.value:
+            taken, dropped = branch.if_true, branch.if_false
+        else:
+            taken, dropped = branch.if_false, branch.if_true
+        block.instructions[-1] = ir.Jump(taken)
+        block.instructions[-1].block = block
+        if dropped is not taken:
+            for phi in dropped.phis():
+                phi.incoming = [pair for pair in phi.incoming if pair[0] is not block]
+        folded += 1
+    return folded
+
+
+def check_widths(function):
+    """Every constant stored or returned has to fit where it goes."""
+    for inst in function.instructions():
+        if isinstance(inst, ir.Store):
+            pairs = [(inst.value, inst.type)]
+        elif isinstance(inst, ir.Return):
+            pairs = [(value, value.type) for value in inst.values]
+        else:
+            continue
+        for value, type_ in pairs:
+            if (
+                isinstance(value, ir.Const)
+                and isinstance(type_, Integer)
+                and not type_.fits(value.value)
+            ):
+                raise TypeError(f"{value.value} does not fit in {type_}")
+
+
+def propagate_constants(function, stats):
+    """
+    Fold what can be folded, counting loads, phis and arithmetic removed in
+    stats.
+    """
+    changed = True
+    while changed:
+        changed = False
+        replacements = {}
+        for block in function.blocks:
+            entry = block is function.entry
+            loads = forward_stores(block, replacements, entry)
+            stats["loads"] += loads
+            stats["binops"] += fold_binops(block, replacements)
+            for phi in list(block.phis()):
+                const = fold_phi(phi, replacements)
+                if const is not None:
+                    replacements[phi] = const
+                    block.instructions.remove(phi)
+                    stats["phis"] += 1
+        if replacements:
+            function.replace_uses(replacements)
+            changed = True
+    stats["branches"] += fold_branches(function)
+    check_widths(function)
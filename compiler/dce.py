@@ -0,0 +1,174 @@
+"""
+Dead code and dead store elimination over `ir`.
+
+Blocks that can't be reached from the entry are dropped and straight-line
+chains of blocks merged. Then stores and copies to stack slots are removed
+if no load can see the bytes they write before they are overwritten or the function
+returns, and finally values and Allocas nothing uses anymore. Liveness of
+stack memory is tracked per byte.
+"""
+from . import ir
+
+
+def remove_unreachable(function):
+    """Returns the number of blocks removed."""
+    reachable = set(function.reachable())
+    dead = [block for block in function.blocks if block not in reachable]
+    if not dead:
+        return 0
+    function.blocks = [block for block in function.blocks if block in reachable]
+    for block in function.blocks:
+        for phi in block.phis():
+            phi.incoming = [pair for pair in phi.incoming if pair[0] in reachable]
+    return len(dead)
+
+
+def merge_blocks(function):
+    """
+    Append blocks to their only predecessor when it jumps nowhere else.
+    Returns the number of blocks merged away.
+    """
+    merged = 0
+    changed = True
+    while changed:
+        changed = False
+        preds = function.predecessors()
+        for block in function.blocks[1:]:
+            if len(preds[block]) != 1:
+                continue
+            pred = preds[block][0]
+            if pred is block or not isinstance(pred.terminator, ir.Jump):
+                continue
+            replacements = {}
+            for phi in list(block.phis()):
+                replacements[phi] = phi.incoming[0][1]
+                block.instructions.remove(phi)
+            pred.instructions.pop()
+            for inst in block.instructions:
+                pred.append(inst)
+            for succ in block.successors():
+                for phi in succ.phis():
+                    for pair in phi.incoming:
+                        if pair[0] is block:
+                            pair[0] = pred
+            function.blocks.remove(block)
+            function.replace_uses(replacements)
+            merged += 1
+            changed = True
+            break
+    return merged
+
+
+def bytes_at(address, offset, size):
+    return {(address, offset + i) for i in range(size)}
+
+
+def bytes_of(inst):
+    return bytes_at(inst.address, inst.offset, inst.type.size())
+
+
+def all_bytes(function):
+    return {
+        (inst, i)
+        for inst in function.instructions()
+        if isinstance(inst, ir.Alloca)
+        for i in range(inst.allocated_type.size())
+    }
+
+
+def transfer(block, live, everything, remove=None):
+    """
+    Walk a block backwards from the bytes live at its end. Returns the bytes
+    live at its start; dead stores are added to remove if it's given.
+    """
+    live = set(live)
+    for inst in reversed(block.instructions):
+        if isinstance(inst, ir.Store) and isinstance(inst.address, ir.Alloca):
+            written = bytes_of(inst)
+            if remove is not None and not written & live:
+                remove.add(inst)
+            live -= written
+        elif isinstance(inst, ir.Load) and isinstance(inst.address, ir.Alloca):
+            live |= bytes_of(inst)
+        elif isinstance(inst, ir.Copy) and isinstance(inst.src, ir.Alloca):
+            size = inst.type.size()
+            if isinstance(inst.dest, ir.Alloca):
+                written = bytes_at(inst.dest, inst.dest_offset, size)
+                if not written & live:
+                    # Dead, so it doesn't read anything either
+                    if remove is not None:
+                        remove.add(inst)
+                    continue
+                live -= written
+            live |= bytes_at(inst.src, inst.src_offset, size)
+        elif isinstance(inst, ir.Call):
+            # The callee can't see our slots, only write its result to one
+            if isinstance(inst.dest, ir.Alloca):
+                live -= bytes_at(inst.dest, inst.dest_offset, inst.type.size())
+        elif inst.writes_memory:
+            # Something that could read any of them afterwards
+            live |= everything
+    return live
+
+
+def remove_dead_stores(function):
+    """Returns the number of stores removed."""
+    everything = all_bytes(function)
+    live_in = {block: set() for block in function.blocks}
+    changed = True
+    while changed:
+        changed = False
+        for block in reversed(function.blocks):
+            live_out = set()
+            for succ in block.successors():
+                live_out |= live_in[succ]
+            new = transfer(block, live_out, everything)
+            if new != live_in[block]:
+                live_in[block] = new
+                changed = True
+
+    dead = set()
+    for block in function.blocks:
+        live_out = set()
+        for succ in block.successors():
+            live_out |= live_in[succ]
+        transfer(block, live_out, everything, dead)
+    for block in function.blocks:
+        block.instructions = [inst for inst in block.instructions if inst not in dead]
+    return len(dead)
+
+
+def remove_unused_values(function):
+    """
+    Remove instructions that only produce a value, once nothing uses it.
+    Returns the Allocas removed.
+    """
+    removed_allocas = []
+    changed = True
+    while changed:
+        changed = False
+        used = set()
+        for inst in function.instructions():
+            for operand in inst.operands():
+                if operand is not inst:
+                    used.add(operand)
+        for block in function.blocks:
+            kept = []
+            for inst in block.instructions:
+                if inst.has_value and inst not in used and not inst.writes_memory:
+                    if isinstance(inst, ir.Alloca):
+                        removed_allocas.append(inst)
+                    changed = True
+                    continue
+                kept.append(inst)
+            block.instructions = kept
+    return removed_allocas
+
+
+def eliminate_dead_code(function, stats):
+    """Run all of the above, counting what was removed in stats."""
+    stats["blocks"] += remove_unreachable(function)
+    stats["merged_blocks"] += merge_blocks(function)
+    stats["stores"] += remove_dead_stores(function)
+    allocas = remove_unused_values(function)
+    stats["stack_bytes"] += sum(a.allocated_type.size() for a in allocas)
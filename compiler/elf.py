@@ -0,0 +1,196 @@
+"""
+Relocatable ELF64 object files for x86-64, written from an `encode.Assembly`.
+
+The layout is the one GNU as produces for our programs: a .text section, its
+relocations if there are any, a symbol table with every label (the exported
+ones global, and anything jumped to but not defined as undefined globals),
+and the string tables. An empty .note.GNU-stack marks the stack as not
+executable.
+"""
+import struct
+
+from .encode import assemble
+from .instrument import phase
+
+EM_X86_64 = 62
+ET_REL = 1
+
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+SHT_RELA = 4
+
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+SHF_INFO_LINK = 0x40
+
+STB_LOCAL = 0
+STB_GLOBAL = 1
+STT_NOTYPE = 0
+SHN_UNDEF = 0
+
+HEADER_SIZE = 64
+SECTION_HEADER_SIZE = 64
+SYMBOL_SIZE = 24
+RELA_SIZE = 24
+
+
+class StringTable:
+    def __init__(self):
+        self.data = bytearray(b"\0")
+        self.offsets = {"": 0}
+
+    def add(self, name):
+        offset = self.offsets.get(name)
+        if offset is None:
+            offset = self.offsets[name] = len(self.data)
+            self.data += name.encode("utf-8") + b"\0"
+        return offset
+
+
+class Section:
+    def __init__(
+        self, name, type_, data, flags=0, link=0, info=0, align=1, entsize=0
+    ):
+        self.name = name
+        self.type = type_
+        self.data = data
+        self.flags = flags
+        self.link = link
+        self.info = info
+        self.align = align
+        self.entsize = entsize
+
+
+def symbol_table(assembly, exports, strings, text_index=1):
+    """The .symtab contents, its first global's index and every symbol's index."""
+    locals_ = [name for name in assembly.labels if name not in exports]
+    globals_ = [name for name in assembly.labels if name in exports]
+    undefined = []
+    for name in list(exports) + [r[1] for r in assembly.relocations]:
+        if name not in assembly.labels and name not in undefined:
+            undefined.append(name)
+
+    data = bytearray(SYMBOL_SIZE)
+    indices = {}
+    for names, bind in [
+        (locals_, STB_LOCAL),
+        (globals_, STB_GLOBAL),
+        (undefined, STB_GLOBAL),
+    ]:
+        for name in names:
+            indices[name] = len(data) // SYMBOL_SIZE
+            defined = name in assembly.labels
+            data += struct.pack(
+                "<IBBHQQ",
+                strings.add(name),
+                bind << 4 | STT_NOTYPE,
+                0,
+                text_index if defined else SHN_UNDEF,
+                assembly.labels[name] if defined else 0,
+                0,
+            )
+    return data, len(locals_) + 1, indices
+
+
+def object_file(program):
+    """The bytes of a relocatable object file for an `asm.Program`."""
+    with phase("encode"):
+        assembly = assemble(program)
+    exports = set(program.exports)
+    strings = StringTable()
+    symbols, first_global, indices = symbol_table(assembly, exports, strings)
+
+    # Section indices, counting the null section at 0
+    text_index = 1
+    symtab_index = 4 if assembly.relocations else 3
+
+    sections = [
+        Section(".text", SHT_PROGBITS, assembly.code, SHF_ALLOC | SHF_EXECINSTR)
+    ]
+    if assembly.relocations:
+        relocations = b"".join(
+            struct.pack("<QQq", offset, indices[symbol] << 32 | type_, addend)
+            for offset, symbol, type_, addend in assembly.relocations
+        )
+        sections.append(
+            Section(
+                ".rela.text",
+                SHT_RELA,
+                relocations,
+                SHF_INFO_LINK,
+                link=symtab_index,
+                info=text_index,
+                align=8,
+                entsize=RELA_SIZE,
+            )
+        )
+    sections.append(Section(".note.GNU-stack", SHT_PROGBITS, b""))
+    sections.append(
+        Section(
+            ".symtab",
+            SHT_SYMTAB,
+            symbols,
+            link=symtab_index + 1,
+            info=first_global,
+            align=8,
+            entsize=SYMBOL_SIZE,
+        )
+    )
+    sections.append(Section(".strtab", SHT_STRTAB, bytes(strings.data)))
+    section_names = StringTable()
+    shstrtab = Section(".shstrtab", SHT_STRTAB, b"")
+    sections.append(shstrtab)
+    name_offsets = [section_names.add(section.name) for section in sections]
+    shstrtab.data = bytes(section_names.data)
+
+    body = bytearray()
+    offsets = []
+    for section in sections:
+        position = HEADER_SIZE + len(body)
+        padding = -position % section.align
+        body += bytes(padding)
+        offsets.append(position + padding)
+        body += section.data
+    body += bytes(-(HEADER_SIZE + len(body)) % 8)
+    section_header_offset = HEADER_SIZE + len(body)
+
+    header = struct.pack(
+        "<4sBBBBB7sHHIQQQIHHHHHH",
+        b"\x7fELF",
+        2,  # 64-bit
+        1,  # little endian
+        1,  # ELF version
+        0,  # System V ABI
+        0,
+        bytes(7),
+        ET_REL,
+        EM_X86_64,
+        1,
+        0,
+        0,
+        section_header_offset,
+        0,
+        HEADER_SIZE,
+        0,
+        0,
+        SECTION_HEADER_SIZE,
+        len(sections) + 1,
+        len(sections),  # .shstrtab is last
+    )
+    headers = bytearray(SECTION_HEADER_SIZE)
+    for section, name, offset in zip(sections, name_offsets, offsets):
+        headers += struct.pack(
+            "<IIQQQQIIQQ",
+            name,
+            section.type,
+            section.flags,
+            0,
+            offset,
+            len(section.data),
+            section.link,
+            section.info,
+            section.align,
+            section.entsize,
+        )
+    return header + bytes(body) + bytes(headers)
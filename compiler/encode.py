@@ -0,0 +1,538 @@
+"""
+x86-64 machine code for the instructions in `asm`.
+
+Encodings are the ones GNU as picks for the same AT&T text, so that an object
+file written from them disassembles the same as one assembled from `str()` of
+the program. Jumps start out in their two byte form and are widened to rel32
+until every displacement fits (jump relaxation). Jumps to symbols that aren't
+defined in the program always use rel32 and a relocation for the linker, as
+do calls to exported functions.
+"""
+from .asm import (
+    Add,
+    Address,
+    And,
+    Call,
+    Cltd,
+    Cmp,
+    Cqto,
+    Idiv,
+    Immediate,
+    Imul,
+    Jcc,
+    Jmp,
+    Label,
+    Lea,
+    Leave,
+    Mov,
+    Movdqa,
+    Movdqu,
+    Movsx,
+    Neg,
+    Or,
+    Pop,
+    Push,
+    Register,
+    RepMovsq,
+    Ret,
+    Sar,
+    Shl,
+    Shr,
+    Size,
+    Sub,
+    Test,
+    Xor,
+    fits_imm32,
+    register_families,
+    xmm_registers,
+)
+
+# Register numbers in the order of the quad word members of register_families
+_family_numbers = [0, 3, 1, 2, 6, 7, 4, 5, 8, 9, 10, 11, 12, 13, 14, 15]
+numbers = {}
+for _family, _number in zip(register_families, _family_numbers):
+    for _reg in _family.sizes.values():
+        numbers[_reg] = _number
+for _reg, _number in [
+    (Register.ah, 4),
+    (Register.ch, 5),
+    (Register.dh, 6),
+    (Register.bh, 7),
+]:
+    numbers[_reg] = _number
+for _number, _reg in enumerate(xmm_registers):
+    numbers[_reg] = _number
+# Byte registers that only exist with a REX prefix, and ones that can't have one
+rex_only = {Register.spl, Register.bpl, Register.sil, Register.dil}
+no_rex = {Register.ah, Register.ch, Register.dh, Register.bh}
+
+R_X86_64_PLT32 = 4
+
+# The two bits of a SIB byte that stand for each scale
+scale_bits = {1: 0, 2: 1, 4: 2, 8: 3}
+
+# The low nibble of the opcodes of conditional jumps
+condition_codes = {
+    "o": 0x0,
+    "no": 0x1,
+    "b": 0x2,
+    "ae": 0x3,
+    "e": 0x4,
+    "ne": 0x5,
+    "be": 0x6,
+    "a": 0x7,
+    "s": 0x8,
+    "ns": 0x9,
+    "p": 0xA,
+    "np": 0xB,
+    "l": 0xC,
+    "ge": 0xD,
+    "le": 0xE,
+    "g": 0xF,
+}
+
+
+class EncodingError(Exception):
+    pass
+
+
+def fits_imm8(value):
+    return -128 <= value < 128
+
+
+def immediate(value, size):
+    bits = size.byte_size() * 8
+    if not -(2 ** (bits - 1)) <= value < 2 ** bits:
+        raise EncodingError(f"${value} does not fit in {bits} bits")
+    return (value & (2 ** bits - 1)).to_bytes(size.byte_size(), "little")
+
+
+def signed(value, size):
+    """An immediate as the signed number it stands for in an operand of size."""
+    immediate(value, size)  # Raises if it doesn't fit at all
+    bits = size.byte_size() * 8
+    if value >= 2 ** (bits - 1):
+        return value - 2 ** bits
+    return value
+
+
+def modrm(reg, rm):
+    """
+    The ModRM byte (with SIB and displacement) for a reg field and an r/m
+    operand, and the REX.R/REX.B bits they need.
+    """
+    rex = (reg >> 3) << 2
+    reg &= 7
+    if isinstance(rm, Register):
+        number = numbers[rm]
+        return rex | number >> 3, bytes([0xC0 | reg << 3 | number & 7])
+    if not isinstance(rm, Address) or not isinstance(rm.register, Register):
+        raise EncodingError(f"Unsupported operand {rm}")
+    if rm.register.size() is not Size.quad_word:
+        raise EncodingError(f"Unsupported address register in {rm}")
+    base = numbers[rm.register]
+    rex |= base >> 3
+    # rbp and r13 as a base always take a displacement
+    if rm.offset == 0 and base & 7 != 5:
+        mod, displacement = 0, b""
+    elif fits_imm8(rm.offset):
+        mod, displacement = 1, rm.offset.to_bytes(1, "little", signed=True)
+    else:
+        mod, displacement = 2, rm.offset.to_bytes(4, "little", signed=True)
+    if rm.index is not None:
+        index = numbers[rm.index]
+        if index == 4 or rm.index.size() is not Size.quad_word:
+            raise EncodingError(f"Unsupported index register in {rm}")
+        rex |= (index >> 3) << 1
+        sib = bytes([scale_bits[rm.scale] << 6 | (index & 7) << 3 | base & 7])
+        return rex, bytes([mod << 6 | reg << 3 | 4]) + sib + displacement
+    # rsp and r12 as a base need a SIB byte
+    sib = b"\x24" if base & 7 == 4 else b""
+    return rex, bytes([mod << 6 | reg << 3 | base & 7]) + sib + displacement
+
+
+def prefixes(size, rex, *operands):
+    """Operand size prefix and REX prefix for an instruction."""
+    registers = [op for op in operands if isinstance(op, Register)]
+    if size is Size.quad_word:
+        rex |= 8
+    force = any(reg in rex_only for reg in registers)
+    if (rex or force) and any(reg in no_rex for reg in registers):
+        raise EncodingError(f"Can't use {registers} in one instruction")
+    out = b"\x66" if size is Size.word else b""
+    if rex or force:
+        out += bytes([0x40 | rex])
+    return out
+
+
+def opcode(byte_form, size):
+    """Opcodes come in pairs, the second for sizes larger than a byte."""
+    return byte_form if size is Size.byte else byte_form + 1
+
+
+def with_modrm(op, reg, rm, size, other=None):
+    """An instruction with a ModRM byte, op being one opcode byte or several."""
+    rex, tail = modrm(reg, rm)
+    if isinstance(op, int):
+        op = bytes([op])
+    return prefixes(size, rex, rm, other) + op + tail
+
+
+def encode_mov(inst):
+    src, dest, size = inst.src, inst.dest, inst.size
+    if isinstance(src, Register):
+        return with_modrm(opcode(0x88, size), numbers[src], dest, size, src)
+    if isinstance(dest, Register) and isinstance(src, Address):
+        return with_modrm(opcode(0x8A, size), numbers[dest], src, size, dest)
+    if not isinstance(src, Immediate):
+        raise EncodingError(f"Unsupported instruction {inst}")
+    value = src.value
+    if isinstance(dest, Register) and (
+        size is not Size.quad_word or not fits_imm32(value)
+    ):
+        number = numbers[dest]
+        op = (0xB0 if size is Size.byte else 0xB8) + (number & 7)
+        prefix = prefixes(size, number >> 3, dest)
+        return prefix + bytes([op]) + immediate(value, size)
+    if size is Size.quad_word:
+        if not fits_imm32(value):
+            raise EncodingError(f"{src} does not fit in a sign extended imm32")
+        imm = immediate(value, Size.double_word)
+    else:
+        imm = immediate(value, size)
+    return with_modrm(opcode(0xC6, size), 0, dest, size) + imm
+
+
+def arithmetic_encoder(digit):
+    """
+    The encoder of one of the eight classic ALU instructions (`add`, `or`,
+    `adc`, `sbb`, `and`, `sub`, `xor`, `cmp`), which only differ in the
+    digit that picks them.
+    """
+    base = digit << 3
+
+    def encode_arithmetic(inst):
+        src, dest, size = inst.src, inst.dest, inst.size
+        if isinstance(src, Register):
+            return with_modrm(opcode(base, size), numbers[src], dest, size, src)
+        if isinstance(dest, Register) and isinstance(src, Address):
+            return with_modrm(opcode(base + 2, size), numbers[dest], src, size, dest)
+        if not isinstance(src, Immediate):
+            raise EncodingError(f"Unsupported instruction {inst}")
+        value = signed(src.value, size)
+        # The accumulator has a short form without a ModRM byte
+        accumulator = dest in (Register.al, Register.ax, Register.eax, Register.rax)
+        if size is Size.byte:
+            if accumulator:
+                return bytes([base + 4]) + immediate(value, size)
+            return with_modrm(0x80, digit, dest, size) + immediate(value, size)
+        if fits_imm8(value):
+            return with_modrm(0x83, digit, dest, size) + immediate(value, Size.byte)
+        imm_size = Size.word if size is Size.word else Size.double_word
+        if size is Size.quad_word and not fits_imm32(value):
+            raise EncodingError(f"{src} does not fit in a sign extended imm32")
+        if accumulator:
+            return prefixes(size, 0) + bytes([base + 5]) + immediate(value, imm_size)
+        return with_modrm(0x81, digit, dest, size) + immediate(value, imm_size)
+
+    return encode_arithmetic
+
+
+def encode_test(inst):
+    src, dest, size = inst.src, inst.dest, inst.size
+    if isinstance(src, Register):
+        return with_modrm(opcode(0x84, size), numbers[src], dest, size, src)
+    if isinstance(dest, Register) and isinstance(src, Address):
+        return with_modrm(opcode(0x84, size), numbers[dest], src, size, dest)
+    if not isinstance(src, Immediate):
+        raise EncodingError(f"Unsupported instruction {inst}")
+    imm_size = Size.double_word if size is Size.quad_word else size
+    if size is Size.quad_word and not fits_imm32(src.value):
+        raise EncodingError(f"{src} does not fit in a sign extended imm32")
+    imm = immediate(signed(src.value, size), imm_size)
+    if dest in (Register.al, Register.ax, Register.eax, Register.rax):
+        return prefixes(size, 0) + bytes([opcode(0xA8, size)]) + imm
+    return with_modrm(opcode(0xF6, size), 0, dest, size) + imm
+
+
+def encode_push_pop(inst, register_op, memory_digit, memory_op):
+    operand, size = inst.operand, inst.size
+    if size not in (Size.word, Size.quad_word):
+        raise EncodingError(f"Unsupported instruction {inst}")
+    # Pushes and pops default to 64 bits, so they never need REX.W
+    if size is Size.quad_word:
+        size = None
+    if isinstance(operand, Register):
+        number = numbers[operand]
+        return prefixes(size, number >> 3) + bytes([register_op + (number & 7)])
+    rex, tail = modrm(memory_digit, operand)
+    return prefixes(size, rex) + bytes([memory_op]) + tail
+
+
+def encode_push(inst):
+    if isinstance(inst.operand, Immediate):
+        if inst.size is not Size.quad_word:
+            raise EncodingError(f"Unsupported instruction {inst}")
+        value = inst.operand.value
+        if fits_imm8(value):
+            return b"\x6a" + immediate(value, Size.byte)
+        return b"\x68" + immediate(value, Size.double_word)
+    return encode_push_pop(inst, 0x50, 6, 0xFF)
+
+
+def encode_pop(inst):
+    return encode_push_pop(inst, 0x58, 0, 0x8F)
+
+
+def encode_lea(inst):
+    if not isinstance(inst.src, Address) or not isinstance(inst.dest, Register):
+        raise EncodingError(f"Unsupported instruction {inst}")
+    return with_modrm(0x8D, numbers[inst.dest], inst.src, inst.size, inst.dest)
+
+
+def shift_encoder(digit):
+    """The encoder of `shl` (4), `shr` (5) or `sar` (7)."""
+
+    def encode_shift(inst):
+        dest, size = inst.dest, inst.size
+        if inst.src is Register.cl:
+            return with_modrm(opcode(0xD2, size), digit, dest, size)
+        if not isinstance(inst.src, Immediate):
+            raise EncodingError(f"Unsupported instruction {inst}")
+        count = inst.src.value
+        if count == 1:
+            return with_modrm(opcode(0xD0, size), digit, dest, size)
+        return with_modrm(opcode(0xC0, size), digit, dest, size) + immediate(
+            count, Size.byte
+        )
+
+    return encode_shift
+
+
+def unary_encoder(digit):
+    """The encoder of `neg` (3) or `idiv` (7), which share their opcodes."""
+
+    def encode_unary(inst):
+        return with_modrm(opcode(0xF6, inst.size), digit, inst.operand, inst.size)
+
+    return encode_unary
+
+
+def encode_imul(inst):
+    src, dest, size = inst.src, inst.dest, inst.size
+    if not isinstance(dest, Register) or size is Size.byte:
+        raise EncodingError(f"Unsupported instruction {inst}")
+    if inst.factor is None:
+        return with_modrm(b"\x0f\xaf", numbers[dest], src, size, dest)
+    value = signed(inst.factor.value, size)
+    if fits_imm8(value):
+        code = with_modrm(0x6B, numbers[dest], src, size, dest)
+        return code + immediate(value, Size.byte)
+    imm_size = Size.word if size is Size.word else Size.double_word
+    if size is Size.quad_word and not fits_imm32(value):
+        raise EncodingError(f"{inst.factor} does not fit in a sign extended imm32")
+    code = with_modrm(0x69, numbers[dest], src, size, dest)
+    return code + immediate(value, imm_size)
+
+
+def encode_movsx(inst):
+    src, dest = inst.src, inst.dest
+    if not isinstance(dest, Register):
+        raise EncodingError(f"Unsupported instruction {inst}")
+    if inst.src_size is Size.double_word:
+        op = b"\x63"
+    else:
+        op = b"\x0f\xbe" if inst.src_size is Size.byte else b"\x0f\xbf"
+    return with_modrm(op, numbers[dest], src, inst.size, dest)
+
+
+def encode_movdq(inst):
+    # Movdqa is Movdqu with another prefix; loads and register moves put
+    # the destination in the reg field, stores the source
+    prefix = b"\x66" if isinstance(inst, Movdqa) else b"\xf3"
+    if inst.dest in xmm_registers:
+        op, reg, rm = 0x6F, inst.dest, inst.src
+    elif inst.src in xmm_registers:
+        op, reg, rm = 0x7F, inst.src, inst.dest
+    else:
+        raise EncodingError(f"Unsupported instruction {inst}")
+    rex, tail = modrm(numbers[reg], rm)
+    rex_prefix = bytes([0x40 | rex]) if rex else b""
+    return prefix + rex_prefix + bytes([0x0F, op]) + tail
+
+
+encoders = {
+    Mov: encode_mov,
+    Add: arithmetic_encoder(0),
+    Sub: arithmetic_encoder(5),
+    Cmp: arithmetic_encoder(7),
+    Test: encode_test,
+    Push: encode_push,
+    Pop: encode_pop,
+    Lea: encode_lea,
+    And: arithmetic_encoder(4),
+    Or: arithmetic_encoder(1),
+    Xor: arithmetic_encoder(6),
+    Imul: encode_imul,
+    Shl: shift_encoder(4),
+    Shr: shift_encoder(5),
+    Sar: shift_encoder(7),
+    Neg: unary_encoder(3),
+    Idiv: unary_encoder(7),
+    Movsx: encode_movsx,
+    Cltd: lambda inst: b"\x99",
+    Cqto: lambda inst: b"\x48\x99",
+    Movdqu: encode_movdq,
+    Movdqa: encode_movdq,
+    RepMovsq: lambda inst: b"\xf3\x48\xa5",
+    Leave: lambda inst: b"\xc9",
+    Ret: lambda inst: b"\xc3",
+}
+
+
+def encode(inst):
+    """Machine code for any instruction besides labels and jumps."""
+    try:
+        encoder = encoders[type(inst)]
+    except KeyError:
+        raise EncodingError(f"Can't encode {inst}") from None
+    return encoder(inst)
+
+
+class Jump:
+    """
+    A jump in the instruction stream whose size isn't settled yet. `code` is
+    the condition code of a conditional jump, None for `jmp`.
+    """
+
+    __slots__ = ("target", "short", "code")
+
+    def __init__(self, target, short, code=None):
+        self.target = target
+        self.short = short
+        self.code = code
+
+    def size(self):
+        if self.short:
+            return 2
+        return 5 if self.code is None else 6
+
+    def opcode(self):
+        if self.short:
+            return b"\xeb" if self.code is None else bytes([0x70 | self.code])
+        return b"\xe9" if self.code is None else bytes([0x0F, 0x80 | self.code])
+
+
+class CallSite:
+    """
+    A call. GNU as leaves calls to global symbols to the linker, through the
+    PLT, even when they are defined in the same file.
+    """
+
+    __slots__ = ("target",)
+
+    def __init__(self, target):
+        self.target = target
+
+    def size(self):
+        return 5
+
+
+class Assembly:
+    """
+    The contents of a text section: code, where each label ended up, and
+    relocations as (offset, symbol, type, addend).
+    """
+
+    def __init__(self, code, labels, relocations):
+        self.code = code
+        self.labels = labels
+        self.relocations = relocations
+
+
+def assemble(program):
+    """Encode an `asm.Program` into an Assembly."""
+    pieces = []
+    label_names = set()
+    for block in program.blocks:
+        pieces.append(Label(block.label))
+        label_names.add(block.label)
+        for inst in block.instructions:
+            if isinstance(inst, Label):
+                pieces.append(inst)
+                label_names.add(inst.name)
+            elif isinstance(inst, Jcc):
+                code = condition_codes[inst.condition]
+                pieces.append(Jump(inst.to, short=True, code=code))
+            elif isinstance(inst, Jmp):
+                pieces.append(Jump(inst.to, short=True))
+            elif isinstance(inst, Call):
+                pieces.append(CallSite(inst.to))
+            else:
+                pieces.append(encode(inst))
+    # Labels can be jumped to before they're defined
+    for piece in pieces:
+        if isinstance(piece, Jump) and piece.target not in label_names:
+            piece.short = False
+
+    labels = relax(pieces)
+    code = bytearray()
+    relocations = []
+    for piece in pieces:
+        if isinstance(piece, Label):
+            continue
+        if isinstance(piece, CallSite):
+            end = len(code) + piece.size()
+            if piece.target in labels and piece.target not in program.exports:
+                code += b"\xe8" + (labels[piece.target] - end).to_bytes(
+                    4, "little", signed=True
+                )
+            else:
+                code += b"\xe8" + bytes(4)
+                relocations.append((end - 4, piece.target, R_X86_64_PLT32, -4))
+            continue
+        if not isinstance(piece, Jump):
+            code += piece
+            continue
+        end = len(code) + piece.size()
+        code += piece.opcode()
+        if piece.target not in labels:
+            code += bytes(4)
+            relocations.append((end - 4, piece.target, R_X86_64_PLT32, -4))
+        else:
+            width = 1 if piece.short else 4
+            code += (labels[piece.target] - end).to_bytes(width, "little", signed=True)
+    return Assembly(bytes(code), labels, relocations)
+
+
+def relax(pieces):
+    """
+    Widen short jumps whose targets are out of their reach, until none are.
+    Jumps only ever grow, so this terminates. Returns the label offsets.
+    """
+    while True:
+        labels = {}
+        offset = 0
+        for piece in pieces:
+            if isinstance(piece, Label):
+                labels[piece.name] = offset
+            elif isinstance(piece, (Jump, CallSite)):
+                offset += piece.size()
+            else:
+                offset += len(piece)
+        changed = False
+        offset = 0
+        for piece in pieces:
+            if isinstance(piece, Label):
+                continue
+            if isinstance(piece, CallSite):
+                offset += piece.size()
+            elif isinstance(piece, Jump):
+                offset += piece.size()
+                if piece.short and not fits_imm8(labels[piece.target] - offset):
+                    piece.short = False
+                    changed = True
+            else:
+                offset += len(piece)
+        if not changed:
+            return labels
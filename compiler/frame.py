@@ -0,0 +1,250 @@
+"""
+Stack frame layout.
+
+Every stack slot, for an Alloca or for a value `regalloc` spilled or saves
+around calls, has a size, an alignment and a lifetime: an interval over the
+same instruction positions `regalloc` uses. Slots whose lifetimes don't overlap
+can share memory. They are placed the most aligned first, each as close to RBP
+as it fits without overlapping a slot that is in use at the same time.
+
+An Alloca is in use from a store, copy or call writing to it for as long as
+something may still read what was stored. One that is never loaded from or
+stored to gets no slot. A call can't see the caller's slots, other than the one
+it returns a struct to.
+
+Without a frame pointer, slots are addressed from RSP instead. A function that
+doesn't call anything or push anything can keep them in the red zone below RSP,
+if they fit, and leave RSP where it is.
+"""
+import bisect
+import itertools
+
+from .abi import RED_ZONE, register_width
+from . import ir
+
+# RSP is 16-byte aligned at calls (System V ABI), so nothing in the frame can
+# be aligned to more than that
+MAX_ALIGNMENT = 16
+# In instructions
+SHORT_LIFETIME = 32
+
+
+class Slot:
+    def __init__(self, key, size, alignment, start, end):
+        self.key = key
+        self.size = size
+        self.alignment = alignment
+        self.start = start
+        self.end = end
+        # Relative to RBP, set by `place`
+        self.offset = None
+
+    def overlaps(self, other):
+        return self.start <= other.end and other.start <= self.end
+
+
+def slot_alignment(type_):
+    # Struct alignment is still the size of the largest field, which needn't
+    # be a power of two
+    alignment = min(type_.alignment(), MAX_ALIGNMENT)
+    return 1 << (alignment.bit_length() - 1)
+
+
+def alloca_lifetimes(function, folded=()):
+    """
+    (start, end) of every Alloca that is used: the hull of its loads and
+    stores and of the block boundaries where it holds a value something may
+    still read. A folded Load reads where its user is.
+    """
+    positions = {}
+    bounds = {}
+    pos = 0
+    for block in function.blocks:
+        start = pos
+        for inst in block.instructions:
+            positions[inst] = pos
+            pos += 1
+        bounds[block] = (start, pos - 1)
+    for inst in function.instructions():
+        for operand in inst.operands():
+            if operand in folded:
+                positions[operand] = positions[inst]
+
+    allocas = [inst for inst in function.instructions() if isinstance(inst, ir.Alloca)]
+    lifetimes = {}
+
+    def extend(alloca, position):
+        if alloca in lifetimes:
+            start, end = lifetimes[alloca]
+            lifetimes[alloca] = (min(start, position), max(end, position))
+        else:
+            lifetimes[alloca] = (position, position)
+
+    def accesses(inst):
+        """(alloca read or None, alloca written or None, whether all of it)."""
+        if isinstance(inst, ir.Load) and isinstance(inst.address, ir.Alloca):
+            return inst.address, None, False
+        if isinstance(inst, ir.Store) and isinstance(inst.address, ir.Alloca):
+            dest, offset = inst.address, inst.offset
+            read = None
+        elif isinstance(inst, ir.Copy):
+            read = inst.src if isinstance(inst.src, ir.Alloca) else None
+            if not isinstance(inst.dest, ir.Alloca):
+                # Memory the caller owns
+                return read, None, False
+            dest, offset = inst.dest, inst.dest_offset
+        elif isinstance(inst, ir.Call):
+            if not isinstance(inst.dest, ir.Alloca):
+                return None, None, False
+            dest, offset = inst.dest, inst.dest_offset
+            read = None
+        else:
+            return None, None, False
+        whole = offset == 0 and inst.type.size() >= dest.allocated_type.size()
+        return read, dest, whole
+
+    for inst in function.instructions():
+        for alloca in accesses(inst)[:2]:
+            if alloca is not None:
+                extend(alloca, positions[inst])
+
+    # Backwards: which allocas may still be read
+    live_in = {block: set() for block in function.blocks}
+    live_out = {block: set() for block in function.blocks}
+    changed = True
+    while changed:
+        changed = False
+        for block in reversed(function.blocks):
+            live = set()
+            for succ in block.successors():
+                live |= live_in[succ]
+            live_out[block] = set(live)
+            for inst in reversed(block.instructions):
+                read, written, whole = accesses(inst)
+                if read is None and written is None:
+                    if inst.writes_memory and not isinstance(inst, ir.Call):
+                        # Anything else touching memory might read them all
+                        live.update(allocas)
+                    continue
+                if whole:
+                    live.discard(written)
+                if read is not None:
+                    live.add(read)
+            if live != live_in[block]:
+                live_in[block] = live
+                changed = True
+
+    # Forwards: which allocas may have been written
+    preds = function.predecessors()
+    written_in = {block: set() for block in function.blocks}
+    written_out = {block: set() for block in function.blocks}
+    changed = True
+    while changed:
+        changed = False
+        for block in function.blocks:
+            written = set()
+            for pred in preds[block]:
+                written |= written_out[pred]
+            written_in[block] = set(written)
+            for inst in block.instructions:
+                dest = accesses(inst)[1]
+                if dest is not None:
+                    written.add(dest)
+            if written != written_out[block]:
+                written_out[block] = written
+                changed = True
+
+    for block in function.blocks:
+        start, end = bounds[block]
+        for alloca in live_in[block] & written_in[block]:
+            extend(alloca, start)
+        for alloca in live_out[block] & written_out[block]:
+            extend(alloca, end)
+    return lifetimes
+
+
+def place(slots):
+    """Set the offset of every slot. Returns how many bytes they take."""
+    # Most lifetimes are short. Those are kept by start, so only the ones
+    # starting late enough to overlap have to be looked at; the few long ones
+    # are always looked at.
+    starts = []
+    short = []
+    long = []
+    depth = 0
+    for slot in sorted(slots, key=lambda slot: (-slot.alignment, -slot.size)):
+        first = bisect.bisect_left(starts, slot.start - SHORT_LIFETIME)
+        last = bisect.bisect_right(starts, slot.end)
+        busy = sorted(
+            (
+                other
+                for other in itertools.chain(short[first:last], long)
+                if other.overlaps(slot)
+            ),
+            key=lambda other: other.offset,
+            reverse=True,
+        )
+        # The highest aligned offset below RBP that is clear of all of them
+        offset = -slot.size
+        for other in busy:
+            offset -= offset % slot.alignment
+            if offset < other.offset + other.size and other.offset < offset + slot.size:
+                offset = other.offset - slot.size
+        offset -= offset % slot.alignment
+        slot.offset = offset
+        depth = max(depth, -offset)
+        if slot.end - slot.start < SHORT_LIFETIME:
+            i = bisect.bisect_right(starts, slot.start)
+            starts.insert(i, slot.start)
+            short.insert(i, slot)
+        else:
+            long.append(slot)
+    return depth
+
+
+def align_stack(size):
+    return -(-size // MAX_ALIGNMENT) * MAX_ALIGNMENT
+
+
+def layout(function, allocation, folded=(), frame_pointer=True, red_zone=False):
+    """
+    Offsets of the slots of allocas and of spilled and saved values, and how
+    much to subtract from RSP in the prologue.
+
+    With a frame pointer, offsets are from RBP and RSP is moved after pushing
+    RBP. Otherwise they are from RSP and it is moved after pushing the
+    callee-saved registers, not at all if red_zone allows and the slots fit
+    there. Either way RSP is 16-byte aligned once it has been moved.
+    """
+    slots = []
+    lifetimes = alloca_lifetimes(function, folded)
+    for inst in function.instructions():
+        if inst in lifetimes:
+            type_ = inst.allocated_type
+            start, end = lifetimes[inst]
+            slots.append(Slot(inst, type_.size(), slot_alignment(type_), start, end))
+    for iv in allocation.intervals:
+        if iv.register is None:
+            # As wide as the register it's moved from and to
+            size = register_width(iv.value.type.size()).byte_size()
+            slots.append(Slot(iv.value, size, size, iv.start, iv.end))
+    for value, (start, end) in allocation.saved_across.items():
+        # The whole register is saved
+        slots.append(Slot(value, 8, 8, start, end))
+    depth = place(slots)
+    offsets = {slot.key: slot.offset for slot in slots}
+    saved = 8 * len(allocation.callee_saved)
+    if frame_pointer:
+        return offsets, align_stack(depth + saved) - saved
+    # The return address left RSP 8 bytes past a multiple of 16, and the slots
+    # are placed below a multiple of 16
+    padding = (8 + saved) % MAX_ALIGNMENT
+    frame_size = padding + align_stack(depth)
+    bias = frame_size - padding
+    if red_zone:
+        if all(slot.alignment < MAX_ALIGNMENT for slot in slots):
+            # RSP is aligned enough for all of them as it is
+            padding = 0
+        if padding + depth <= RED_ZONE:
+            frame_size, bias = 0, -padding
+    return {key: offset + bias for key, offset in offsets.items()}, frame_size
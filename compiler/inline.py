@@ -0,0 +1,137 @@
+"""
+Inlining of calls to small functions.
+
+A call is replaced by a copy of the callee's IR, built afresh from its AST
+so its locals are distinct from the caller's. Arguments become the values
+passed, each return becomes a jump to the code after the call, and the
+result of the call is a phi of the returned values if there is more than
+one return. Calls that would recurse, callees that cost more than the
+threshold and calls passing or returning structs that don't fit in a
+register are left alone.
+
+Every function is exported for now, so inlining one doesn't make its own
+code go away; it still has to be there for other callers.
+"""
+from .irgen import build as build_ir
+from .mem2reg import mem2reg
+from . import ir
+
+DEFAULT_THRESHOLD = 20
+# What a call left in the callee counts for, moving arguments included
+CALL_COST = 5
+
+
+def cost(function):
+    """Roughly how many instructions the function's body turns into."""
+    total = 0
+    for inst in function.instructions():
+        if isinstance(inst, (ir.Alloca, ir.Phi, ir.Jump)):
+            continue
+        total += CALL_COST if isinstance(inst, ir.Call) else 1
+    return total
+
+
+def splice(caller, call, callee):
+    """Replace call, an instruction of caller, with the body of callee."""
+    block = call.block
+    i = block.instructions.index(call)
+    after = caller.new_block(append=False)
+    for inst in block.instructions[i + 1 :]:
+        after.append(inst)
+    del block.instructions[i:]
+    for succ in after.successors():
+        for phi in succ.phis():
+            for pair in phi.incoming:
+                if pair[0] is block:
+                    pair[0] = after
+
+    for callee_block in callee.blocks:
+        callee_block.name = caller.new_block(append=False).name
+    allocas = [i for i in callee.entry.instructions if isinstance(i, ir.Alloca)]
+    callee.entry.instructions = [
+        i for i in callee.entry.instructions if not isinstance(i, ir.Alloca)
+    ]
+    for alloca in reversed(allocas):
+        caller.entry.insert(0, alloca)
+
+    returned = []
+    for callee_block in callee.blocks:
+        terminator = callee_block.terminator
+        if isinstance(terminator, ir.Return):
+            callee_block.instructions.pop()
+            callee_block.append(ir.Jump(after))
+            value = terminator.values[0] if terminator.values else None
+            returned.append((callee_block, value))
+
+    block.append(ir.Jump(callee.entry))
+    position = caller.blocks.index(block) + 1
+    caller.blocks[position:position] = callee.blocks + [after]
+
+    if len(returned) == 1 and returned[0][1] is not None:
+        result = returned[0][1]
+    elif any(value is not None for _, value in returned):
+        result = after.insert(0, ir.Phi(call.type))
+        for pred, value in returned:
+            result.add_incoming(pred, value or ir.Undef(call.type))
+    else:
+        result = ir.Undef(call.type)
+    mapping = dict(zip(callee.params, call.arguments))
+    mapping[call] = result
+    caller.replace_uses(mapping)
+
+
+class Inliner:
+    """
+    Inlines calls in the functions given to run(). Callee bodies come from
+    the declarations collected by `Compile`. Every decision is counted in
+    stats and, if there is a log, written to it.
+    """
+
+    def __init__(self, compile, threshold=DEFAULT_THRESHOLD, stats=None, log=None):
+        self.compile = compile
+        self.threshold = threshold
+        self.stats = stats
+        self.log = log
+
+    def run(self, function, stack=(), report=True):
+        stack = stack + (function.name,)
+        calls = [i for i in function.instructions() if isinstance(i, ir.Call)]
+        for call in calls:
+            callee, reason = self.candidate(call, stack)
+            if report:
+                self.report(function, call, callee is not None, reason)
+            if callee is not None:
+                splice(function, call, callee)
+
+    def candidate(self, call, stack):
+        """The IR to put in place of call, or None and why not."""
+        decl = self.compile.function_decls.get(call.function)
+        if decl is None:
+            return None, "no body"
+        if call.function in stack:
+            return None, "recursive"
+        if call.dest is not None:
+            return None, "returns a struct"
+        if any(value.type.size() > 8 for value in call.arguments):
+            return None, "struct argument"
+        callee = build_ir(self.compile, decl)
+        mem2reg(callee)
+        # Bottom up, so the cost includes whatever gets inlined into it
+        self.run(callee, stack, report=False)
+        callee_cost = cost(callee)
+        if callee_cost > self.threshold:
+            return None, f"cost {callee_cost} over threshold {self.threshold}"
+        for inst in callee.instructions():
+            if isinstance(inst, ir.Return) and len(inst.values) > 1:
+                return None, "returns in two registers"
+        return callee, f"cost {callee_cost}"
+
+    def report(self, caller, call, inlined, reason):
+        if self.stats is not None:
+            self.stats["inlined" if inlined else "not_inlined"] += 1
+        if self.log is not None:
+            verdict = "inlined" if inlined else "not inlined"
+            print(
+                f"{caller.name}: {verdict} call to {call.function} ({reason})",
+                file=self.log,
+            )
@@ -0,0 +1,159 @@
+"""
+Optional timing and statistics for the compiler's phases.
+
+Everything here is off until enable() is called. While it is off, phase()
+returns one shared do-nothing context manager and count_function() returns
+right away, so instrumented code costs a function call per phase.
+
+Phases nest: a phase entered while another is running is recorded under
+"outer/inner".
+"""
+import contextlib
+import time
+
+_null = contextlib.nullcontext()
+_current = None
+
+
+class Instrumentation:
+    def __init__(self, trace_memory=False):
+        self.times = {}
+        self.calls = {}
+        self.functions = {}
+        self.stack = []
+        self.trace_memory = trace_memory
+        if trace_memory:
+            # Imported here since it's slow to import and rarely used
+            import tracemalloc
+
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.stack.append(name)
+        key = "/".join(self.stack)
+        if key not in self.times:
+            # Keep outer phases ahead of the ones inside them
+            self.times[key] = 0.0
+            self.calls[key] = 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stack.pop()
+            self.times[key] += elapsed
+            self.calls[key] += 1
+
+    def take(self):
+        """Everything recorded so far, which is then forgotten."""
+        data = {
+            "times": self.times,
+            "calls": self.calls,
+            "functions": self.functions,
+        }
+        self.times = {}
+        self.calls = {}
+        self.functions = {}
+        return data
+
+    def merge(self, data):
+        """Add what another process recorded, as returned by its take()."""
+        for key, elapsed in data["times"].items():
+            self.times[key] = self.times.get(key, 0.0) + elapsed
+            self.calls[key] = self.calls.get(key, 0) + data["calls"][key]
+        self.functions.update(data["functions"])
+
+    def peak_memory(self):
+        if not self.trace_memory:
+            return None
+        import tracemalloc
+
+        return tracemalloc.get_traced_memory()[1]
+
+    def report(self):
+        totals = {"instructions": 0, "blocks": 0, "stack_bytes": 0}
+        for counts in self.functions.values():
+            for name in totals:
+                totals[name] += counts[name]
+        return {
+            "phases": {
+                key: {"seconds": self.times[key], "calls": self.calls[key]}
+                for key in self.times
+            },
+            "functions": self.functions,
+            "totals": totals,
+            "peak_memory": self.peak_memory(),
+        }
+
+
+def enable(trace_memory=False):
+    global _current
+    _current = Instrumentation(trace_memory=trace_memory)
+    return _current
+
+
+def current():
+    """The enabled Instrumentation, or None."""
+    return _current
+
+
+def phase(name):
+    """Context manager timing a phase of compilation."""
+    if _current is None:
+        return _null
+    return _current.phase(name)
+
+
+def count_function(name, instructions, blocks, stack_bytes):
+    if _current is None:
+        return
+    _current.functions[name] = {
+        "instructions": instructions,
+        "blocks": blocks,
+        "stack_bytes": stack_bytes,
+    }
+
+
+def format_phases(report):
+    lines = [f"{'seconds':>10} {'calls':>7}  phase"]
+    for key, entry in report["phases"].items():
+        depth = key.count("/")
+        name = "  " * depth + key.rsplit("/", 1)[-1]
+        lines.append(f"{entry['seconds']:10.4f} {entry['calls']:7}  {name}")
+    return "\n".join(lines)
+
+
+def format_functions(report):
+    lines = [f"{'instructions':>12} {'blocks':>6} {'stack':>6}  function"]
+    rows = list(report["functions"].items()) + [("(total)", report["totals"])]
+    for name, counts in rows:
+        lines.append(
+            f"{counts['instructions']:12} {counts['blocks']:6} "
+            f"{counts['stack_bytes']:6}  {name}"
+        )
+    return "\n".join(lines)
+
+
+def format_report(report, time_passes=True, stats=True, as_json=False):
+    """The parts of a report() asked for, as a table or JSON."""
+    if as_json:
+        import json
+
+        selected = {}
+        if time_passes:
+            selected["phases"] = report["phases"]
+        if stats:
+            selected["functions"] = report["functions"]
+            selected["totals"] = report["totals"]
+        if report["peak_memory"] is not None:
+            selected["peak_memory"] = report["peak_memory"]
+        return json.dumps(selected, indent=2)
+    parts = []
+    if time_passes:
+        parts.append(format_phases(report))
+    if stats:
+        parts.append(format_functions(report))
+    if report["peak_memory"] is not None:
+        parts.append(f"peak memory: {report['peak_memory'] / 1024 / 1024:.1f} MiB")
+    return "\n\n".join(parts)
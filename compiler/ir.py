@@ -0,0 +1,499 @@
+"""
+SSA intermediate representation between the AST and `asm`.
+
+A Function is a list of Blocks, each a list of Instructions ending in a
+terminator (Jump, Branch or Return). Instructions that produce a value are used
+directly as operands of later instructions; there are no separate virtual
+registers. Memory is only reached through Allocas (stack slots) plus a
+constant byte offset, which is all the language can express so far.
+"""
+from . import types_
+
+
+class Value:
+    type = None
+
+
+class Const(Value):
+    def __init__(self, value, type_):
+        self.value = value
+        self.type = type_
+
+    def __str__(self):
+        return str(self.value)
+
+
+class Undef(Value):
+    """The value of a local that is read before anything is stored in it."""
+
+    def __init__(self, type_):
+        self.type = type_
+
+    def __str__(self):
+        return "undef"
+
+
+class Param(Value):
+    """An argument, as passed in by the caller."""
+
+    def __init__(self, index, name, type_):
+        self.index = index
+        self.name = name
+        self.type = type_
+
+    def __str__(self):
+        return f"%{self.name}"
+
+
+class Instruction(Value):
+    # Names of the attributes that hold operands
+    operand_names = ()
+    is_terminator = False
+    has_value = False
+    writes_memory = False
+
+    block = None
+
+    def operands(self):
+        return [getattr(self, name) for name in self.operand_names]
+
+    def replace_operands(self, mapping):
+        for name in self.operand_names:
+            value = getattr(self, name)
+            if value in mapping:
+                setattr(self, name, mapping[value])
+
+    def successors(self):
+        return []
+
+    def replace_successors(self, mapping):
+        pass
+
+
+class Alloca(Instruction):
+    """A stack slot for a value of `allocated_type`. The value is its address."""
+
+    has_value = True
+
+    def __init__(self, allocated_type, name):
+        self.allocated_type = allocated_type
+        self.name = name
+
+    def format(self, names):
+        return f"{names[self]} = alloca {self.name}, {self.allocated_type.size()}"
+
+
+class Load(Instruction):
+    operand_names = ("address",)
+    has_value = True
+
+    def __init__(self, address, offset, type_):
+        self.address = address
+        self.offset = offset
+        self.type = type_
+
+    def format(self, names):
+        return (
+            f"{names[self]} = load {self.type.size()} "
+            f"{name_of(self.address, names)}+{self.offset}"
+        )
+
+
+class Store(Instruction):
+    operand_names = ("address", "value")
+    writes_memory = True
+
+    def __init__(self, address, offset, value, type_):
+        self.address = address
+        self.offset = offset
+        self.value = value
+        self.type = type_
+
+    def format(self, names):
+        return (
+            f"store {self.type.size()} {name_of(self.value, names)}, "
+            f"{name_of(self.address, names)}+{self.offset}"
+        )
+
+
+class Copy(Instruction):
+    """Copy a value of `type` from src+src_offset to dest+dest_offset."""
+
+    operand_names = ("dest", "src")
+    writes_memory = True
+
+    def __init__(self, dest, dest_offset, src, src_offset, type_):
+        self.dest = dest
+        self.dest_offset = dest_offset
+        self.src = src
+        self.src_offset = src_offset
+        self.type = type_
+
+    def format(self, names):
+        return (
+            f"copy {self.type.size()} {name_of(self.src, names)}+{self.src_offset}, "
+            f"{name_of(self.dest, names)}+{self.dest_offset}"
+        )
+
+
+class BinOp(Instruction):
+    """
+    Integer arithmetic on two values of `type`, wrapping around like two's
+    complement does. Division truncates toward zero, and the remainder has
+    the sign of the dividend. `>>` is an arithmetic shift, and shift counts
+    are taken modulo 32 (64 for 8 byte values), as x86 does.
+    """
+
+    operand_names = ("left", "right")
+    has_value = True
+
+    # Mnemonics, for printing
+    names = {
+        "+": "add",
+        "-": "sub",
+        "*": "mul",
+        "/": "div",
+        "%": "rem",
+        "<<": "shl",
+        ">>": "sar",
+        "&": "and",
+        "|": "or",
+        "^": "xor",
+    }
+    commutative = frozenset(["+", "*", "&", "|", "^"])
+
+    def __init__(self, operator, left, right, type_):
+        self.operator = operator
+        self.left = left
+        self.right = right
+        self.type = type_
+
+    def can_trap(self):
+        """Whether it is a division that could fault, by zero or overflow."""
+        if self.operator not in ("/", "%"):
+            return False
+        if not isinstance(self.right, Const):
+            return True
+        return self.type.wrap(self.right.value) in (0, -1)
+
+    def format(self, names):
+        return (
+            f"{names[self]} = {self.names[self.operator]} {self.type.size()} "
+            f"{name_of(self.left, names)}, {name_of(self.right, names)}"
+        )
+
+
+class Phi(Instruction):
+    has_value = True
+
+    def __init__(self, type_):
+        self.type = type_
+        self.incoming = []
+
+    def add_incoming(self, block, value):
+        self.incoming.append([block, value])
+
+    def operands(self):
+        return [value for _, value in self.incoming]
+
+    def replace_operands(self, mapping):
+        for pair in self.incoming:
+            if pair[1] in mapping:
+                pair[1] = mapping[pair[1]]
+
+    def format(self, names):
+        incoming = ", ".join(
+            f"[{block.name}: {name_of(value, names)}]" for block, value in self.incoming
+        )
+        return f"{names[self]} = phi {incoming}"
+
+
+class Call(Instruction):
+    """
+    A call of the function with the given name. Arguments larger than 8 bytes
+    are Loads of the whole value, which lowering reads from memory. A struct
+    that is returned is written to dest+dest_offset, and the call has no
+    value; dest is an Alloca, or the caller's own return pointer.
+    """
+
+    # The callee could do anything
+    writes_memory = True
+
+    def __init__(self, function, arguments, type_, dest=None, dest_offset=0):
+        self.function = function
+        self.arguments = arguments
+        self.type = type_
+        self.dest = dest
+        self.dest_offset = dest_offset
+        self.has_value = dest is None
+
+    def operands(self):
+        if self.dest is None:
+            return list(self.arguments)
+        return self.arguments + [self.dest]
+
+    def replace_operands(self, mapping):
+        self.arguments = [mapping.get(v, v) for v in self.arguments]
+        self.dest = mapping.get(self.dest, self.dest)
+
+    def format(self, names):
+        arguments = ", ".join(name_of(v, names) for v in self.arguments)
+        if self.dest is None:
+            return f"{names[self]} = call {self.function}({arguments})"
+        dest = f"{name_of(self.dest, names)}+{self.dest_offset}"
+        return f"call {self.function}({arguments}) -> {dest}"
+
+
+class Jump(Instruction):
+    is_terminator = True
+
+    def __init__(self, target):
+        self.target = target
+
+    def successors(self):
+        return [self.target]
+
+    def replace_successors(self, mapping):
+        self.target = mapping.get(self.target, self.target)
+
+    def format(self, names):
+        return f"jump {self.target.name}"
+
+
+class Branch(Instruction):
+    """Go to if_true if cond is not zero, to if_false otherwise."""
+
+    operand_names = ("cond",)
+    is_terminator = True
+
+    def __init__(self, cond, if_true, if_false):
+        self.cond = cond
+        self.if_true = if_true
+        self.if_false = if_false
+
+    def successors(self):
+        return [self.if_true, self.if_false]
+
+    def replace_successors(self, mapping):
+        self.if_true = mapping.get(self.if_true, self.if_true)
+        self.if_false = mapping.get(self.if_false, self.if_false)
+
+    def format(self, names):
+        return (
+            f"branch {name_of(self.cond, names)}, "
+            f"{self.if_true.name}, {self.if_false.name}"
+        )
+
+
+class Return(Instruction):
+    """
+    Return from the function. `values` are put in the return registers in
+    order (RAX, then RDX for the upper half of a 16 byte value).
+    """
+
+    is_terminator = True
+
+    def __init__(self, values):
+        self.values = values
+
+    def operands(self):
+        return list(self.values)
+
+    def replace_operands(self, mapping):
+        self.values = [mapping.get(v, v) for v in self.values]
+
+    def format(self, names):
+        return "return " + ", ".join(name_of(v, names) for v in self.values)
+
+
+def name_of(value, names):
+    if isinstance(value, Instruction):
+        return names[value]
+    return str(value)
+
+
+class Block:
+    def __init__(self, name):
+        self.name = name
+        self.instructions = []
+
+    def append(self, inst):
+        inst.block = self
+        self.instructions.append(inst)
+        return inst
+
+    def insert(self, index, inst):
+        inst.block = self
+        self.instructions.insert(index, inst)
+        return inst
+
+    @property
+    def terminator(self):
+        if self.instructions and self.instructions[-1].is_terminator:
+            return self.instructions[-1]
+        return None
+
+    def successors(self):
+        terminator = self.terminator
+        return terminator.successors() if terminator is not None else []
+
+    def phis(self):
+        for inst in self.instructions:
+            if not isinstance(inst, Phi):
+                break
+            yield inst
+
+
+class Function:
+    def __init__(self, name, params, return_type):
+        self.name = name
+        self.params = params
+        self.return_type = return_type
+        # Where to put a return value too large for registers, see `abi`
+        self.return_pointer = None
+        self.blocks = []
+        self.block_count = 0
+
+    @property
+    def entry(self):
+        return self.blocks[0]
+
+    def new_block(self, append=True):
+        block = Block(f"b{self.block_count}")
+        self.block_count += 1
+        if append:
+            self.blocks.append(block)
+        return block
+
+    def incoming(self):
+        """The params, after the hidden return pointer if there is one."""
+        if self.return_pointer is None:
+            return list(self.params)
+        return [self.return_pointer] + self.params
+
+    def instructions(self):
+        for block in self.blocks:
+            yield from block.instructions
+
+    def predecessors(self):
+        preds = {block: [] for block in self.blocks}
+        for block in self.blocks:
+            for succ in block.successors():
+                preds[succ].append(block)
+        return preds
+
+    def reachable(self):
+        """Blocks reachable from the entry, in depth-first preorder."""
+        seen = set()
+        order = []
+        stack = [self.entry]
+        while stack:
+            block = stack.pop()
+            if block in seen:
+                continue
+            seen.add(block)
+            order.append(block)
+            stack.extend(reversed(block.successors()))
+        return order
+
+    def replace_uses(self, mapping):
+        """Replace operands according to mapping, following chains."""
+
+        def resolve(value):
+            while value in mapping:
+                value = mapping[value]
+            return value
+
+        resolved = {old: resolve(new) for old, new in mapping.items()}
+        for inst in self.instructions():
+            inst.replace_operands(resolved)
+
+    def value_names(self):
+        """Printable names of the values instructions produce, by position."""
+        names = {}
+        for inst in self.instructions():
+            if inst.has_value:
+                names[inst] = f"%{len(names)}"
+        return names
+
+    def __str__(self):
+        names = self.value_names()
+        params = ", ".join(f"{p}: {p.type.size()}" for p in self.incoming())
+        lines = [f"function {self.name}({params}) {{"]
+        for block in self.blocks:
+            lines.append(f"{block.name}:")
+            lines.extend(f"\t{inst.format(names)}" for inst in block.instructions)
+        lines.append("}")
+        return "\n".join(lines)
+
+
+def reverse_postorder(function):
+    seen = set()
+    order = []
+    stack = [(function.entry, iter(function.entry.successors()))]
+    seen.add(function.entry)
+    while stack:
+        block, successors = stack[-1]
+        for succ in successors:
+            if succ not in seen:
+                seen.add(succ)
+                stack.append((succ, iter(succ.successors())))
+                break
+        else:
+            stack.pop()
+            order.append(block)
+    order.reverse()
+    return order
+
+
+def dominators(function):
+    """
+    Immediate dominators of the reachable blocks, using the algorithm from
+    Cooper, Harvey and Kennedy's "A Simple, Fast Dominance Algorithm".
+    """
+    order = reverse_postorder(function)
+    index = {block: i for i, block in enumerate(order)}
+    preds = function.predecessors()
+    entry = function.entry
+    idom = {entry: entry}
+
+    def intersect(a, b):
+        while a is not b:
+            while index[a] > index[b]:
+                a = idom[a]
+            while index[b] > index[a]:
+                b = idom[b]
+        return a
+
+    changed = True
+    while changed:
+        changed = False
+        for block in order[1:]:
+            new_idom = None
+            for pred in preds[block]:
+                if pred not in idom:
+                    continue
+                new_idom = pred if new_idom is None else intersect(pred, new_idom)
+            if idom.get(block) is not new_idom:
+                idom[block] = new_idom
+                changed = True
+    return idom
+
+
+def dominance_frontiers(function, idom):
+    preds = function.predecessors()
+    frontiers = {block: set() for block in idom}
+    for block in idom:
+        block_preds = [p for p in preds[block] if p in idom]
+        if len(block_preds) < 2:
+            continue
+        for pred in block_preds:
+            runner = pred
+            while runner is not idom[block]:
+                frontiers[runner].add(block)
+                runner = idom[runner]
+    return frontiers
+
+
+def is_scalar(type_):
+    return isinstance(type_, types_.Integer)
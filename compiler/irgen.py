@@ -0,0 +1,277 @@
+"""
+Translation of a function's AST to `ir`.
+
+Every argument and local gets an Alloca, and every read or write of one is
+a Load or Store, so the result is trivially in SSA form. mem2reg then turns
+the scalar ones into plain values.
+
+A call that returns a struct writes it straight to the variable it is assigned
+to, or to the caller's own return pointer when it is returned; otherwise to a
+temporary slot.
+"""
+from .ast import (
+    AssignStmt,
+    BinaryExpr,
+    CallExpr,
+    FieldAccessExpr,
+    IdentExpr,
+    IntExpr,
+    ReturnStmt,
+    VarDecl,
+    WhileStmt,
+)
+from .abi import in_memory
+from .types_ import Integer, Pointer
+from . import ir
+
+
+class Place:
+    """Memory an expression refers to: an Alloca plus a byte offset."""
+
+    def __init__(self, address, offset, type_):
+        self.address = address
+        self.offset = offset
+        self.type = type_
+
+    def field(self, name):
+        return Place(
+            self.address,
+            self.offset + self.type.field_offset(name),
+            self.type.field_type(name),
+        )
+
+
+class IRBuilder:
+    def __init__(self, compile, decl):
+        self.compile = compile
+        self.decl = decl
+        self.return_type = compile.get_type(decl.return_type)
+        params = [
+            ir.Param(i, name, compile.get_type(t))
+            for i, (name, t) in enumerate(decl.arguments)
+        ]
+        self.function = ir.Function(decl.name, params, self.return_type)
+        if in_memory(self.return_type):
+            self.function.return_pointer = ir.Param(
+                None, ".result", Pointer(self.return_type)
+            )
+        self.block = self.function.new_block()
+        # Allocas are kept together at the start of the entry block
+        self.alloca_count = 0
+        self.locals_ = {}
+
+    def emit(self, inst):
+        return self.block.append(inst)
+
+    def alloca(self, type_, name):
+        inst = ir.Alloca(type_, name)
+        self.function.entry.insert(self.alloca_count, inst)
+        self.alloca_count += 1
+        return inst
+
+    def build(self):
+        for param in self.function.params:
+            slot = self.alloca(param.type, param.name)
+            self.emit(ir.Store(slot, 0, param, param.type))
+            self.locals_[param.name] = Place(slot, 0, param.type)
+        for stmt in self.decl.body:
+            self.stmt(stmt)
+        if self.block is not None:
+            self.block.append(ir.Return([]))
+        return self.function
+
+    def place(self, expr):
+        if isinstance(expr, IdentExpr):
+            return self.locals_[expr.name]
+        if isinstance(expr, FieldAccessExpr):
+            return self.place(expr.obj).field(expr.field_name)
+        if isinstance(expr, CallExpr):
+            result = self.call(expr)
+            if isinstance(result, Place):
+                return result
+            slot = self.alloca(result.type, f".{expr.function_name}")
+            place = Place(slot, 0, result.type)
+            self.store(place, result)
+            return place
+        raise NotImplementedError(type(expr))
+
+    def type_of(self, expr):
+        """The type of a place or call, without generating any code for it."""
+        if isinstance(expr, IdentExpr):
+            return self.locals_[expr.name].type
+        if isinstance(expr, FieldAccessExpr):
+            return self.type_of(expr.obj).field_type(expr.field_name)
+        if isinstance(expr, CallExpr):
+            return self.compile.functions[expr.function_name].return_type
+        if isinstance(expr, BinaryExpr):
+            # The literals in it take the type of the rest
+            operand = expr.right if is_constant(expr.left) else expr.left
+            return self.type_of(operand)
+        raise NotImplementedError(type(expr))
+
+    def typed_place(self, expr, expected_type):
+        if isinstance(expr, (IntExpr, BinaryExpr)):
+            raise TypeError(f"{expr} is not assignable to {expected_type}")
+        place = self.place(expr)
+        if expected_type != place.type:
+            raise TypeError(f"{place.type} is not assignable to {expected_type}")
+        return place
+
+    def expr(self, expr, expected_type):
+        if isinstance(expr, IntExpr):
+            if not isinstance(expected_type, Integer):
+                raise TypeError(f"{expr.value} is not assignable to {expected_type}")
+            if not expected_type.fits(expr.value):
+                raise TypeError(f"{expr.value} does not fit in {expected_type}")
+            return ir.Const(expr.value, expected_type)
+        if isinstance(expr, BinaryExpr):
+            if not isinstance(expected_type, Integer):
+                raise TypeError(f"{expr} is not assignable to {expected_type}")
+            left = self.expr(expr.left, expected_type)
+            right = self.expr(expr.right, expected_type)
+            return self.emit(ir.BinOp(expr.operator, left, right, expected_type))
+        if isinstance(expr, CallExpr) and ir.is_scalar(expected_type):
+            self.check_call(expr, expected_type)
+            return self.call(expr)
+        place = self.typed_place(expr, expected_type)
+        return self.emit(ir.Load(place.address, place.offset, place.type))
+
+    def check_call(self, expr, expected_type):
+        type_ = self.type_of(expr)
+        if expected_type != type_:
+            raise TypeError(f"{type_} is not assignable to {expected_type}")
+
+    def call(self, expr, dest=None):
+        """
+        Emit a call. Returns its value, or for a struct the Place it was
+        returned to: dest if there is one, otherwise a new temporary.
+        """
+        name = expr.function_name
+        signature = self.compile.functions[name]
+        expected = len(signature.argument_types)
+        if len(expr.arguments) != expected:
+            raise TypeError(
+                f"{name} takes {expected} arguments, not {len(expr.arguments)}"
+            )
+        arguments = []
+        for arg, type_ in zip(expr.arguments, signature.argument_types):
+            if type_.size() <= 8:
+                arguments.append(self.expr(arg, type_))
+            else:
+                arguments.append(self.typed_place(arg, type_))
+        # Larger ones are loaded last, right before the call reads them
+        for i, place in enumerate(arguments):
+            if isinstance(place, Place):
+                load = ir.Load(place.address, place.offset, place.type)
+                arguments[i] = self.emit(load)
+        type_ = signature.return_type
+        if ir.is_scalar(type_):
+            return self.emit(ir.Call(name, arguments, type_))
+        if dest is None:
+            dest = Place(self.alloca(type_, f".{name}"), 0, type_)
+        self.emit(ir.Call(name, arguments, type_, dest.address, dest.offset))
+        return dest
+
+    def store(self, place, value):
+        self.emit(ir.Store(place.address, place.offset, value, place.type))
+
+    def assign(self, place, expr):
+        """Store the value of expr in place, copying it if it's too large."""
+        if isinstance(expr, CallExpr) and not ir.is_scalar(place.type):
+            self.check_call(expr, place.type)
+            self.call(expr, dest=place)
+            return
+        if place.type.size() in (1, 2, 4, 8):
+            self.store(place, self.expr(expr, place.type))
+            return
+        src = self.typed_place(expr, place.type)
+        self.emit(
+            ir.Copy(place.address, place.offset, src.address, src.offset, place.type)
+        )
+
+    def stmt(self, stmt):
+        if self.block is None:
+            # Statements after a return are unreachable, but still compiled
+            self.block = self.function.new_block()
+        if isinstance(stmt, VarDecl):
+            type_ = self.compile.get_type(stmt.type)
+            place = self.locals_[stmt.name] = Place(
+                self.alloca(type_, stmt.name), 0, type_
+            )
+            if stmt.init is not None:
+                self.assign(place, stmt.init)
+        elif isinstance(stmt, AssignStmt):
+            if not isinstance(stmt.target, (IdentExpr, FieldAccessExpr)):
+                raise NotImplementedError()
+            self.assign(self.place(stmt.target), stmt.value)
+        elif isinstance(stmt, ReturnStmt):
+            self.return_(stmt)
+        elif isinstance(stmt, WhileStmt):
+            self.while_(stmt)
+        else:
+            raise NotImplementedError(type(stmt))
+
+    def condition(self, expr):
+        """The value of an expression tested for being non-zero."""
+        if is_constant(expr):
+            return self.expr(expr, Integer(64))
+        type_ = self.type_of(expr)
+        if not isinstance(type_, Integer):
+            raise TypeError(f"{type_} is not an integer")
+        return self.expr(expr, type_)
+
+    def while_(self, stmt):
+        header = self.function.new_block()
+        self.emit(ir.Jump(header))
+        self.block = header
+        body = self.function.new_block()
+        exit = self.function.new_block(append=False)
+        self.emit(ir.Branch(self.condition(stmt.condition), body, exit))
+        self.block = body
+        # Locals declared in the body aren't visible after it
+        outer = dict(self.locals_)
+        for inner in stmt.body:
+            self.stmt(inner)
+        self.locals_ = outer
+        if self.block is not None:
+            self.emit(ir.Jump(header))
+        self.function.blocks.append(exit)
+        self.block = exit
+
+    def return_(self, stmt):
+        values = []
+        if stmt.value:
+            type_ = self.return_type
+            size = type_.size()
+            if in_memory(type_):
+                # Copied to where the caller said, and that address returned
+                pointer = self.function.return_pointer
+                self.assign(Place(pointer, 0, type_), stmt.value)
+                values.append(pointer)
+            elif size <= 8:
+                values.append(self.expr(stmt.value, type_))
+            else:
+                # Returned in two halves, RAX and RDX
+                place = self.typed_place(stmt.value, type_)
+                for offset, part in ((0, 8), (8, size - 8)):
+                    values.append(
+                        self.emit(
+                            ir.Load(
+                                place.address, place.offset + offset, Integer(part * 8)
+                            )
+                        )
+                    )
+        self.emit(ir.Return(values))
+        self.block = None
+
+
+def is_constant(expr):
+    """Whether an expression is made of integer literals only."""
+    if isinstance(expr, BinaryExpr):
+        return is_constant(expr.left) and is_constant(expr.right)
+    return isinstance(expr, IntExpr)
+
+
+def build(compile, decl):
+    """The IR for a function declaration."""
+    return IRBuilder(compile, decl).build()
@@ -0,0 +1,400 @@
+"""
+Instruction selection for `ir.BinOp`.
+
+Most operations have more than one instruction sequence that does them, and
+the cheapest one for the operands the value ends up with is picked by
+`asm.cost`, for speed or with optimize_size for size:
+
+- `+` and `-` are `mov` and `add`/`sub`, or a single `lea` when the operands
+  are registers or a constant and the result goes somewhere else.
+- Multiplying by a constant is a shift for a power of two, `lea` for 3, 5
+  and 9 times (and those times a power of two), a shift and an add or sub
+  for one more or one less than a power of two, or `imul`.
+- Dividing by a power of two is an arithmetic shift, with a bias added to
+  round toward zero. Dividing by any other constant is a multiplication by
+  its "magic" reciprocal (Granlund and Montgomery), unless `idiv` is
+  cheaper, as it is for size.
+- Operands in memory are read by the instruction itself rather than loaded
+  first, where x86 has a form for that.
+
+Only idioms turns any of this on; without it every operation is done the
+straightforward way, with `imul` and `idiv`.
+
+Values narrower than 32 bits are worked on in 32-bit registers, whose low
+bits come out the same. Division, remainder and `>>` sign extend them first.
+RAX and R11 are scratch registers. `idiv` also needs RDX and a shift by a
+variable count CL, which `regalloc` keeps clear of other values.
+"""
+from . import asm as s
+from . import ir
+
+scratch = s.Register.rax
+spare = s.Register.r11
+
+QUAD = s.Size.quad_word
+DOUBLE = s.Size.double_word
+
+two_address = {
+    "+": s.Add,
+    "-": s.Sub,
+    "&": s.And,
+    "|": s.Or,
+    "^": s.Xor,
+}
+
+
+def wide(size):
+    """The size narrower values are worked on in."""
+    return QUAD if size is QUAD else DOUBLE
+
+
+def same_register(a, b):
+    return (
+        isinstance(a, s.Register)
+        and isinstance(b, s.Register)
+        and s.RegisterFamily.for_register(a) is s.RegisterFamily.for_register(b)
+    )
+
+
+def load(operand, reg, size, extend=False):
+    """
+    Put an operand of size into reg, which may be wider. With extend, the
+    value is sign extended to the width of reg; otherwise what ends up above
+    size is anything.
+    """
+    if isinstance(operand, s.Immediate):
+        return [s.Mov(operand, reg)]
+    if reg.size() is not size and (extend or isinstance(operand, s.Address)):
+        return [s.Movsx(operand, reg, size)]
+    if same_register(operand, reg):
+        return []
+    if isinstance(operand, s.Register):
+        operand = operand.with_size(reg.size())
+    return [s.Mov(operand, reg, size=reg.size())]
+
+
+def store(reg, dest, size):
+    """Move the result from reg to where it goes, if it isn't there already."""
+    if same_register(reg, dest):
+        return []
+    return [s.Mov(reg.with_size(size), dest)]
+
+
+def magic(divisor):
+    """
+    (multiplier, shift) such that for any int32 n, n / divisor is
+    (n * multiplier) >> shift, plus one if n is negative (Granlund and
+    Montgomery, "Division by invariant integers using multiplication").
+    """
+    precision = 32
+    log = (divisor - 1).bit_length()
+    shift = precision + log - 1
+    return (1 << shift) // divisor + 1, shift
+
+
+class Selector:
+    def __init__(self, optimize_size=False, idioms=True):
+        self.optimize_size = optimize_size
+        self.idioms = idioms
+
+    def cheapest(self, candidates):
+        return min(candidates, key=lambda code: s.cost(code, self.optimize_size))
+
+    def clobbers(self, inst):
+        """Registers besides RAX and R11 that the code for a BinOp writes."""
+        if inst.operator in ("/", "%") and self.division(inst) == "idiv":
+            return {s.Register.rdx}
+        if inst.operator in ("<<", ">>") and not constant(inst.right):
+            return {s.Register.rcx}
+        return set()
+
+    def division(self, inst):
+        """How a BinOp divides: "pow2", "magic" or "idiv"."""
+        divisor = constant(inst.right)
+        if not self.idioms or divisor is None or inst.type.size() == 8:
+            return "idiv"
+        divisor = inst.type.wrap(divisor)
+        magnitude = abs(divisor)
+        if magnitude < 2:
+            return "idiv"
+        if magnitude & (magnitude - 1) == 0:
+            return "pow2"
+        # Neither depends much on where the operands are, so stand-ins do
+        size = s.Size.from_byte_size(inst.type.size())
+        left, dest = s.Register.ecx.with_size(size), s.Register.esi.with_size(size)
+        remainder = inst.operator == "%"
+        by_magic = self.divide_by_magic(left, divisor, dest, size, remainder)
+        by_idiv = self.idiv(left, s.Immediate(divisor), dest, size, remainder)
+        return "magic" if self.cheapest([by_idiv, by_magic]) is by_magic else "idiv"
+
+    def select(self, inst, left, right, dest, size):
+        """
+        Instructions computing a BinOp from the operands left and right into
+        dest, all of them of size.
+        """
+        op = inst.operator
+        if isinstance(left, s.Immediate):
+            left = s.Immediate(inst.type.wrap(left.value))
+        if isinstance(right, s.Immediate):
+            right = s.Immediate(inst.type.wrap(right.value))
+        if op in ("/", "%"):
+            remainder = op == "%"
+            strategy = self.division(inst)
+            if strategy == "pow2":
+                return self.divide_by_power(left, right.value, dest, size, remainder)
+            if strategy == "magic":
+                return self.divide_by_magic(left, right.value, dest, size, remainder)
+            return self.idiv(left, right, dest, size, remainder)
+        if op in ("<<", ">>"):
+            return self.shift(op, left, right, dest, size)
+        if isinstance(left, s.Immediate) and op in ir.BinOp.commutative:
+            left, right = right, left
+        if op == "*":
+            if self.idioms and isinstance(right, s.Immediate):
+                return self.multiply_by_constant(left, right.value, dest, size)
+            return self.multiply(left, right, dest, size)
+        candidates = [self.arithmetic(op, left, right, dest, size)]
+        if self.idioms and op in ("+", "-"):
+            code = self.lea(op, left, right, dest, size)
+            if code is not None:
+                candidates.append(code)
+        return self.cheapest(candidates)
+
+    def target(self, dest, size):
+        """The register to compute a result in: dest or the scratch one."""
+        reg = dest if isinstance(dest, s.Register) else scratch
+        return reg.with_size(size)
+
+    def fit(self, operand, size, code):
+        """An operand an ALU instruction can take, loading wide immediates."""
+        if (
+            isinstance(operand, s.Immediate)
+            and size is QUAD
+            and not s.fits_imm32(operand.value)
+        ):
+            code.append(s.Mov(operand, spare))
+            return spare
+        return operand
+
+    def arithmetic(self, op, left, right, dest, size):
+        code = []
+        target = self.target(dest, size)
+        right = self.fit(right, size, code)
+        if same_register(right, target) and not same_register(left, right):
+            if op in ir.BinOp.commutative:
+                left, right = right, left
+            else:
+                # The target already holds right, and left - right is
+                # -right + left
+                left = self.fit(left, size, code)
+                code.extend([s.Neg(target), s.Add(left, target)])
+                return code + store(target, dest, size)
+        code.extend(load(left, target, size))
+        code.append(two_address[op](right, target, size=size))
+        return code + store(target, dest, size)
+
+    def lea(self, op, left, right, dest, size):
+        """`lea` adding two registers, or a register and a constant."""
+        if not isinstance(dest, s.Register) or not isinstance(left, s.Register):
+            return None
+        base = left.with_size(QUAD)
+        if isinstance(right, s.Immediate):
+            offset = right.value if op == "+" else -right.value
+            if not s.fits_imm32(offset):
+                return None
+            address = s.Address(base, offset)
+        elif isinstance(right, s.Register) and op == "+":
+            address = s.Address(base, 0, right.with_size(QUAD), 1)
+        else:
+            return None
+        return [s.Lea(address, dest.with_size(wide(size)))]
+
+    def multiply(self, left, right, dest, size):
+        work = wide(size)
+        code = []
+        target = self.target(dest, work)
+        if same_register(right, target):
+            left, right = right, left
+        if isinstance(right, s.Immediate):
+            code.extend(load(left, target, size))
+            if s.fits_imm32(right.value):
+                code.append(s.Imul(target, target, factor=right))
+                return code + store(target, dest, size)
+            code.append(s.Mov(right, spare))
+            right = spare
+        elif isinstance(right, s.Register):
+            right = right.with_size(work)
+        elif work is not size:
+            # No narrow imul, and reading 4 bytes could go past the value
+            code.extend(load(right, spare.with_size(work), size))
+            right = spare.with_size(work)
+        code.extend(load(left, target, size))
+        code.append(s.Imul(right, target))
+        return code + store(target, dest, size)
+
+    def multiply_by_constant(self, left, factor, dest, size):
+        work = wide(size)
+        target = self.target(dest, work)
+        if factor == 0:
+            return [s.Mov(s.Immediate(0), target)] + store(target, dest, size)
+        if isinstance(left, s.Register):
+            prepare, source = [], left.with_size(work)
+        else:
+            prepare, source = load(left, target, size), target
+        base = source.with_size(QUAD)
+        finish = store(target, dest, size)
+        magnitude = abs(factor)
+        negate = [s.Neg(target)] if factor < 0 else []
+        power = (magnitude & -magnitude).bit_length() - 1
+        odd = magnitude >> power
+        copy = load(source, target, work)
+
+        candidates = []
+        if magnitude == 1:
+            candidates.append(prepare + copy + negate + finish)
+        if odd == 1 and power:
+            shift = [s.Shl(s.Immediate(power), target)]
+            candidates.append(prepare + copy + shift + negate + finish)
+            if power == 1:
+                lea = [s.Lea(s.Address(base, 0, base, 1), target)]
+                candidates.append(prepare + lea + negate + finish)
+        if odd in (3, 5, 9):
+            code = [s.Lea(s.Address(base, 0, base, odd - 1), target)]
+            if power:
+                code.append(s.Shl(s.Immediate(power), target))
+            candidates.append(prepare + code + negate + finish)
+        if not same_register(source, target):
+            for delta, op in [(-1, s.Add), (1, s.Sub)]:
+                shifted = magnitude + delta
+                if shifted & (shifted - 1) == 0 and shifted > 2:
+                    shift = s.Shl(s.Immediate(shifted.bit_length() - 1), target)
+                    code = copy + [shift, op(source, target)]
+                    candidates.append(prepare + code + negate + finish)
+        if s.fits_imm32(factor):
+            # imul takes its operand from memory too
+            if isinstance(left, s.Address) and work is size:
+                imul = [s.Imul(left, target, factor=s.Immediate(factor))]
+            else:
+                imul = prepare + [s.Imul(source, target, factor=s.Immediate(factor))]
+            candidates.append(imul + finish)
+        if not candidates:
+            return self.multiply(left, s.Immediate(factor), dest, size)
+        return self.cheapest(candidates)
+
+    def shift(self, op, left, right, dest, size):
+        work = wide(size)
+        arithmetic = op == ">>"
+        cls = s.Sar if arithmetic else s.Shl
+        if isinstance(right, s.Immediate):
+            target = self.target(dest, work)
+            code = load(left, target, size, extend=arithmetic)
+            count = right.value & (63 if size is QUAD else 31)
+            finish = store(target, dest, size)
+            if not count:
+                return code + finish
+            candidates = [code + [cls(s.Immediate(count), target)] + finish]
+            if self.idioms and not arithmetic and count == 1:
+                if isinstance(left, s.Register) and isinstance(dest, s.Register):
+                    base = left.with_size(QUAD)
+                    lea = s.Lea(s.Address(base, 0, base, 1), target)
+                    candidates.append([lea] + finish)
+            return self.cheapest(candidates)
+        # The count has to be in CL
+        count = s.Register.cl
+        if (
+            isinstance(dest, s.Register)
+            and not same_register(dest, right)
+            and not same_register(dest, count)
+        ):
+            target = dest.with_size(work)
+        else:
+            target = scratch.with_size(work)
+        code = load(left, target, size, extend=arithmetic)
+        if not same_register(right, count):
+            code.append(s.Mov(right, count.with_size(size)))
+        code.append(cls(count, target, work))
+        return code + store(target, dest, size)
+
+    def idiv(self, left, right, dest, size, remainder):
+        work = wide(size)
+        rax = scratch.with_size(work)
+        code = load(left, rax, size, extend=True)
+        if isinstance(right, s.Immediate):
+            divisor = spare.with_size(work)
+            code.append(s.Mov(right, divisor))
+        elif work is not size:
+            divisor = spare.with_size(work)
+            code.extend(load(right, divisor, size, extend=True))
+        elif same_register(right, s.Register.rdx):
+            # cltd overwrites it
+            divisor = spare.with_size(work)
+            code.append(s.Mov(right, divisor))
+        else:
+            divisor = right
+        code.append(s.Cqto() if work is QUAD else s.Cltd())
+        code.append(s.Idiv(divisor, work))
+        result = s.Register.rdx if remainder else scratch
+        return code + store(result, dest, size)
+
+    def divide_by_power(self, left, divisor, dest, size, remainder):
+        """
+        Truncating division by a power of two: add 2^k - 1 to negative
+        dividends, then shift. The remainder is what the shift drops, less
+        the same bias.
+        """
+        magnitude = abs(divisor)
+        power = magnitude.bit_length() - 1
+        eax, bias = scratch.with_size(DOUBLE), spare.with_size(DOUBLE)
+        code = load(left, eax, size, extend=True)
+        code.append(s.Mov(eax, bias))
+        if power > 1:
+            code.append(s.Sar(s.Immediate(31), bias))
+        code.append(s.Shr(s.Immediate(32 - power), bias))
+        code.append(s.Add(bias, eax))
+        if remainder:
+            code.append(s.And(s.Immediate(magnitude - 1), eax))
+            code.append(s.Sub(bias, eax))
+        else:
+            code.append(s.Sar(s.Immediate(power), eax))
+            if divisor < 0:
+                code.append(s.Neg(eax))
+        return code + store(eax, dest, size)
+
+    def divide_by_magic(self, left, divisor, dest, size, remainder):
+        """
+        Truncating division by any other constant: multiply by its magic
+        number in 64 bits and keep the high bits. The remainder is the
+        dividend less the quotient times the divisor.
+        """
+        magnitude = abs(divisor)
+        multiplier, shift = magic(magnitude)
+        rax, eax = scratch, scratch.with_size(DOUBLE)
+        code = load(left, rax, size, extend=True)
+        if s.fits_imm32(multiplier):
+            code.append(s.Imul(rax, rax, factor=s.Immediate(multiplier)))
+        else:
+            code.append(s.Mov(s.Immediate(multiplier), spare.with_size(DOUBLE)))
+            code.append(s.Imul(spare, rax))
+        code.extend(
+            [
+                s.Mov(rax, spare),
+                s.Sar(s.Immediate(shift), rax),
+                s.Shr(s.Immediate(63), spare),
+                s.Add(spare.with_size(DOUBLE), eax),
+            ]
+        )
+        if remainder:
+            code.append(s.Imul(eax, eax, factor=s.Immediate(-magnitude)))
+            code.append(s.Add(left, eax.with_size(size)))
+        elif divisor < 0:
+            code.append(s.Neg(eax))
+        return code + store(eax, dest, size)
+
+
+def constant(value):
+    """The value of a constant operand, or None."""
+    if isinstance(value, ir.Const):
+        return value.value
+    if isinstance(value, ir.Undef):
+        return 0
+    return None
@@ -0,0 +1,354 @@
+"""
+Loop optimizations over `ir`, at -O1 once the rest has cleaned up.
+
+Loops are found from their back edges, edges to a block that dominates the
+block they come from, and handled innermost first. Each needs a preheader:
+a block outside of it that jumps to its header and nowhere else, which
+irgen always makes for a `while`.
+
+Loads from stack slots that nothing in the loop writes to are hoisted into
+the preheader (loop-invariant code motion). A field's address is its slot
+plus a constant offset, so the load is all there is to hoist. Calls only
+write the slot they return a struct to. Loads of whole structs passed to a
+call are read by the call itself, so they stay where they are. Arithmetic on
+values from outside the loop is hoisted too, unless it is a division that
+could fault: in the preheader it runs even when the loop body never does.
+
+At -O2, multiplying a counter by a constant, where the counter goes up or
+down by a constant every iteration, becomes a second counter going up or
+down by their product (strength reduction): an add instead of a multiply.
+
+Innermost loops that only exit from their header can also be unrolled: the
+header and body are copied so that one trip around the loop runs several
+iterations, each still testing the condition. Every copy but the last falls
+through into the next, which saves the jump back to the header.
+"""
+import copy
+
+from .constprop import evaluate
+from . import ir
+
+
+class Loop:
+    def __init__(self, header, blocks):
+        self.header = header
+        self.blocks = blocks
+
+    def latches(self, preds):
+        return [pred for pred in preds[self.header] if pred in self.blocks]
+
+
+def dominates(idom, a, b):
+    while b is not a:
+        if idom[b] is b:
+            return False
+        b = idom[b]
+    return True
+
+
+def find_loops(function):
+    """The natural loops of a function, innermost first."""
+    idom = ir.dominators(function)
+    preds = function.predecessors()
+    loops = {}
+    for block in idom:
+        for succ in block.successors():
+            if not dominates(idom, succ, block):
+                continue
+            blocks = loops.setdefault(succ, {succ})
+            work = [block]
+            while work:
+                member = work.pop()
+                if member not in blocks:
+                    blocks.add(member)
+                    work.extend(pred for pred in preds[member] if pred in idom)
+    found = [Loop(header, blocks) for header, blocks in loops.items()]
+    found.sort(key=lambda loop: len(loop.blocks))
+    return found
+
+
+def preheader(loop, preds):
+    """The block the loop is entered from, if it only jumps to the header."""
+    outside = [pred for pred in preds[loop.header] if pred not in loop.blocks]
+    if len(outside) == 1 and isinstance(outside[0].terminator, ir.Jump):
+        return outside[0]
+    return None
+
+
+def hoist_invariants(function, loop, before):
+    """
+    Move loads from slots the loop doesn't write, and arithmetic that can't
+    fault on values from outside the loop, to the end of the block before
+    it. Returns how many were moved.
+    """
+    written = set()
+    # Whether something could write to any slot
+    clobbered = False
+    for block in loop.blocks:
+        for inst in block.instructions:
+            if isinstance(inst, ir.Store):
+                written.add(inst.address)
+            elif isinstance(inst, (ir.Copy, ir.Call)):
+                written.add(inst.dest)
+            elif inst.writes_memory:
+                clobbered = True
+    inside = {inst for block in loop.blocks for inst in block.instructions}
+    hoisted = []
+    for block in function.blocks:
+        if block not in loop.blocks:
+            continue
+        kept = []
+        for inst in block.instructions:
+            if isinstance(inst, ir.Load):
+                invariant = (
+                    not clobbered
+                    and inst.type.size() <= 8
+                    and isinstance(inst.address, ir.Alloca)
+                    and inst.address not in written
+                )
+            elif isinstance(inst, ir.BinOp):
+                invariant = not inst.can_trap() and not any(
+                    operand in inside for operand in inst.operands()
+                )
+            else:
+                invariant = False
+            if invariant:
+                hoisted.append(inst)
+                inside.discard(inst)
+            else:
+                kept.append(inst)
+        block.instructions = kept
+    for inst in hoisted:
+        before.insert(len(before.instructions) - 1, inst)
+    return len(hoisted)
+
+
+def counters(loop, before, latch):
+    """
+    Header phis that go up or down by a constant every iteration, mapped to
+    (their value on entry, the constant, the instruction adding it).
+    """
+    found = {}
+    for phi in loop.header.phis():
+        incoming = {pred: value for pred, value in phi.incoming}
+        step = incoming.get(latch)
+        if not isinstance(step, ir.BinOp) or step.block not in loop.blocks:
+            continue
+        if step.operator == "+" and step.right is phi:
+            delta = step.left
+        elif step.operator in ("+", "-") and step.left is phi:
+            delta = step.right
+        else:
+            continue
+        if not isinstance(delta, ir.Const):
+            continue
+        amount = -delta.value if step.operator == "-" else delta.value
+        found[phi] = (incoming[before], amount, step)
+    return found
+
+
+def scaled_counter(inst, found):
+    """(counter, factor) if inst multiplies a counter by a constant."""
+    if not isinstance(inst, ir.BinOp):
+        return None
+    left, right = inst.left, inst.right
+    if inst.operator == "*" and isinstance(left, ir.Const):
+        left, right = right, left
+    if left not in found or not isinstance(right, ir.Const):
+        return None
+    if inst.operator == "*":
+        return left, right.value
+    if inst.operator == "<<":
+        return left, evaluate("<<", 1, right.value, inst.type)
+    return None
+
+
+def reduce_strength(function, loop, before, preds):
+    """
+    Replace products of counters and constants in the loop with counters of
+    their own. Returns how many were replaced.
+    """
+    latches = loop.latches(preds)
+    if len(latches) != 1:
+        return 0
+    (latch,) = latches
+    found = counters(loop, before, latch)
+    reduced = {}
+    replaced = {}
+    for block in function.blocks:
+        if block not in loop.blocks:
+            continue
+        for inst in list(block.instructions):
+            scaled = scaled_counter(inst, found)
+            if scaled is None or inst.type is not scaled[0].type:
+                continue
+            counter, factor = scaled
+            type_ = inst.type
+            key = (counter, type_.wrap(factor))
+            if key not in reduced:
+                start, amount, step = found[counter]
+                if isinstance(start, ir.Const):
+                    value = evaluate("*", start.value, factor, type_)
+                    start = ir.Const(value, type_)
+                else:
+                    start = ir.BinOp("*", start, ir.Const(factor, type_), type_)
+                    before.insert(len(before.instructions) - 1, start)
+                phi = loop.header.insert(0, ir.Phi(type_))
+                increment = ir.Const(evaluate("*", amount, factor, type_), type_)
+                following = ir.BinOp("+", phi, increment, type_)
+                index = step.block.instructions.index(step)
+                step.block.insert(index + 1, following)
+                phi.add_incoming(before, start)
+                phi.add_incoming(latch, following)
+                reduced[key] = phi
+            replaced[inst] = reduced[key]
+            block.instructions.remove(inst)
+    function.replace_uses(replaced)
+    return len(replaced)
+
+
+def clone(inst):
+    new = copy.copy(inst)
+    new.block = None
+    if isinstance(inst, ir.Phi):
+        new.incoming = [list(pair) for pair in inst.incoming]
+    return new
+
+
+def unrollable(function, loop, preds):
+    """The block the loop exits to, if it can be unrolled; otherwise None."""
+    header = loop.header
+    if not isinstance(header.terminator, ir.Branch):
+        return None
+    if len(loop.latches(preds)) != 1:
+        return None
+    exits = [succ for succ in header.successors() if succ not in loop.blocks]
+    if len(exits) != 1 or len(preds[exits[0]]) != 1:
+        return None
+    for block in loop.blocks:
+        if block is header:
+            continue
+        if next(block.phis(), None) is not None:
+            return None
+        if any(succ not in loop.blocks for succ in block.successors()):
+            return None
+    return exits[0]
+
+
+def unroll(function, loop, factor):
+    """
+    Chain factor - 1 copies of the loop's blocks after it. Returns whether
+    the loop could be unrolled.
+    """
+    preds = function.predecessors()
+    exit = unrollable(function, loop, preds)
+    if exit is None:
+        return False
+    header = loop.header
+    (latch,) = loop.latches(preds)
+    order = [block for block in function.blocks if block in loop.blocks]
+    phis = list(header.phis())
+    from_latch = {}
+    for phi in phis:
+        for pred, value in phi.incoming:
+            if pred is latch:
+                from_latch[phi] = value
+
+    # Header values used after the loop get a phi in the exit block, merging
+    # the header's and the copies' versions
+    outside = set()
+    for block in function.blocks:
+        if block in loop.blocks:
+            continue
+        for inst in block.instructions:
+            if isinstance(inst, ir.Phi) and block is exit:
+                continue
+            outside.update(inst.operands())
+    escaping = [inst for inst in header.instructions if inst in outside]
+    merges = {}
+    for inst in escaping:
+        merge = merges[inst] = exit.insert(0, ir.Phi(inst.type))
+        merge.add_incoming(header, inst)
+    exit_phis = [phi for phi in exit.phis() if phi not in merges.values()]
+    for block in function.blocks:
+        if block in loop.blocks:
+            continue
+        for inst in block.instructions:
+            if not (block is exit and isinstance(inst, ir.Phi)):
+                inst.replace_operands(merges)
+
+    entry_values = dict(from_latch)
+    headers = [header]
+    latches = [latch]
+    position = function.blocks.index(order[-1]) + 1
+    for _ in range(factor - 1):
+        blocks = {block: function.new_block(append=False) for block in order}
+        values = {}
+        for block in order:
+            for inst in block.instructions:
+                if block is header and isinstance(inst, ir.Phi):
+                    values[inst] = entry_values[inst]
+                    continue
+                values[inst] = blocks[block].append(clone(inst))
+        for block in order:
+            for inst in blocks[block].instructions:
+                inst.replace_operands(values)
+                inst.replace_successors(blocks)
+        copy_header = blocks[header]
+        headers.append(copy_header)
+        latches.append(blocks[latch])
+        for phi in exit_phis:
+            for pred, value in list(phi.incoming):
+                if pred is header:
+                    phi.add_incoming(copy_header, values.get(value, value))
+        for inst, merge in merges.items():
+            merge.add_incoming(copy_header, values[inst])
+        entry_values = {
+            phi: values.get(value, value) for phi, value in from_latch.items()
+        }
+        new_blocks = [blocks[block] for block in order]
+        function.blocks[position:position] = new_blocks
+        position += len(new_blocks)
+
+    # Each latch (jumping to its own header so far) goes on to the next
+    # copy, and the last one back around
+    for i, block in enumerate(latches):
+        following = headers[(i + 1) % len(headers)]
+        block.terminator.replace_successors({headers[i]: following})
+    for phi in phis:
+        for pair in phi.incoming:
+            if pair[0] is latch:
+                pair[0] = latches[-1]
+                pair[1] = entry_values[phi]
+    return True
+
+
+def optimize_loops(
+    function, stats, hoist=True, unroll_factor=1, strength_reduction=False
+):
+    """
+    Hoist invariant loads and arithmetic, strength-reduce multiplications of
+    counters if asked to, then unroll innermost loops unroll_factor times.
+    What was done is counted in stats.
+    """
+    loops = find_loops(function)
+    if hoist or strength_reduction:
+        preds = function.predecessors()
+        for loop in loops:
+            before = preheader(loop, preds)
+            if before is None:
+                continue
+            if hoist:
+                stats["hoisted"] += hoist_invariants(function, loop, before)
+            if strength_reduction:
+                stats["strength_reduced"] += reduce_strength(
+                    function, loop, before, preds
+                )
+    if unroll_factor > 1:
+        # Unrolling doesn't touch the blocks of other innermost loops
+        headers = {loop.header for loop in loops}
+        for loop in loops:
+            if any(b in headers for b in loop.blocks if b is not loop.header):
+                continue
+            if unroll(function, loop, unroll_factor):
+                stats["unrolled"] += 1
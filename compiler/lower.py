@@ -0,0 +1,649 @@
+"""
+Lowering of `ir` to `asm`.
+
+A Load is folded into the instruction using it when nothing can write memory
+in between. Every other value is put where `regalloc` says, a register or a
+stack slot. RAX is the scratch register, and R11 breaks cycles between phis.
+
+A Branch to a block with phis gets a block of its own for the moves into
+them, so that they only happen on that edge.
+
+With omit_frame_pointer, RBP is a register like the others and the frame is
+addressed from RSP; see `frame`.
+
+Arguments come in where `abi` says. Those in one register are values like any
+other; those split over two registers or passed on the stack are only ever
+stored to their Alloca, which irgen does before anything else.
+
+Calls pass arguments the same way. One larger than 8 bytes is always a folded
+Load, copied from its slot to the stack or loaded into its two registers. The
+registers are all set at once, as phis are. Values that live across the call
+in caller-saved registers are saved to their slots first and restored after.
+With tail_calls, a call whose value is returned right away and that has no
+arguments on the stack jumps to the callee once this function's frame is
+gone, so the callee returns straight to our caller. "Right away" allows for
+jumps and phis on the way to the Return, as inlining leaves them, and for a
+struct returned in registers, the loads of it from where the call put it.
+
+Arithmetic is left to an `isel.Selector`, once the operands' homes are known.
+"""
+from .abi import (
+    argument_locations,
+    eightbytes,
+    in_memory,
+    register_width,
+    return_registers,
+)
+from .isel import Selector
+from .memcopy import copy_memory, pushes
+from .regalloc import allocate
+from .types_ import Pointer, align
+from . import asm as s
+from . import frame
+from . import ir
+
+scratch = s.Register.rax
+# Neither an argument nor a return register
+cycle_register = s.Register.r11
+frame_pointer = s.Register.rbp
+# Where the caller's frame starts, past the saved RBP and the return address
+ARGUMENTS_OFFSET = 16
+
+
+def operand_size(type_):
+    """
+    The size of a register holding a value of type_. Values of other sizes
+    than 1, 2, 4 and 8 bytes are loaded with a wider move; the bytes past the
+    end are in the same frame and the ABI doesn't care what they are.
+    """
+    return register_width(type_.size())
+
+
+def split_edges(function):
+    """
+    Put a block on every edge from a Branch to a block with phis, for the
+    phi moves. It goes right before the target, so it falls through.
+    """
+    for block in list(function.blocks):
+        terminator = block.terminator
+        if not isinstance(terminator, ir.Branch):
+            continue
+        for target in set(terminator.successors()):
+            if next(target.phis(), None) is None:
+                continue
+            edge = function.new_block(append=False)
+            edge.append(ir.Jump(target))
+            function.blocks.insert(function.blocks.index(target), edge)
+            terminator.replace_successors({target: edge})
+            for phi in target.phis():
+                for pair in phi.incoming:
+                    if pair[0] is block:
+                        pair[0] = edge
+
+
+class Lowering:
+    def __init__(
+        self,
+        function,
+        regalloc_log=None,
+        omit_frame_pointer=False,
+        tail_calls=False,
+        selector=None,
+    ):
+        self.function = function
+        self.regalloc_log = regalloc_log
+        self.omit_frame_pointer = omit_frame_pointer
+        self.tail_calls = tail_calls
+        self.selector = selector or Selector(idioms=False)
+        # What slots and arguments on the stack are addressed from, set once
+        # the frame is laid out
+        self.base = frame_pointer
+        self.arguments_offset = ARGUMENTS_OFFSET
+        self.alignments = {frame_pointer: 16}
+        # How far RSP is below where it was after the prologue, while the
+        # stack arguments of a call are set up
+        self.stack_adjust = 0
+        self.frame_size = 0
+        # Calls that become jumps, and the Returns they replace
+        self.tail_returns = {}
+        self.allocation = None
+        self.name = function.name
+        self.instructions = []
+        self.slots = {}
+        self.folded = set()
+        self.need_end_label = False
+        self.preds = function.predecessors()
+        incoming = function.incoming()
+        types = [param.type for param in incoming]
+        self.locations = dict(zip(incoming, argument_locations(types)))
+
+    def end_label(self):
+        self.need_end_label = True
+        return f"{self.name}.end"
+
+    def label(self, block):
+        return f"{self.name}.{block.name}"
+
+    def find_folded_loads(self):
+        """
+        Loads used once, later in the same block, with no store between, and
+        every Load of something larger than a register.
+        """
+        users = {}
+        for inst in self.function.instructions():
+            for operand in inst.operands():
+                users.setdefault(operand, []).append(inst)
+        for block in self.function.blocks:
+            pending = set()
+            for inst in block.instructions:
+                for operand in inst.operands():
+                    if operand in pending:
+                        self.folded.add(operand)
+                        pending.discard(operand)
+                if inst.writes_memory or isinstance(inst, ir.Phi):
+                    pending.clear()
+                if isinstance(inst, ir.Load):
+                    if inst.type.size() > 8:
+                        self.folded.add(inst)
+                        continue
+                    user = users.get(inst, [])
+                    if len(user) == 1 and user[0].block is block:
+                        pending.add(inst)
+
+    def is_leaf(self):
+        """Whether nothing is called or pushed, which would clobber the red zone."""
+        for inst in self.function.instructions():
+            if isinstance(inst, ir.Call):
+                return False
+            if isinstance(inst, ir.Copy) and pushes(inst.type.size()):
+                return False
+            if isinstance(inst, ir.Store) and pushes(inst.value.type.size()):
+                return False
+        return True
+
+    def assign_slots(self):
+        """Frame offsets for Allocas and for values kept in memory."""
+        self.slots, frame_size = frame.layout(
+            self.function,
+            self.allocation,
+            self.folded,
+            frame_pointer=not self.omit_frame_pointer,
+            red_zone=self.omit_frame_pointer and self.is_leaf(),
+        )
+        if self.omit_frame_pointer:
+            saved = 8 * len(self.allocation.callee_saved)
+            self.base = s.Register.rsp
+            # Past the frame, the saved registers and the return address
+            self.arguments_offset = frame_size + saved + 8
+            # RSP is only known to be aligned once it has been moved
+            self.alignments = {s.Register.rsp: 16} if frame_size else {}
+        return frame_size
+
+    def allocate_registers(self):
+        values = set()
+        preferred = {}
+        for param, location in self.locations.items():
+            if len(location.registers) == 1:
+                values.add(param)
+                preferred[param] = location.registers[0]
+        clobbers = {}
+        for inst in self.function.instructions():
+            if inst.has_value and not isinstance(inst, ir.Alloca):
+                if inst not in self.folded:
+                    values.add(inst)
+            if isinstance(inst, ir.BinOp):
+                regs = self.selector.clobbers(inst)
+                if regs:
+                    clobbers[inst] = regs
+        self.allocation = allocate(
+            self.function,
+            values,
+            preferred,
+            frame_pointer_free=self.omit_frame_pointer,
+            tail_calls=self.tail_returns,
+            clobbers=clobbers,
+        )
+        if self.regalloc_log is not None:
+            print(self.allocation.format(self.function), file=self.regalloc_log)
+
+    def operand(self, value):
+        if isinstance(value, ir.Const):
+            return s.Immediate(value.value)
+        if isinstance(value, ir.Undef):
+            return s.Immediate(0)
+        if value in self.folded:
+            return self.address(value.address, value.offset)
+        reg = self.allocation.registers.get(value)
+        if reg is not None:
+            return reg.with_size(operand_size(value.type))
+        location = self.locations.get(value)
+        if location is not None and location.stack_offset is not None:
+            return self.frame_address(self.arguments_offset + location.stack_offset)
+        return self.frame_address(self.slots[value])
+
+    def param_register(self, param):
+        return self.locations[param].registers[0].with_size(operand_size(param.type))
+
+    def frame_address(self, offset):
+        if self.base is s.Register.rsp:
+            offset += self.stack_adjust
+        return s.Address(self.base, offset)
+
+    def address(self, alloca, offset):
+        return self.frame_address(self.slots[alloca] + offset)
+
+    def move(self, src, dest, size):
+        """A move that goes through the scratch register if needed."""
+        if isinstance(dest, s.Address) and (
+            isinstance(src, s.Address)
+            or isinstance(src, s.Immediate)
+            and not s.fits_imm32(src.value)
+        ):
+            reg = scratch.with_size(size)
+            self.instructions.append(s.Mov(src, reg, size=size))
+            src = reg
+        self.instructions.append(s.Mov(src, dest, size=size))
+
+    def lower(self):
+        self.find_folded_loads()
+        if self.tail_calls:
+            self.find_tail_calls()
+        self.allocate_registers()
+        frame_size = self.frame_size = self.assign_slots()
+        saved = self.allocation.callee_saved
+        if self.omit_frame_pointer:
+            self.instructions = [s.Push(reg) for reg in saved]
+            if frame_size:
+                self.instructions.append(s.Sub(s.Immediate(frame_size), s.Register.rsp))
+        else:
+            self.instructions = [
+                s.Push(frame_pointer),
+                s.Mov(s.Register.rsp, frame_pointer),
+                s.Sub(s.Immediate(frame_size), s.Register.rsp),
+            ]
+            self.instructions.extend(s.Push(reg) for reg in saved)
+        for param, location in self.locations.items():
+            if len(location.registers) != 1:
+                continue
+            if param in self.slots or param in self.allocation.registers:
+                # Unless it stays where it was passed
+                home = self.operand(param)
+                if home is not self.param_register(param):
+                    self.instructions.append(s.Mov(self.param_register(param), home))
+        blocks = self.function.blocks
+        for i, block in enumerate(blocks):
+            following = blocks[i + 1] if i + 1 < len(blocks) else None
+            if i > 0 and self.preds[block]:
+                self.instructions.append(s.Label(self.label(block)))
+            for inst in block.instructions:
+                self.lower_instruction(inst, block, following)
+                if inst in self.tail_returns:
+                    # The rest of the block only leads to the Return
+                    break
+        if self.need_end_label:
+            self.instructions.append(s.Label(self.end_label()))
+        # Not after a jump out of the last block, where it can't be reached
+        last = self.instructions[-1] if self.instructions else None
+        if self.need_end_label or type(last) is not s.Jmp:
+            self.epilogue()
+            self.instructions.append(s.Ret())
+        return s.Block(label=self.name, instructions=self.instructions)
+
+    def epilogue(self):
+        """Undo the prologue, up to the return."""
+        if self.omit_frame_pointer and self.frame_size:
+            self.instructions.append(
+                s.Add(s.Immediate(self.frame_size), s.Register.rsp)
+            )
+        saved = self.allocation.callee_saved
+        self.instructions.extend(s.Pop(reg) for reg in reversed(saved))
+        if not self.omit_frame_pointer:
+            self.instructions.append(s.Leave())
+
+    def lower_instruction(self, inst, block, following):
+        if isinstance(inst, (ir.Alloca, ir.Phi)):
+            pass
+        elif isinstance(inst, ir.Load):
+            if inst not in self.folded:
+                self.move(
+                    self.address(inst.address, inst.offset),
+                    self.operand(inst),
+                    operand_size(inst.type),
+                )
+        elif isinstance(inst, ir.Store):
+            self.store(inst.value, self.address(inst.address, inst.offset))
+        elif isinstance(inst, ir.Copy):
+            self.copy(inst)
+        elif isinstance(inst, ir.BinOp):
+            self.instructions.extend(
+                self.selector.select(
+                    inst,
+                    self.operand(inst.left),
+                    self.operand(inst.right),
+                    self.operand(inst),
+                    operand_size(inst.type),
+                )
+            )
+        elif isinstance(inst, ir.Call):
+            self.call(inst)
+        elif isinstance(inst, ir.Jump):
+            self.phi_moves(block, inst.target)
+            if inst.target is not following:
+                self.instructions.append(s.Jmp(self.label(inst.target)))
+        elif isinstance(inst, ir.Branch):
+            self.branch(inst, following)
+        elif isinstance(inst, ir.Return):
+            for value, reg in zip(inst.values, return_registers):
+                reg = reg.with_size(operand_size(value.type))
+                self.instructions.append(s.Mov(self.operand(value), reg))
+            if following is not None:
+                self.instructions.append(s.Jmp(self.end_label()))
+        else:
+            raise NotImplementedError(type(inst))
+
+    def branch(self, inst, following):
+        cond = self.operand(inst.cond)
+        if isinstance(cond, s.Immediate):
+            target = inst.if_true if cond.value else inst.if_false
+            if target is not following:
+                self.instructions.append(s.Jmp(self.label(target)))
+            return
+        if isinstance(cond, s.Register):
+            self.instructions.append(s.Test(cond, cond))
+        else:
+            size = operand_size(inst.cond.type)
+            self.instructions.append(s.Cmp(s.Immediate(0), cond, size=size))
+        if inst.if_false is following:
+            self.instructions.append(s.Jcc("ne", self.label(inst.if_true)))
+        else:
+            self.instructions.append(s.Jcc("e", self.label(inst.if_false)))
+            if inst.if_true is not following:
+                self.instructions.append(s.Jmp(self.label(inst.if_true)))
+
+    def store(self, value, dest):
+        size = value.type.size()
+        location = self.locations.get(value)
+        if location is not None and len(location.registers) > 1:
+            for i, (reg, part) in enumerate(zip(location.registers, eightbytes(size))):
+                self.store_register(reg, dest.with_offset(8 * i), part)
+        elif size in (1, 2, 4, 8):
+            self.move(self.operand(value), dest, operand_size(value.type))
+        elif location is not None and location.stack_offset is not None:
+            self.instructions.extend(
+                copy_memory(self.operand(value), dest, size, self.alignments)
+            )
+        else:
+            width = operand_size(value.type)
+            self.move(self.operand(value), scratch.with_size(width), width)
+            self.store_register(scratch, dest, size)
+
+    def store_register(self, reg, dest, size):
+        """Store the low size bytes of reg, which is clobbered if size is odd."""
+        if size in (1, 2, 4, 8):
+            width = s.Size.from_byte_size(size)
+            self.instructions.append(s.Mov(reg.with_size(width), dest))
+            return
+        if reg is not scratch:
+            self.instructions.append(s.Mov(reg, scratch))
+        offset = 0
+        for width in (4, 2, 1):
+            if size - offset < width:
+                continue
+            size_ = s.Size.from_byte_size(width)
+            self.instructions.append(
+                s.Mov(scratch.with_size(size_), dest.with_offset(offset))
+            )
+            offset += width
+            if offset < size:
+                self.instructions.append(s.Shr(s.Immediate(8 * width), scratch))
+
+    def copy(self, inst):
+        src = self.address(inst.src, inst.src_offset)
+        if isinstance(inst.dest, ir.Alloca):
+            dest = self.address(inst.dest, inst.dest_offset)
+        else:
+            # Through a pointer, the return pointer for now
+            base = self.operand(inst.dest)
+            if isinstance(base, s.Address):
+                self.instructions.append(s.Mov(base, cycle_register))
+                base = cycle_register
+            dest = s.Address(base, inst.dest_offset)
+        self.instructions.extend(
+            copy_memory(src, dest, inst.type.size(), self.alignments)
+        )
+
+    def find_tail_calls(self):
+        """
+        Calls with no arguments on the stack whose result is returned right
+        after. Each is mapped to its Return.
+        """
+        for inst in self.function.instructions():
+            if isinstance(inst, ir.Call) and not call_arguments(inst)[3]:
+                following = self.returned_by(inst)
+                if following is not None:
+                    self.tail_returns[inst] = following
+
+    def returned_by(self, call):
+        """
+        The Return that returns what call returned, if nothing else happens
+        on the way there: the call's block ends with it or jumps to it, through
+        blocks of nothing but phis and a jump.
+        """
+        block = call.block
+        rest = block.instructions[block.instructions.index(call) + 1 :]
+        if call.dest is None:
+            results = [call]
+        elif call.dest is self.function.return_pointer:
+            # RAX gets it back from the callee
+            results = [call.dest]
+        elif not in_memory(call.type):
+            # Returned in registers and stored to dest, from where it's loaded
+            # to be returned in the same registers
+            parts = eightbytes(call.type.size())
+            results = rest[: len(parts)]
+            for i, (load, part) in enumerate(zip(results, parts)):
+                if not (
+                    isinstance(load, ir.Load)
+                    and load.address is call.dest
+                    and load.offset == call.dest_offset + 8 * i
+                    and load.type.size() == part
+                ):
+                    return None
+            rest = rest[len(parts) :]
+        else:
+            return None
+        seen = set()
+        while len(rest) == 1 and block not in seen:
+            seen.add(block)
+            terminator = rest[0]
+            if isinstance(terminator, ir.Return):
+                return terminator if terminator.values == results else None
+            if not isinstance(terminator, ir.Jump):
+                return None
+            target = terminator.target
+            passed = {}
+            for phi in target.phis():
+                for pred, value in phi.incoming:
+                    if pred is block:
+                        passed.setdefault(value, phi)
+            results = [passed.get(value, value) for value in results]
+            block = target
+            rest = [i for i in target.instructions if not isinstance(i, ir.Phi)]
+        return None
+
+    def call(self, inst):
+        arguments, types, locations, stack_size = call_arguments(inst)
+        hidden = inst.dest is not None and in_memory(inst.type)
+        tail_return = self.tail_returns.get(inst)
+        saves = []
+        if tail_return is None:
+            for value in self.allocation.saves.get(inst, ()):
+                reg = self.allocation.registers[value]
+                saves.append((reg, self.frame_address(self.slots[value])))
+        for reg, slot in saves:
+            self.instructions.append(s.Mov(reg, slot))
+
+        if stack_size:
+            self.instructions.append(s.Sub(s.Immediate(stack_size), s.Register.rsp))
+            self.stack_adjust += stack_size
+        # RSP is 16-byte aligned at the call
+        alignments = {**self.alignments, s.Register.rsp: 16}
+        moves = []
+        pointer = None
+        for value, type_, location in zip(arguments, types, locations):
+            size = type_.size()
+            if location.stack_offset is not None:
+                dest = s.Address(s.Register.rsp, location.stack_offset)
+                if size > 8:
+                    self.instructions.extend(
+                        copy_memory(self.operand(value), dest, size, alignments)
+                    )
+                else:
+                    self.move(self.operand(value), dest, operand_size(type_))
+            elif value is inst.dest and isinstance(value, ir.Alloca):
+                # Reads no register, so it can go after the others
+                pointer = s.Lea(
+                    self.address(value, inst.dest_offset), location.registers[0]
+                )
+            elif size > 8:
+                src = self.operand(value)
+                parts = eightbytes(size)
+                for i, (reg, part) in enumerate(zip(location.registers, parts)):
+                    reg = reg.with_size(register_width(part))
+                    moves.append((src.with_offset(8 * i), reg))
+            else:
+                reg = location.registers[0].with_size(operand_size(type_))
+                moves.append((self.operand(value), reg))
+        self.parallel_moves(moves)
+        if pointer is not None:
+            self.instructions.append(pointer)
+
+        if tail_return is not None:
+            self.epilogue()
+            self.instructions.append(s.Jmp(inst.function))
+            return
+        self.instructions.append(s.Call(inst.function))
+        if stack_size:
+            self.instructions.append(s.Add(s.Immediate(stack_size), s.Register.rsp))
+            self.stack_adjust -= stack_size
+
+        if inst.dest is None:
+            size = operand_size(inst.type)
+            self.move(return_registers[0].with_size(size), self.operand(inst), size)
+        elif not hidden:
+            dest = self.address(inst.dest, inst.dest_offset)
+            parts = eightbytes(inst.type.size())
+            for i, (reg, part) in enumerate(zip(return_registers, parts)):
+                self.store_register(reg, dest.with_offset(8 * i), part)
+        for reg, slot in saves:
+            self.instructions.append(s.Mov(slot, reg))
+
+    def parallel_moves(self, moves):
+        """
+        (src, register) moves done as if all at once: no register is written
+        before every move reading it has been done. Cycles are broken with
+        the spare register.
+        """
+        moves = [(src, reg) for src, reg in moves if src is not reg]
+        while moves:
+            for i, (_, reg) in enumerate(moves):
+                written = s.RegisterFamily.for_register(reg)
+                others = moves[:i] + moves[i + 1 :]
+                if not any(reads_family(src, written) for src, _ in others):
+                    break
+            else:
+                # Only cycles are left: move one register out of the way
+                _, reg = moves[0]
+                written = s.RegisterFamily.for_register(reg)
+                self.instructions.append(
+                    s.Mov(reg.with_size(s.Size.quad_word), cycle_register)
+                )
+                moves = [
+                    (
+                        cycle_register.with_size(src.size())
+                        if reads_family(src, written)
+                        else src,
+                        dest,
+                    )
+                    for src, dest in moves
+                ]
+                continue
+            src, reg = moves.pop(i)
+            self.instructions.append(s.Mov(src, reg))
+
+    def phi_moves(self, block, target):
+        """Copy the incoming values into the target's phis, all at once."""
+        moves = [
+            (phi, value)
+            for phi in target.phis()
+            for pred, value in phi.incoming
+            if pred is block and value is not phi
+        ]
+        spare = None
+        while moves:
+            sources = {value for _, value in moves}
+            for i, (phi, value) in enumerate(moves):
+                if phi not in sources:
+                    break
+            else:
+                # Only cycles are left, break one with the spare register
+                phi, value = moves[0]
+                size = operand_size(value.type)
+                spare = cycle_register.with_size(size)
+                self.move(self.operand(value), spare, size)
+                moves = [(p, spare if v is value else v) for p, v in moves]
+                continue
+            del moves[i]
+            src = value if value is spare else self.operand(value)
+            self.move(src, self.operand(phi), operand_size(phi.type))
+
+
+def call_arguments(call):
+    """
+    The arguments of a call, the hidden return pointer first if there is one,
+    with their types and `abi` locations, and the stack space they take.
+    """
+    arguments = call.arguments
+    types = [value.type for value in arguments]
+    if call.dest is not None and in_memory(call.type):
+        arguments = [call.dest] + arguments
+        types.insert(0, Pointer(call.type))
+    locations = argument_locations(types)
+    stack_size = frame.align_stack(
+        max(
+            (
+                location.stack_offset + align(type_.size(), 8)
+                for type_, location in zip(types, locations)
+                if location.stack_offset is not None
+            ),
+            default=0,
+        )
+    )
+    return arguments, types, locations, stack_size
+
+
+def reads_family(operand, family):
+    """Whether operand is a register of family or an address based on one."""
+    if isinstance(operand, s.Address):
+        operand = operand.register
+    return (
+        isinstance(operand, s.Register)
+        and s.RegisterFamily.for_register(operand) is family
+    )
+
+
+def lower(
+    function,
+    regalloc_log=None,
+    omit_frame_pointer=False,
+    tail_calls=False,
+    selector=None,
+):
+    """
+    The `asm.Block` for an IR function. The register allocation is printed
+    to regalloc_log if one is given.
+    """
+    split_edges(function)
+    return Lowering(
+        function, regalloc_log, omit_frame_pointer, tail_calls, selector
+    ).lower()
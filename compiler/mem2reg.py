@@ -0,0 +1,147 @@
+"""
+Promotion of scalar stack slots to SSA values.
+
+An Alloca qualifies when it holds an integer and is only ever loaded or
+stored whole. Phis go on the iterated dominance frontier of the blocks that
+store to it, and a walk over the dominator tree replaces each Load with the
+value of the nearest Store above it (Cytron et al.).
+"""
+from . import ir
+
+
+def promotable(alloca, uses):
+    if not ir.is_scalar(alloca.allocated_type):
+        return False
+    size = alloca.allocated_type.size()
+    for inst in uses:
+        if isinstance(inst, ir.Load):
+            ok = inst.offset == 0 and inst.type.size() == size
+        elif isinstance(inst, ir.Store):
+            ok = (
+                inst.value is not alloca
+                and inst.offset == 0
+                and inst.type.size() == size
+            )
+        else:
+            ok = False
+        if not ok:
+            return False
+    return True
+
+
+def dominator_tree(idom):
+    children = {block: [] for block in idom}
+    for block, parent in idom.items():
+        if block is not parent:
+            children[parent].append(block)
+    return children
+
+
+def place_phis(function, allocas, idom):
+    """Insert empty phis; returns {phi: alloca}."""
+    frontiers = ir.dominance_frontiers(function, idom)
+    def_blocks = {alloca: set() for alloca in allocas}
+    for block in idom:
+        for inst in block.instructions:
+            if isinstance(inst, ir.Store) and inst.address in def_blocks:
+                def_blocks[inst.address].add(block)
+    phis = {}
+    for alloca in allocas:
+        has_phi = set()
+        work = list(def_blocks[alloca])
+        while work:
+            block = work.pop()
+            for frontier in frontiers[block]:
+                if frontier in has_phi:
+                    continue
+                has_phi.add(frontier)
+                phi = frontier.insert(0, ir.Phi(alloca.allocated_type))
+                phis[phi] = alloca
+                if frontier not in def_blocks[alloca]:
+                    work.append(frontier)
+    return phis
+
+
+def mem2reg(function):
+    """Promote what can be promoted. Returns the number of Allocas removed."""
+    uses = {}
+    for inst in function.instructions():
+        for operand in inst.operands():
+            if isinstance(operand, ir.Alloca):
+                uses.setdefault(operand, []).append(inst)
+    allocas = [
+        inst
+        for inst in function.entry.instructions
+        if isinstance(inst, ir.Alloca) and promotable(inst, uses.get(inst, ()))
+    ]
+    if not allocas:
+        return 0
+    promoted = set(allocas)
+
+    idom = ir.dominators(function)
+    phis = place_phis(function, allocas, idom)
+    children = dominator_tree(idom)
+    replacements = {}
+
+    def resolve(value):
+        while value in replacements:
+            value = replacements[value]
+        return value
+
+    def rename_block(block, current):
+        """Rewrite one block; current maps each alloca to its live value."""
+        kept = []
+        for inst in block.instructions:
+            if isinstance(inst, ir.Phi) and inst in phis:
+                current[phis[inst]] = inst
+            elif isinstance(inst, ir.Load) and inst.address in promoted:
+                replacements[inst] = current[inst.address]
+                continue
+            elif isinstance(inst, ir.Store) and inst.address in promoted:
+                current[inst.address] = resolve(inst.value)
+                continue
+            kept.append(inst)
+        block.instructions = kept
+        for succ in block.successors():
+            for phi in succ.phis():
+                if phi in phis:
+                    phi.add_incoming(block, current[phis[phi]])
+
+    initial = {alloca: ir.Undef(alloca.allocated_type) for alloca in allocas}
+    # Iterative walk of the dominator tree, each block seeing the values
+    # left by its immediate dominator
+    stack = [(function.entry, initial)]
+    while stack:
+        block, current = stack.pop()
+        current = dict(current)
+        rename_block(block, current)
+        for child in children[block]:
+            stack.append((child, current))
+    # Unreachable code only sees what it stores itself
+    for block in function.blocks:
+        if block not in idom:
+            rename_block(block, dict(initial))
+
+    function.entry.instructions = [
+        inst for inst in function.entry.instructions if inst not in promoted
+    ]
+    function.replace_uses(replacements)
+    remove_trivial_phis(function)
+    return len(allocas)
+
+
+def remove_trivial_phis(function):
+    """Drop phis whose incoming values are all the same (or the phi itself)."""
+    changed = True
+    while changed:
+        changed = False
+        replacements = {}
+        for block in function.blocks:
+            for phi in list(block.phis()):
+                values = {v for v in phi.operands() if v is not phi}
+                if len(values) == 1:
+                    replacements[phi] = values.pop()
+                    block.instructions.remove(phi)
+        if replacements:
+            function.replace_uses(replacements)
+            changed = True
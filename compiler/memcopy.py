@@ -0,0 +1,106 @@
+"""
+Instructions copying a block of memory, for values too large or too oddly
+sized for a single move.
+
+Below SCALAR_LIMIT bytes the copy goes through RAX, widest moves first. Up to
+SSE_LIMIT bytes it goes 16 bytes at a time through XMM0, with `movdqa` when
+both sides are known to be 16-byte aligned. In both cases the last move may
+overlap bytes already copied, so that the tail takes one move instead of up
+to three. Anything larger is a `rep movsq` followed by one overlapping move
+for the last few bytes; RCX, RSI and RDI are saved on the stack around it.
+
+Source and destination must be either the same bytes or not overlap at all.
+"""
+from . import asm as s
+
+SCALAR_LIMIT = 16
+SSE_LIMIT = 256
+
+scratch = s.Register.rax
+vector_scratch = s.Register.xmm0
+# Registers that `rep movsq` uses, in the order they are pushed
+string_registers = [s.Register.rcx, s.Register.rsi, s.Register.rdi]
+# Alignment of what these registers point to, for the frame pointer because
+# RSP is 16-byte aligned at calls (System V ABI)
+base_alignments = {s.Register.rbp: 16}
+
+
+def pushes(size):
+    """Whether copying size bytes pushes to the stack, below RSP."""
+    return size > SSE_LIMIT
+
+
+def chunks(size, widest):
+    """(offset, width) of the moves copying size bytes, at most widest each."""
+    moves = []
+    offset = 0
+    while offset < size:
+        remaining = size - offset
+        width = widest
+        while width > remaining:
+            width //= 2
+        if offset and width < remaining < widest:
+            # One move overlapping what's been copied instead of several
+            width = min(widest, 1 << (remaining - 1).bit_length())
+            moves.append((size - width, width))
+            break
+        moves.append((offset, width))
+        offset += width
+    return moves
+
+
+def aligned(address, alignments):
+    alignment = alignments.get(address.register, 1)
+    return alignment >= 16 and address.offset % 16 == 0
+
+
+def scalar_move(src, dest, width):
+    size = s.Size.from_byte_size(width)
+    reg = scratch.with_size(size)
+    return [s.Mov(src, reg, size=size), s.Mov(reg, dest, size=size)]
+
+
+def vector_move(src, dest, alignments):
+    if aligned(src, alignments) and aligned(dest, alignments):
+        return [s.Movdqa(src, vector_scratch), s.Movdqa(vector_scratch, dest)]
+    return [s.Movdqu(src, vector_scratch), s.Movdqu(vector_scratch, dest)]
+
+
+def copy_memory(src, dest, size, alignments=base_alignments):
+    """Instructions copying size bytes from the src address to dest."""
+    instructions = []
+    if not pushes(size):
+        widest = 8 if size < SCALAR_LIMIT else 16
+        for offset, width in chunks(size, widest):
+            from_, to = src.with_offset(offset), dest.with_offset(offset)
+            if width == 16:
+                instructions.extend(vector_move(from_, to, alignments))
+            else:
+                instructions.extend(scalar_move(from_, to, width))
+        return instructions
+
+    instructions.extend(s.Push(reg) for reg in string_registers)
+    # Pushing moved RSP, and the addresses could be based on it
+    pushed = 8 * len(string_registers)
+    from_, to = src, dest
+    if src.register is s.Register.rsp:
+        from_ = src.with_offset(pushed)
+    if dest.register is s.Register.rsp:
+        to = dest.with_offset(pushed)
+    # The source address goes through RAX in case it's based on RDI
+    instructions.extend(
+        [
+            s.Lea(from_, scratch),
+            s.Lea(to, s.Register.rdi),
+            s.Mov(scratch, s.Register.rsi),
+            s.Mov(s.Immediate(size // 8), s.Register.ecx),
+            s.RepMovsq(),
+        ]
+    )
+    instructions.extend(s.Pop(reg) for reg in reversed(string_registers))
+    if size % 8:
+        offset = size - 8
+        instructions.extend(
+            scalar_move(src.with_offset(offset), dest.with_offset(offset), 8)
+        )
+    return instructions
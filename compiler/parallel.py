@@ -0,0 +1,212 @@
+"""
+Multi-process build driver behind `-j N`.
+
+The work is split into three steps:
+
+1. Every input file is parsed in a worker process.
+2. The trees are fed to `Compile.declare_file` in input order, in this
+   process, so all types and function signatures end up in one table.
+3. Functions are compiled in workers in contiguous chunks, each chunk carrying
+   a copy of the table as it stood after its file was declared, and the
+   resulting blocks are put back in source order.
+
+Since step 3 returns blocks in the same order `Compile.add_file` would have
+generated them, the program is identical to a serial build.
+
+Phase times recorded by `instrument` in the workers are sent back with their
+results and added up, so they are CPU time across workers rather than wall
+time.
+"""
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from .ast import FunctionDecl
+from .cache import BlockCache, ParseCache
+from .compile import Compile
+from .inline import DEFAULT_THRESHOLD
+from .instrument import phase
+from .parser import parse, read_source
+from . import instrument
+
+_parse_cache = None
+_block_cache = None
+
+
+def _open_cache(cls, settings):
+    if settings is None:
+        return None
+    directory, max_bytes = settings
+    return cls(directory, max_bytes=max_bytes)
+
+
+def _cache_settings(cache):
+    if cache is None:
+        return None
+    return cache.directory, cache.max_bytes
+
+
+def _stats_since(cache, before):
+    if cache is None:
+        return None
+    after = cache.stats()
+    return {k: after[k] - before[k] for k in after}
+
+
+def _compile_options(
+    opt_level,
+    optimize_size,
+    opt_stats,
+    dump_regalloc,
+    inline_threshold,
+    inline_report,
+    unroll,
+    omit_frame_pointer,
+    reorder_fields,
+    reorder_structs,
+    layout_report,
+):
+    """Compile() arguments for the options given to compile_files."""
+    return dict(
+        opt_level=opt_level,
+        optimize_size=optimize_size,
+        report_opt_stats=opt_stats,
+        regalloc_log=sys.stderr if dump_regalloc else None,
+        inline_threshold=inline_threshold,
+        inline_log=sys.stderr if inline_report else None,
+        unroll=unroll,
+        omit_frame_pointer=omit_frame_pointer,
+        reorder_fields=reorder_fields,
+        reorder_structs=reorder_structs,
+        layout_log=sys.stderr if layout_report else None,
+    )
+
+
+def _init_worker(parse_cache, block_cache, instrumented):
+    global _parse_cache, _block_cache
+    _parse_cache = _open_cache(ParseCache, parse_cache)
+    _block_cache = _open_cache(BlockCache, block_cache)
+    if instrumented:
+        instrument.enable()
+
+
+def _instrumentation():
+    """What this worker recorded since the last call, if anything."""
+    recorder = instrument.current()
+    return recorder and recorder.take()
+
+
+def _merge_instrumentation(data):
+    if data is not None:
+        instrument.current().merge(data)
+
+
+def _parse_file(path, backend):
+    with phase("read"):
+        source = read_source(path)
+    before = _parse_cache and _parse_cache.stats()
+    tree = parse(source, backend=backend, cache=_parse_cache)
+    return tree, _stats_since(_parse_cache, before), _instrumentation()
+
+
+def _compile_chunk(table, decls, options):
+    c = Compile(block_cache=_block_cache, **_compile_options(**options))
+    c.types, c.functions, c.function_decls = table
+    before = _block_cache and _block_cache.stats()
+    with phase("compile"):
+        blocks = [c.function_block(decl) for decl in decls]
+    return (
+        blocks,
+        _stats_since(_block_cache, before),
+        c.opt_stats(),
+        _instrumentation(),
+    )
+
+
+def compile_files(
+    paths,
+    jobs,
+    backend="antlr",
+    cache=None,
+    block_cache=None,
+    opt_level=0,
+    optimize_size=False,
+    opt_stats=False,
+    dump_regalloc=False,
+    inline_threshold=DEFAULT_THRESHOLD,
+    inline_report=False,
+    unroll=1,
+    omit_frame_pointer=False,
+    reorder_fields=False,
+    reorder_structs=(),
+    layout_report=False,
+):
+    """
+    Parse and compile paths with a pool of `jobs` processes. Returns the
+    Compile instance, which holds the blocks and the optimization stats
+    (complete only if opt_stats is set, see Compile.function_block).
+    With dump_regalloc and inline_report, workers print register
+    allocations and inlining decisions to stderr; with layout_report, struct
+    layouts are printed as they are declared. If `instrument` is
+    enabled here, it is enabled in the workers too.
+    """
+    options = dict(
+        opt_level=opt_level,
+        optimize_size=optimize_size,
+        opt_stats=opt_stats,
+        dump_regalloc=dump_regalloc,
+        inline_threshold=inline_threshold,
+        inline_report=inline_report,
+        unroll=unroll,
+        omit_frame_pointer=omit_frame_pointer,
+        reorder_fields=reorder_fields,
+        reorder_structs=tuple(reorder_structs),
+        layout_report=layout_report,
+    )
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_worker,
+        initargs=(
+            _cache_settings(cache),
+            _cache_settings(block_cache),
+            instrument.current() is not None,
+        ),
+    ) as pool:
+        trees = []
+        parsed = pool.map(_parse_file, paths, [backend] * len(paths))
+        for tree, stats, recorded in parsed:
+            if stats is not None:
+                cache.merge_stats(stats)
+            _merge_instrumentation(recorded)
+            trees.append(tree)
+
+        c = Compile(block_cache=block_cache, **_compile_options(**options))
+        files = []
+        for tree in trees:
+            with phase("declare"):
+                c.declare_file(tree)
+            # A serial build compiles each file before declaring the next one,
+            # so each file gets the table as it was at that point.
+            decls = [d for d in tree.decls if isinstance(d, FunctionDecl)]
+            table = (dict(c.types), dict(c.functions), dict(c.function_decls))
+            files.append((table, decls))
+
+        # A few chunks per worker keeps them busy when functions differ in size
+        total = sum(len(decls) for _, decls in files)
+        chunk_size = max(1, -(-total // (jobs * 4)))
+        chunks = []
+        futures = []
+        for table, decls in files:
+            for i in range(0, len(decls), chunk_size):
+                chunk = decls[i : i + chunk_size]
+                chunks.append(chunk)
+                futures.append(pool.submit(_compile_chunk, table, chunk, options))
+        for chunk, future in zip(chunks, futures):
+            blocks, stats, opt_stats, recorded = future.result()
+            if stats is not None:
+                block_cache.merge_stats(stats)
+            c.merge_opt_stats(opt_stats)
+            _merge_instrumentation(recorded)
+            for decl, block in zip(chunk, blocks):
+                c.add_block(decl, block)
+
+    return c
@@ -1,104 +1,76 @@
 import io
+import mmap
 import sys
-from antlr4 import CommonTokenStream, InputStream
-from antlr4.error.ErrorListener import ConsoleErrorListener
 from contextlib import redirect_stderr
 
-from . import ast
-
-try:
-    from ._parser.Compiler37Lexer import Compiler37Lexer
-    from ._parser.Compiler37Parser import Compiler37Parser
-    from ._parser.Compiler37Visitor import Compiler37Visitor
-except ImportError:
-    print("Missing _parser module, run `make parser`", file=sys.stderr)
-    raise
+from .instrument import phase
 
 
 class ParseError(Exception):
     pass
 
 
-class RaiseOnSyntaxError(ConsoleErrorListener):
-    def syntaxError(self, *args, **kwargs):
-        captured = io.StringIO()
+BACKENDS = ("antlr", "fast")
+
+
+def read_source(path):
+    """
+    Read a source file through mmap, decoding straight from the mapping.
+    Newlines are translated like text mode would.
+    """
+    with open(path, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                text = str(m, "utf-8")
+        except ValueError:
+            # Empty files can't be mapped
+            text = f.read().decode("utf-8")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def parse(input, backend="antlr", cache=None):
+    """
+    Parse source text into an `ast.File`.
+
+    If a `cache.ParseCache` is given, a tree cached for the same source and
+    backend is returned without running (or even importing) the parser, and
+    the warnings the parser printed when it was cached are printed again.
+    """
+    with phase("parse"):
+        return _parse(input, backend, cache)
+
+
+def _parse(input, backend, cache):
+    if cache is None:
+        return _run_backend(input, backend)
+
+    cached = cache.get(input, backend)
+    if cached is not None:
+        tree, diagnostics = cached
+        sys.stderr.write(diagnostics)
+        return tree
+
+    captured = io.StringIO()
+    try:
         with redirect_stderr(captured):
-            super().syntaxError(*args, **kwargs)
-        raise ParseError(captured.getvalue())
-
-
-class ConvertAST(Compiler37Visitor):
-    def visitProgram(self, ctx):
-        return ast.File([c.accept(self) for c in ctx.decl()])
-
-    def visitVarDecl(self, ctx):
-        return ast.VarDecl(ctx.name.text, ctx.type_.accept(self))
-
-    def visitFunctionDecl(self, ctx):
-        return ast.FunctionDecl(
-            ctx.name.text,
-            ctx.args.accept(self) if ctx.args else [],
-            ctx.return_type.accept(self),
-            [s.accept(self) for s in ctx.body or []],
-            export=True,
-        )
-
-    def visitArg(self, ctx):
-        return ast.FunctionDecl.Arg(ctx.name.text, ctx.type_.accept(self))
-
-    def visitArgList(self, ctx):
-        args = [ctx.car.accept(self)]
-        if ctx.cdr:
-            args.extend(ctx.cdr.accept(self))
-        return args
-
-    def visitStructDecl(self, ctx):
-        return ast.StructDecl(ctx.name.text, fields=ctx.fields.accept(self),)
-
-    def visitStructField(self, ctx):
-        return ast.StructDecl.Field(ctx.name.text, ctx.type_.accept(self))
-
-    def visitStructFieldList(self, ctx):
-        fields = [ctx.car.accept(self)]
-        if ctx.cdr:
-            fields.extend(ctx.cdr.accept(self))
-        return fields
-
-    def visitTypeExpr(self, ctx):
-        if ctx.ID():
-            return ast.NamedTypeExpr(str(ctx.ID()))
-        return ast.ArrayTypeExpr(ctx.element_type().accept(self), int(ctx.length()))
-
-    def visitInteger(self, ctx):
-        return ast.IntExpr(int(ctx.getText()))
-
-    def visitExpr(self, ctx):
-        if ctx.ID():
-            return ast.IdentExpr(str(ctx.ID()))
-        if ctx.integer():
-            return ctx.integer().accept(self)
-        return ctx.expr().accept(self)
-
-    def visitAssign(self, ctx):
-        return ast.AssignStmt(
-            ctx.assignmentTarget().accept(self), ctx.expr().accept(self)
-        )
-
-    def visitAssignmentTarget(self, ctx):
-        target = ctx.assignmentTarget()
-        if target:
-            return ast.FieldAccessExpr(target.accept(self), str(ctx.ID()))
-        return ast.IdentExpr(str(ctx.ID()))
-
-    def visitReturn_(self, ctx):
-        return ast.ReturnStmt(ctx.expr().accept(self))
-
-
-def parse(input):
-    input_stream = InputStream(input)
-    lexer = Compiler37Lexer(input_stream)
-    stream = CommonTokenStream(lexer)
-    parser = Compiler37Parser(stream)
-    parser.removeErrorListener(ConsoleErrorListener.INSTANCE)
-    parser.addErrorListener(RaiseOnSyntaxError())
-    return parser.program().accept(ConvertAST())
+            tree = _run_backend(input, backend)
+    finally:
+        sys.stderr.write(captured.getvalue())
+    cache.put(input, backend, (tree, captured.getvalue()))
+    return tree
+
+
+def _run_backend(input, backend):
+    if backend == "antlr":
+        from .antlr_parser import parse as parse_antlr
+
+        tree = parse_antlr(input)
+    elif backend == "fast":
+        from .rd_parser import parse as parse_fast
+
+        tree = parse_fast(input)
+    else:
+        raise ValueError(f"Unknown parser backend {backend!r}")
+    return tree
@@ -0,0 +1,315 @@
+"""
+Peephole optimization of the instructions in a single `asm.Block`.
+
+A rule is a function taking the instruction list and a position. If it
+matches there, it returns `(n, replacement)` and the n instructions starting
+at that position are replaced; otherwise it returns None. Rules only look
+forward through straight-line code: a label, jump or any instruction they
+don't understand ends the search.
+"""
+from collections import Counter
+
+from . import asm as s
+
+# Registers that may hold the return value when `ret` runs
+return_registers = frozenset(
+    [
+        s.RegisterFamily.for_register(s.Register.rax),
+        s.RegisterFamily.for_register(s.Register.rdx),
+    ]
+)
+
+
+# Instructions that read their destination as well as write it
+read_modify_write = (s.Add, s.Sub, s.And, s.Or, s.Xor)
+# Instructions that set the flags without reading them
+flag_writers = (s.Cmp, s.Test, s.Add, s.Sub, s.And, s.Or, s.Xor, s.Neg)
+
+
+def same_operand(a, b):
+    if isinstance(a, s.Address) and isinstance(b, s.Address):
+        return (
+            a.register is b.register
+            and a.offset == b.offset
+            and a.index is b.index
+            and a.scale == b.scale
+        )
+    if isinstance(a, s.Immediate) and isinstance(b, s.Immediate):
+        return a.value == b.value
+    return a is b
+
+
+def family(operand):
+    if isinstance(operand, s.Register):
+        return s.RegisterFamily.for_register(operand)
+    return None
+
+
+def base_family(operand):
+    if isinstance(operand, s.Address):
+        return family(operand.register)
+    return None
+
+
+def overlaps(a, a_size, b, b_size):
+    """Whether two memory operands might refer to the same bytes."""
+    if a.register is not b.register or a.index is not None or b.index is not None:
+        return True
+    return a.offset < b.offset + b_size and b.offset < a.offset + a_size
+
+
+def is_simple(inst):
+    """Instructions whose operands the rules below can reason about."""
+    return isinstance(inst, (s.Mov,) + read_modify_write)
+
+
+def reads_memory(inst, addr, size):
+    dest = inst.dest if isinstance(inst, read_modify_write) else None
+    for operand in (inst.src, dest):
+        if isinstance(operand, s.Address) and overlaps(
+            operand, inst.size.byte_size(), addr, size
+        ):
+            return True
+    return False
+
+
+def writes_register(inst, fam):
+    return family(inst.dest) is fam
+
+
+def reads_register(inst, fam):
+    if family(inst.src) is fam or base_family(inst.src) is fam:
+        return True
+    if base_family(inst.dest) is fam:
+        return True
+    return isinstance(inst, read_modify_write) and family(inst.dest) is fam
+
+
+def register_dead_after(instructions, start, reg):
+    """Whether the value in reg is never read from instructions[start] on."""
+    fam = family(reg)
+    size = reg.size().byte_size()
+    for inst in instructions[start:]:
+        if isinstance(inst, s.Ret):
+            return fam not in return_registers
+        if isinstance(inst, s.Leave):
+            continue
+        if not is_simple(inst) or reads_register(inst, fam):
+            return False
+        if writes_register(inst, fam):
+            dest_size = inst.dest.size().byte_size()
+            # 32-bit writes clear the upper half, smaller ones don't
+            if dest_size >= 4 or dest_size >= size:
+                return True
+    return False
+
+
+def zero_stack_adjust(instructions, i):
+    """`sub $0, %reg` does nothing."""
+    inst = instructions[i]
+    if (
+        isinstance(inst, s.Sub)
+        and isinstance(inst.src, s.Immediate)
+        and inst.src.value == 0
+        and isinstance(inst.dest, s.Register)
+    ):
+        return 1, []
+
+
+def jump_to_next(instructions, i):
+    """A jump to a label that immediately follows it."""
+    inst = instructions[i]
+    if not isinstance(inst, s.Jmp):
+        return None
+    for following in instructions[i + 1 :]:
+        if not isinstance(following, s.Label):
+            return None
+        if following.name == inst.to:
+            return 1, []
+
+
+def unused_label(instructions, i):
+    """A local label that nothing jumps to."""
+    inst = instructions[i]
+    if not isinstance(inst, s.Label):
+        return None
+    for other in instructions:
+        if isinstance(other, s.Jmp) and other.to == inst.name:
+            return None
+    return 1, []
+
+
+def redundant_move_back(instructions, i):
+    """`mov A, B; mov B, A`: after the first move B already equals A."""
+    if i + 1 >= len(instructions):
+        return None
+    a, b = instructions[i], instructions[i + 1]
+    if not (isinstance(a, s.Mov) and isinstance(b, s.Mov) and a.size is b.size):
+        return None
+    if isinstance(a.src, s.Immediate):
+        return None
+    if not (same_operand(b.src, a.dest) and same_operand(b.dest, a.src)):
+        return None
+    # `mov (%rax), %rax` changes what the address refers to
+    if family(a.dest) is not None and base_family(a.src) is family(a.dest):
+        return None
+    return 2, [a]
+
+
+def overwritten_store(instructions, i):
+    """A store to memory that is overwritten before anything reads it."""
+    a = instructions[i]
+    if not (isinstance(a, s.Mov) and isinstance(a.dest, s.Address)):
+        return None
+    addr = a.dest
+    size = a.size.byte_size()
+    base = base_family(addr)
+    for inst in instructions[i + 1 :]:
+        if not is_simple(inst) or reads_memory(inst, addr, size):
+            return None
+        if writes_register(inst, base):
+            return None
+        dest = inst.dest
+        if (
+            isinstance(inst, s.Mov)
+            and isinstance(dest, s.Address)
+            and dest.register is addr.register
+            and dest.offset <= addr.offset
+            and dest.offset + inst.size.byte_size() >= addr.offset + size
+        ):
+            return 1, []
+    return None
+
+
+def forward_stored_value(instructions, i):
+    """
+    Use a constant or register directly instead of reading it back from
+    where it was stored.
+    """
+    a = instructions[i]
+    if not (
+        isinstance(a, s.Mov)
+        and isinstance(a.src, (s.Immediate, s.Register))
+        and isinstance(a.dest, s.Address)
+    ):
+        return None
+    addr = a.dest
+    size = a.size.byte_size()
+    base = base_family(addr)
+    src_family = family(a.src)
+    for j in range(i + 1, len(instructions)):
+        inst = instructions[j]
+        if not is_simple(inst) or writes_register(inst, base):
+            return None
+        if src_family is not None and writes_register(inst, src_family):
+            return None
+        if (
+            isinstance(inst, s.Mov)
+            and same_operand(inst.src, addr)
+            and inst.size is a.size
+            and isinstance(inst.dest, s.Register)
+        ):
+            load = s.Mov(a.src, inst.dest, size=inst.size)
+            return j - i + 1, instructions[i:j] + [load]
+        if isinstance(inst.dest, s.Address) and overlaps(
+            inst.dest, inst.size.byte_size(), addr, size
+        ):
+            return None
+    return None
+
+
+def move_through_scratch(instructions, i):
+    """`mov X, %reg; mov %reg, Y` where nothing else reads %reg."""
+    if i + 1 >= len(instructions):
+        return None
+    a, b = instructions[i], instructions[i + 1]
+    if not (isinstance(a, s.Mov) and isinstance(b, s.Mov) and a.size is b.size):
+        return None
+    if not isinstance(a.dest, s.Register) or b.src is not a.dest:
+        return None
+    if isinstance(a.src, s.Address) and isinstance(b.dest, s.Address):
+        return None
+    if base_family(b.dest) is family(a.dest):
+        return None
+    if isinstance(a.src, s.Immediate) and not s.fits_imm32(a.src.value):
+        return None
+    if not register_dead_after(instructions, i + 2, a.dest):
+        return None
+    return 2, [s.Mov(a.src, b.dest, size=a.size)]
+
+
+def flags_dead_after(instructions, start):
+    """
+    Whether nothing reads the flags from instructions[start] on before they
+    are set again. A jump is only ever taken on flags set right before it,
+    so they are dead across labels, jumps and calls.
+    """
+    for inst in instructions[start:]:
+        if isinstance(inst, s.Jcc):
+            return False
+        if isinstance(inst, (s.Label, s.Jmp, s.Call, s.Ret) + flag_writers):
+            return True
+    return True
+
+
+def zero_with_xor(instructions, i):
+    """
+    `mov $0, %reg` as `xor %reg, %reg`, which is shorter and breaks the
+    dependency on the old value, where the flags it sets don't matter.
+    """
+    inst = instructions[i]
+    if not (
+        isinstance(inst, s.Mov)
+        and isinstance(inst.src, s.Immediate)
+        and inst.src.value == 0
+        and isinstance(inst.dest, s.Register)
+        and inst.dest.size() is not None
+    ):
+        return None
+    if not flags_dead_after(instructions, i + 1):
+        return None
+    # Writing the 32-bit register clears the rest of it too
+    reg = inst.dest.with_size(s.Size.double_word)
+    return 1, [s.Xor(reg, reg)]
+
+
+DEFAULT_RULES = [
+    zero_stack_adjust,
+    jump_to_next,
+    unused_label,
+    redundant_move_back,
+    overwritten_store,
+    forward_stored_value,
+    move_through_scratch,
+    zero_with_xor,
+]
+
+
+class Peephole:
+    """
+    Applies rules until none of them match anywhere in a block. `stats`
+    counts how often each rule fired, across every block optimized.
+    """
+
+    def __init__(self, rules=None):
+        self.rules = list(DEFAULT_RULES if rules is None else rules)
+        self.stats = Counter()
+
+    def optimize(self, block):
+        instructions = list(block.instructions)
+        changed = True
+        while changed:
+            changed = False
+            i = 0
+            while i < len(instructions):
+                for rule in self.rules:
+                    result = rule(instructions, i)
+                    if result is not None:
+                        n, replacement = result
+                        instructions[i : i + n] = replacement
+                        self.stats[rule.__name__] += 1
+                        changed = True
+                        break
+                else:
+                    i += 1
+        return s.Block(label=block.label, instructions=instructions)
@@ -0,0 +1,500 @@
+"""
+Hand-written recursive descent front end for the language in Compiler37.g4.
+
+This builds `compiler.ast` nodes in a single pass over the token list, without
+the ANTLR runtime or the ConvertAST visitor. Its job is to accept exactly what
+the generated parser accepts, and to fail with the same message ANTLR's
+default error strategy reports for the first syntax error in a file (which is
+the only one we see, since RaiseOnSyntaxError bails out on it).
+
+Token types are numbered the way ANTLR numbers them for the grammar, so that
+"expecting {...}" sets print in the same order.
+"""
+import re
+import sys
+
+from . import ast
+from .instrument import phase
+from .parser import ParseError
+
+EOF = -1
+VAR = 1
+COLON = 2
+ASSIGN = 3
+SEMI = 4
+FUNCTION = 5
+LPAREN = 6
+RPAREN = 7
+LBRACE = 8
+RBRACE = 9
+COMMA = 10
+STRUCT = 11
+LBRACKET = 12
+RBRACKET = 13
+MINUS = 14
+DOT = 15
+STAR = 16
+SLASH = 17
+PERCENT = 18
+PLUS = 19
+SHIFT_LEFT = 20
+SHIFT_RIGHT = 21
+AMPERSAND = 22
+CARET = 23
+PIPE = 24
+RETURN = 25
+WHILE = 26
+POSITIVE_INTEGER = 30
+ID = 31
+
+token_names = {
+    EOF: "<EOF>",
+    VAR: "'var'",
+    COLON: "':'",
+    ASSIGN: "'='",
+    SEMI: "';'",
+    FUNCTION: "'function'",
+    LPAREN: "'('",
+    RPAREN: "')'",
+    LBRACE: "'{'",
+    RBRACE: "'}'",
+    COMMA: "','",
+    STRUCT: "'struct'",
+    LBRACKET: "'['",
+    RBRACKET: "']'",
+    MINUS: "'-'",
+    DOT: "'.'",
+    STAR: "'*'",
+    SLASH: "'/'",
+    PERCENT: "'%'",
+    PLUS: "'+'",
+    SHIFT_LEFT: "'<<'",
+    SHIFT_RIGHT: "'>>'",
+    AMPERSAND: "'&'",
+    CARET: "'^'",
+    PIPE: "'|'",
+    RETURN: "'return'",
+    WHILE: "'while'",
+    POSITIVE_INTEGER: "POSITIVE_INTEGER",
+    ID: "ID",
+}
+
+keywords = {
+    "var": VAR,
+    "function": FUNCTION,
+    "struct": STRUCT,
+    "return": RETURN,
+    "while": WHILE,
+}
+
+punctuation = {
+    ":": COLON,
+    "=": ASSIGN,
+    ";": SEMI,
+    "(": LPAREN,
+    ")": RPAREN,
+    "{": LBRACE,
+    "}": RBRACE,
+    ",": COMMA,
+    "[": LBRACKET,
+    "]": RBRACKET,
+    "-": MINUS,
+    ".": DOT,
+    "*": STAR,
+    "/": SLASH,
+    "%": PERCENT,
+    "+": PLUS,
+    "<<": SHIFT_LEFT,
+    ">>": SHIFT_RIGHT,
+    "&": AMPERSAND,
+    "^": CARET,
+    "|": PIPE,
+}
+
+# Skipped input (WS and COMMENT) is matched together with the following token
+# so that the common case is one regex match per token.
+token_re = re.compile(
+    r"""
+    (?:[ \r\n\t]+|//[^\n\r]*\r?\n)*
+    (?:
+        (?P<id>[a-zA-Z_][a-zA-Z0-9_]*)
+      | (?P<int>[1-9][0-9]*|0)
+      | (?P<punct>[:=;(){},\[\]\-.*/%+&^|]|<<|>>)
+    )?
+    """,
+    re.VERBOSE,
+)
+
+FIRST_DECL = frozenset([VAR, FUNCTION, STRUCT])
+FIRST_STMT = frozenset([VAR, ID, RETURN, WHILE])
+FIRST_EXPR = frozenset([ID, MINUS, POSITIVE_INTEGER, LPAREN])
+FIRST_INTEGER = frozenset([MINUS, POSITIVE_INTEGER])
+FIRST_TYPE = frozenset([ID])
+# Binary operators and how tightly they bind, as in C
+precedence = {
+    STAR: 5,
+    SLASH: 5,
+    PERCENT: 5,
+    PLUS: 4,
+    MINUS: 4,
+    SHIFT_LEFT: 3,
+    SHIFT_RIGHT: 3,
+    AMPERSAND: 2,
+    CARET: 1,
+    PIPE: 0,
+}
+# What may follow an expression within a larger one
+EXPR_SUFFIX = frozenset([DOT]) | frozenset(precedence)
+PROGRAM_LOOP = FIRST_DECL | {EOF}
+BODY_LOOP = FIRST_STMT | {RBRACE}
+
+
+def line_and_column(source, offset):
+    line_start = source.rfind("\n", 0, offset) + 1
+    return source.count("\n", 0, offset) + 1, offset - line_start
+
+
+def error_display(text):
+    return text.replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t")
+
+
+def format_token_set(types):
+    names = [token_names[t] for t in sorted(types)]
+    if len(names) == 1:
+        return names[0]
+    return "{" + ", ".join(names) + "}"
+
+
+def _stuck_at(source, pos):
+    """
+    Find where ANTLR's lexer DFA gives up when no token matches at pos.
+
+    Only a lone "<" or ">" gets any further than the first character, since
+    it could have started a shift. A "/" is always a token, even when it
+    starts an unterminated comment.
+    """
+    if source[pos] in "<>":
+        return pos + 1
+    return pos
+
+
+def tokenize(source):
+    """
+    Split source into parallel lists of token types, texts and offsets.
+
+    The lists end with an EOF token. Characters that don't start a token are
+    reported on stderr and skipped, like the generated lexer does.
+    """
+    types = []
+    texts = []
+    offsets = []
+    match = token_re.match
+    end = len(source)
+    pos = 0
+    while True:
+        m = match(source, pos)
+        last = m.lastgroup
+        if last is None:
+            pos = m.end()
+            if pos == end:
+                break
+            stuck = _stuck_at(source, pos)
+            line, column = line_and_column(source, pos)
+            text = error_display(source[pos : stuck + 1])
+            print(
+                f"line {line}:{column} token recognition error at: '{text}'",
+                file=sys.stderr,
+            )
+            pos = min(stuck + 1, end)
+            continue
+        text = m.group(last)
+        if last == "id":
+            types.append(keywords.get(text, ID))
+        elif last == "int":
+            types.append(POSITIVE_INTEGER)
+        else:
+            types.append(punctuation[text])
+        texts.append(text)
+        offsets.append(m.start(last))
+        pos = m.end()
+    types.append(EOF)
+    texts.append("<EOF>")
+    offsets.append(end)
+    return types, texts, offsets
+
+
+class Parser:
+    """
+    One method per grammar rule. Each rule takes `follow`, the set of tokens
+    that may come after it in the current context; ANTLR uses the same
+    information to tell a missing token from a mismatched one.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.types, self.texts, self.offsets = tokenize(source)
+        self.pos = 0
+
+    def la(self, i):
+        types = self.types
+        return types[min(self.pos + i - 1, len(types) - 1)]
+
+    def error(self, message):
+        line, column = line_and_column(self.source, self.offsets[self.pos])
+        return ParseError(f"line {line}:{column} {message}\n")
+
+    def display(self):
+        return f"'{error_display(self.texts[self.pos])}'"
+
+    def match(self, type_, after):
+        if self.types[self.pos] == type_:
+            text = self.texts[self.pos]
+            self.pos += 1
+            return text
+        expecting = format_token_set([type_])
+        if self.la(2) == type_:
+            raise self.error(f"extraneous input {self.display()} expecting {expecting}")
+        if self.types[self.pos] in after:
+            raise self.error(f"missing {expecting} at {self.display()}")
+        raise self.error(f"mismatched input {self.display()} expecting {expecting}")
+
+    def sync(self, expecting):
+        if self.types[self.pos] in expecting:
+            return
+        if self.la(2) in expecting:
+            problem = "extraneous"
+        else:
+            problem = "mismatched"
+        raise self.error(
+            f"{problem} input {self.display()} expecting {format_token_set(expecting)}"
+        )
+
+    def sync_loop_back(self, expecting):
+        if self.types[self.pos] in expecting:
+            return
+        raise self.error(
+            f"extraneous input {self.display()} "
+            f"expecting {format_token_set(expecting)}"
+        )
+
+    def program(self):
+        decls = []
+        self.sync(PROGRAM_LOOP)
+        while self.types[self.pos] in FIRST_DECL:
+            decls.append(self.decl(PROGRAM_LOOP))
+            self.sync_loop_back(PROGRAM_LOOP)
+        self.match(EOF, after=())
+        return ast.File(decls)
+
+    def decl(self, follow):
+        type_ = self.types[self.pos]
+        if type_ == VAR:
+            return self.var_decl(follow)
+        if type_ == FUNCTION:
+            return self.function_decl(follow)
+        return self.struct_decl(follow)
+
+    def var_decl(self, follow):
+        self.match(VAR, after={ID})
+        name = self.match(ID, after={COLON})
+        self.match(COLON, after=FIRST_TYPE)
+        type_ = self.type_expr({ASSIGN, SEMI})
+        self.sync({ASSIGN, SEMI})
+        init = None
+        if self.types[self.pos] == ASSIGN:
+            self.match(ASSIGN, after=FIRST_EXPR)
+            init = self.expr({SEMI})
+        self.match(SEMI, after=follow)
+        return ast.VarDecl(name, type_, init)
+
+    def function_decl(self, follow):
+        self.match(FUNCTION, after={ID})
+        name = self.match(ID, after={LPAREN})
+        self.match(LPAREN, after={ID, RPAREN})
+        self.sync({ID, RPAREN})
+        arguments = []
+        if self.types[self.pos] == ID:
+            arguments = self.arg_list({RPAREN})
+        self.match(RPAREN, after={COLON})
+        self.match(COLON, after=FIRST_TYPE)
+        return_type = self.type_expr({LBRACE})
+        body = self.body(follow)
+        return ast.FunctionDecl(name, arguments, return_type, body, export=True)
+
+    def body(self, follow):
+        """`'{' body+=stmt* '}'`, in functionDecl and while_."""
+        self.match(LBRACE, after=BODY_LOOP)
+        body = []
+        self.sync(BODY_LOOP)
+        while self.types[self.pos] in FIRST_STMT:
+            body.append(self.stmt(BODY_LOOP))
+            self.sync_loop_back(BODY_LOOP)
+        self.match(RBRACE, after=follow)
+        return body
+
+    def arg(self, follow):
+        name = self.match(ID, after={COLON})
+        self.match(COLON, after=FIRST_TYPE)
+        return ast.FunctionDecl.Arg(name, self.type_expr(follow))
+
+    def arg_list(self, follow):
+        return self._list(self.arg, follow)
+
+    def struct_decl(self, follow):
+        self.match(STRUCT, after={ID})
+        name = self.match(ID, after={LBRACE})
+        self.match(LBRACE, after={ID})
+        fields = self.struct_field_list({RBRACE})
+        self.match(RBRACE, after=follow)
+        return ast.StructDecl(name, fields=fields)
+
+    def struct_field(self, follow):
+        name = self.match(ID, after={COLON})
+        self.match(COLON, after=FIRST_TYPE)
+        return ast.StructDecl.Field(name, self.type_expr(follow))
+
+    def struct_field_list(self, follow):
+        return self._list(self.struct_field, follow)
+
+    def _list(self, item, follow, first=FIRST_TYPE):
+        """
+        argList, structFieldList and exprList, `car=item (',' cdr=list)? ','?`,
+        where items start with a token in first.
+
+        The right recursion is unrolled into a loop. The innermost list takes
+        the trailing comma, as ANTLR's prediction does, and every list inside
+        the outermost one may be followed by the outer list's comma.
+        """
+        inner_follow = {COMMA} | set(follow)
+        items = [item(inner_follow)]
+        while self.types[self.pos] == COMMA and self.la(2) in first:
+            self.match(COMMA, after=first)
+            items.append(item(inner_follow))
+        if self.types[self.pos] == COMMA:
+            self.match(COMMA, after=follow)
+        return items
+
+    def type_expr(self, follow):
+        self.sync(FIRST_TYPE)
+        if self.la(2) == LBRACKET:
+            element_type = self.match(ID, after={LBRACKET})
+            self.match(LBRACKET, after={POSITIVE_INTEGER})
+            length = self.match(POSITIVE_INTEGER, after={RBRACKET})
+            self.match(RBRACKET, after=follow)
+            return ast.ArrayTypeExpr(ast.NamedTypeExpr(element_type), int(length))
+        return ast.NamedTypeExpr(self.match(ID, after=follow))
+
+    def integer(self, follow):
+        self.sync(FIRST_INTEGER)
+        sign = ""
+        if self.types[self.pos] == MINUS:
+            sign = self.match(MINUS, after={POSITIVE_INTEGER})
+        return ast.IntExpr(int(sign + self.match(POSITIVE_INTEGER, after=follow)))
+
+    def expr(self, follow, binding=0):
+        """
+        An expression, with the binary operators that bind at least as
+        tightly as binding (the precedence climbing ANTLR turns the left
+        recursion into).
+        """
+        # Parentheses are unwrapped in a loop so deep nesting can't blow the
+        # Python stack.
+        depth = 0
+        while True:
+            self.sync(FIRST_EXPR)
+            if self.types[self.pos] != LPAREN:
+                break
+            self.match(LPAREN, after=FIRST_EXPR)
+            depth += 1
+        inner_follow = {RPAREN} if depth else follow
+        if self.types[self.pos] == ID and self.la(2) == LPAREN:
+            value = self.call(EXPR_SUFFIX | inner_follow)
+        elif self.types[self.pos] == ID:
+            value = ast.IdentExpr(self.match(ID, after=EXPR_SUFFIX | inner_follow))
+        else:
+            value = self.integer(EXPR_SUFFIX | inner_follow)
+        value = self.field_accesses(value, inner_follow)
+        value = self.operators(value, 0 if depth else binding, inner_follow)
+        for level in range(depth - 1, -1, -1):
+            outer_follow = {RPAREN} if level else follow
+            self.match(RPAREN, after=EXPR_SUFFIX | outer_follow)
+            value = self.field_accesses(value, outer_follow)
+            value = self.operators(value, 0 if level else binding, outer_follow)
+        return value
+
+    def operators(self, left, binding, follow):
+        """The binary operators after left, if they bind at least that tightly."""
+        while precedence.get(self.types[self.pos], -1) >= binding:
+            level = precedence[self.types[self.pos]]
+            operator = self.texts[self.pos]
+            self.pos += 1
+            # Left associative, so the right operand stops at the same level
+            right = self.expr(follow, level + 1)
+            left = ast.BinaryExpr(operator, left, right)
+        return left
+
+    def call(self, follow):
+        """`callee=ID '(' args=exprList? ')'`."""
+        name = self.match(ID, after={LPAREN})
+        self.match(LPAREN, after=FIRST_EXPR | {RPAREN})
+        self.sync(FIRST_EXPR | {RPAREN})
+        arguments = []
+        if self.types[self.pos] in FIRST_EXPR:
+            arguments = self._list(self.expr, {RPAREN}, FIRST_EXPR)
+        self.match(RPAREN, after=follow)
+        return ast.CallExpr(name, arguments)
+
+    def field_accesses(self, value, follow):
+        """The `expr '.' ID` suffixes ANTLR turns the left recursion into."""
+        while self.types[self.pos] == DOT:
+            self.match(DOT, after={ID})
+            value = ast.FieldAccessExpr(
+                value, self.match(ID, after=EXPR_SUFFIX | follow)
+            )
+        return value
+
+    def stmt(self, follow):
+        type_ = self.types[self.pos]
+        if type_ == VAR:
+            return self.var_decl(follow)
+        if type_ == ID:
+            return self.assign(follow)
+        if type_ == WHILE:
+            return self.while_(follow)
+        return self.return_(follow)
+
+    def assign(self, follow):
+        target = self.assignment_target({ASSIGN})
+        self.match(ASSIGN, after=FIRST_EXPR)
+        value = self.expr({SEMI})
+        self.match(SEMI, after=follow)
+        return ast.AssignStmt(target, value)
+
+    def assignment_target(self, follow):
+        after_id = {DOT} | set(follow)
+        target = ast.IdentExpr(self.match(ID, after=after_id))
+        while self.types[self.pos] == DOT:
+            self.match(DOT, after={ID})
+            target = ast.FieldAccessExpr(target, self.match(ID, after=after_id))
+        return target
+
+    def return_(self, follow):
+        self.match(RETURN, after=FIRST_EXPR | {SEMI})
+        self.sync(FIRST_EXPR | {SEMI})
+        value = None
+        if self.types[self.pos] in FIRST_EXPR:
+            value = self.expr({SEMI})
+        self.match(SEMI, after=follow)
+        return ast.ReturnStmt(value)
+
+    def while_(self, follow):
+        self.match(WHILE, after=FIRST_EXPR)
+        condition = self.expr({LBRACE})
+        return ast.WhileStmt(condition, self.body(follow))
+
+
+def parse(input):
+    with phase("tokenize"):
+        parser = Parser(input)
+    with phase("rules"):
+        return parser.program()
@@ -0,0 +1,279 @@
+"""
+Linear scan register allocation (Poletto and Sarkar) over `ir` values.
+
+Each value that needs a home gets one live interval, the hull of every
+position where it is live. Intervals are visited in order of their start and
+take a free register if there is one; otherwise whichever of the competing
+intervals ends last is spilled to the stack.
+
+Calls clobber the caller-saved registers, so intervals that live across one
+take a callee-saved register while there are any. The rest are saved to the
+stack around each call they live across, by the lowering. Some instructions
+clobber particular registers too, such as RDX for a division; intervals that
+live across one of them never get those.
+"""
+import bisect
+
+from . import asm as s
+from . import ir
+
+# Preferred first. RAX and R11 are kept back as scratch registers for the
+# lowering, and callee-saved ones are only worth their save and restore when
+# the others run out.
+caller_saved = [
+    s.Register.rcx,
+    s.Register.rdx,
+    s.Register.rsi,
+    s.Register.rdi,
+    s.Register.r8,
+    s.Register.r9,
+    s.Register.r10,
+]
+callee_saved = [
+    s.Register.rbx,
+    s.Register.r12,
+    s.Register.r13,
+    s.Register.r14,
+    s.Register.r15,
+]
+allocatable = caller_saved + callee_saved
+# Callee-saved too, and allocatable last of all when it isn't the frame pointer
+frame_pointer = s.Register.rbp
+
+# Arguments are live from before the first instruction
+ENTRY = -1
+
+
+class Interval:
+    def __init__(self, value, start, end):
+        self.value = value
+        self.start = start
+        self.end = end
+        self.register = None
+
+    def extend(self, position):
+        self.start = min(self.start, position)
+        self.end = max(self.end, position)
+
+
+class Allocation:
+    """
+    Where every value lives: `registers` maps values to 64-bit registers.
+    `saves` maps each call to the values in caller-saved registers that live
+    across it, and `saved_across` each of those values to the first and last
+    position of such a call.
+    """
+
+    def __init__(self, intervals, saves=None, saved_across=None):
+        self.intervals = intervals
+        self.saves = saves or {}
+        self.saved_across = saved_across or {}
+        self.registers = {
+            iv.value: iv.register for iv in intervals if iv.register is not None
+        }
+        self.spilled = [iv.value for iv in intervals if iv.register is None]
+        used = set(self.registers.values())
+        saved = callee_saved + [frame_pointer]
+        self.callee_saved = [reg for reg in saved if reg in used]
+
+    def format(self, function):
+        """A table of intervals and assignments, for debugging."""
+        names = function.value_names()
+        lines = [f"{function.name}:"]
+        for iv in self.intervals:
+            home = iv.register if iv.register is not None else "spilled"
+            name = ir.name_of(iv.value, names)
+            lines.append(f"\t{name:<8} [{iv.start}, {iv.end}]\t{home}")
+        if self.callee_saved:
+            saved = " ".join(str(reg) for reg in self.callee_saved)
+            lines.append(f"\tcallee-saved: {saved}")
+        if self.saved_across:
+            saved = " ".join(ir.name_of(value, names) for value in self.saved_across)
+            lines.append(f"\tsaved around calls: {saved}")
+        return "\n".join(lines)
+
+
+def live_intervals(function, values):
+    """
+    Intervals of the given values, over positions numbering the instructions
+    in block order. A phi is live from where each predecessor writes it.
+    """
+    positions = {}
+    bounds = {}
+    pos = 0
+    for block in function.blocks:
+        start = pos
+        for inst in block.instructions:
+            positions[inst] = pos
+            pos += 1
+        bounds[block] = (start, pos - 1)
+
+    intervals = {}
+
+    def extend(value, position):
+        if value not in values:
+            return
+        iv = intervals.get(value)
+        if iv is None:
+            intervals[value] = Interval(value, position, position)
+        else:
+            iv.extend(position)
+
+    # Uses and definitions local to each block; phi inputs are used at the
+    # end of the predecessor they come from
+    upward = {}
+    defined = {}
+    phi_inputs = {block: set() for block in function.blocks}
+    for block in function.blocks:
+        up = upward[block] = set()
+        defs = defined[block] = set()
+        for inst in block.instructions:
+            if isinstance(inst, ir.Phi):
+                extend(inst, bounds[block][0])
+                for pred, value in inst.incoming:
+                    end = bounds[pred][1]
+                    phi_inputs[pred].add(value)
+                    extend(inst, end)
+                    extend(value, end)
+            else:
+                for operand in inst.operands():
+                    extend(operand, positions[inst])
+                    if operand in values and operand not in defs:
+                        up.add(operand)
+                extend(inst, positions[inst])
+            if inst in values:
+                defs.add(inst)
+
+    live_in = {block: set() for block in function.blocks}
+    live_out = {block: set() for block in function.blocks}
+    changed = True
+    while changed:
+        changed = False
+        for block in reversed(function.blocks):
+            out = set(phi_inputs[block] & values)
+            for succ in block.successors():
+                out |= live_in[succ] - defined[succ]
+            in_ = upward[block] | (out - defined[block])
+            if out != live_out[block] or in_ != live_in[block]:
+                live_out[block] = out
+                live_in[block] = in_
+                changed = True
+
+    for block in function.blocks:
+        start, end = bounds[block]
+        for value in live_in[block]:
+            extend(value, start)
+        for value in live_out[block]:
+            extend(value, end)
+    for param in function.incoming():
+        if param in intervals:
+            intervals[param].extend(ENTRY)
+
+    return sorted(intervals.values(), key=lambda iv: (iv.start, iv.end))
+
+
+def call_positions(function, tail_calls=()):
+    """
+    (position, call) of every call that returns here, numbered like
+    `live_intervals`.
+    """
+    return [
+        (pos, inst)
+        for pos, inst in enumerate(function.instructions())
+        if isinstance(inst, ir.Call) and inst not in tail_calls
+    ]
+
+
+def crossed_calls(iv, calls, positions):
+    """The calls an interval lives across, not just into or out of."""
+    first = bisect.bisect_right(positions, iv.start)
+    last = bisect.bisect_left(positions, iv.end)
+    return calls[first:last]
+
+
+def clobber_positions(function, clobbers):
+    """(position, registers) of the instructions in clobbers, in order."""
+    return [
+        (pos, clobbers[inst])
+        for pos, inst in enumerate(function.instructions())
+        if inst in clobbers
+    ]
+
+
+def allocate(
+    function,
+    values,
+    preferred=None,
+    frame_pointer_free=False,
+    tail_calls=(),
+    clobbers=None,
+):
+    """
+    Assign registers to the given values with linear scan. Params take the
+    register they are passed in, from preferred, if it's free, unless they
+    live across a call and a callee-saved one is. Calls in tail_calls never
+    return, so nothing lives across them. clobbers maps instructions to the
+    registers they overwrite. RBP is only handed out with frame_pointer_free.
+    """
+    preferred = preferred or {}
+    registers = allocatable + [frame_pointer] if frame_pointer_free else allocatable
+    intervals = live_intervals(function, values)
+    calls = call_positions(function, tail_calls)
+    positions = [pos for pos, _ in calls]
+    clobbered = clobber_positions(function, clobbers or {})
+    clobber_points = [pos for pos, _ in clobbered]
+    free = list(registers)
+    active = []
+
+    def avoided(iv):
+        """Registers clobbered while the interval is live."""
+        regs = set()
+        for _, clobbered_regs in crossed_calls(iv, clobbered, clobber_points):
+            regs |= clobbered_regs
+        return regs
+
+    def take(iv, reg):
+        iv.register = reg
+        free.remove(reg)
+        active.append(iv)
+
+    for iv in intervals:
+        # Expire intervals that ended before this one starts
+        for old in [a for a in active if a.end < iv.start]:
+            active.remove(old)
+            free.append(old.register)
+        free.sort(key=registers.index)
+
+        avoid = avoided(iv)
+        usable = [r for r in free if r not in avoid]
+        reg = preferred.get(iv.value)
+        kept = [r for r in usable if r not in caller_saved]
+        if kept and crossed_calls(iv, calls, positions):
+            take(iv, kept[0])
+        elif reg in usable:
+            take(iv, reg)
+        elif usable and not isinstance(iv.value, ir.Param):
+            take(iv, usable[0])
+        elif any(a.register not in avoid for a in active):
+            # Out of registers: spill whatever is live the longest
+            victim = max(
+                (a for a in active if a.register not in avoid), key=lambda a: a.end
+            )
+            if victim.end > iv.end and not isinstance(iv.value, ir.Param):
+                reg = victim.register
+                victim.register = None
+                active.remove(victim)
+                free.append(reg)
+                take(iv, reg)
+
+    saves = {}
+    saved_across = {}
+    for iv in intervals:
+        if iv.register not in caller_saved:
+            continue
+        crossed = crossed_calls(iv, calls, positions)
+        for _, call in crossed:
+            saves.setdefault(call, []).append(iv.value)
+        if crossed:
+            saved_across[iv.value] = (crossed[0][0], crossed[-1][0])
+    return Allocation(intervals, saves, saved_across)
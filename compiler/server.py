@@ -0,0 +1,198 @@
+"""
+A compile server on a Unix domain socket, so that a build paying for the
+interpreter, the imports and the register tables once per compile doesn't
+have to. `compiler/client.py` is the other end.
+
+    python . --server /tmp/c37.sock --idle-timeout 600
+
+Each connection carries one request: a JSON line naming the input files (or
+giving their source) and the options. The answer is a JSON line saying
+whether it worked, how long the output is and what was logged, followed by
+the output itself: assembly text, or an object file with "emit": "obj".
+
+Every request is handled in a process forked from the server, so requests
+run in parallel, each with its own `Compile` and nothing it does (a crash
+included) reaches the server or other requests. Whatever the server imported
+before forking is shared with them. Parse and block caches are on disk, so
+their entries outlive the requests that made them.
+
+The server stops when it has been idle for the given number of seconds, or
+on SIGTERM or SIGINT, and removes its socket.
+"""
+import contextlib
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import time
+import traceback
+
+from .compile import Compile
+from .elf import object_file
+from .inline import DEFAULT_THRESHOLD
+from .parser import BACKENDS, ParseError, parse, read_source
+
+DEFAULT_IDLE_TIMEOUT = 600
+# How often the server wakes up to check whether it's idle, in seconds
+POLL_INTERVAL = 1
+
+
+class BadRequest(Exception):
+    pass
+
+
+def read_inputs(request):
+    """The source text of every input in a request, in order."""
+    sources = []
+    for item in request.get("inputs", []):
+        if "source" in item:
+            sources.append(item["source"])
+        elif "path" in item:
+            sources.append(read_source(item["path"]))
+        else:
+            raise BadRequest(f"Input without a path or source: {item!r}")
+    if not sources:
+        raise BadRequest("No inputs")
+    return sources
+
+
+def compile_request(request, cache=None, block_cache=None):
+    """The output and the log for a request."""
+    options = request.get("options", {})
+    backend = options.get("parser", "antlr")
+    if backend not in BACKENDS:
+        raise BadRequest(f"Unknown parser backend {backend!r}")
+    emit = options.get("emit", "asm")
+    if emit not in ("asm", "obj"):
+        raise BadRequest(f"Unknown output kind {emit!r}")
+    opt_level = options.get("opt_level", 0)
+    if opt_level not in (0, 1, 2):
+        raise BadRequest(f"Unknown optimization level {opt_level!r}")
+
+    log = io.StringIO()
+    trees = [
+        parse(source, backend=backend, cache=cache)
+        for source in read_inputs(request)
+    ]
+    c = Compile(
+        block_cache=block_cache,
+        opt_level=opt_level,
+        optimize_size=options.get("optimize_size", False),
+        report_opt_stats=options.get("opt_stats", False),
+        regalloc_log=log if options.get("dump_regalloc") else None,
+        inline_threshold=options.get("inline_threshold", DEFAULT_THRESHOLD),
+        inline_log=log if options.get("inline_report") else None,
+        unroll=options.get("unroll", 1),
+        omit_frame_pointer=options.get("omit_frame_pointer", False),
+        reorder_fields=options.get("reorder_fields", False),
+        reorder_structs=options.get("reorder_structs", ()),
+        layout_log=log if options.get("layout_report") else None,
+    )
+    for tree in trees:
+        c.add_file(tree)
+    if options.get("opt_stats"):
+        for pass_name, counts in c.opt_stats().items():
+            for name, count in sorted(counts.items()):
+                print(f"{pass_name}: {name}={count}", file=log)
+    program = c.finish()
+    if emit == "obj":
+        output = object_file(program)
+    else:
+        output = str(program).encode("utf-8")
+    return output, log.getvalue()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # Someone checking whether the server is up
+            return
+        try:
+            request = json.loads(line)
+            output, log = compile_request(
+                request, self.server.cache, self.server.block_cache
+            )
+        except (BadRequest, ParseError, OSError, json.JSONDecodeError) as e:
+            self.respond({"ok": False, "error": str(e)})
+        except Exception:
+            self.respond({"ok": False, "error": traceback.format_exc()})
+        else:
+            self.respond({"ok": True, "log": log, "length": len(output)}, output)
+
+    def respond(self, header, payload=b""):
+        self.wfile.write(json.dumps(header).encode("utf-8") + b"\n" + payload)
+
+
+class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    def __init__(self, path, idle_timeout, cache=None, block_cache=None):
+        super().__init__(path, RequestHandler)
+        self.timeout = POLL_INTERVAL
+        self.idle_timeout = idle_timeout
+        self.cache = cache
+        self.block_cache = block_cache
+        self.last_active = time.monotonic()
+
+    def process_request(self, request, client_address):
+        self.last_active = time.monotonic()
+        super().process_request(request, client_address)
+
+    def idle(self):
+        """Whether nothing has been running for idle_timeout seconds."""
+        self.collect_children()
+        now = time.monotonic()
+        if self.active_children:
+            self.last_active = now
+            return False
+        return bool(self.idle_timeout) and now - self.last_active >= self.idle_timeout
+
+
+def remove_stale_socket(path):
+    """Remove a socket left behind by a server that's gone, or raise."""
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(path)
+            return
+    raise OSError(f"A server is already listening on {path}")
+
+
+def warm_up(backends):
+    """Import the parsers now, so that forked requests don't each have to."""
+    for backend in backends:
+        if backend == "fast":
+            from . import rd_parser  # noqa: F401
+        else:
+            # The generated parser may not have been built
+            with contextlib.suppress(ImportError):
+                from . import antlr_parser  # noqa: F401
+
+
+def serve(path, idle_timeout=None, cache=None, block_cache=None):
+    """
+    Handle requests on a socket at path until idle or told to stop. The idle
+    timeout defaults to DEFAULT_IDLE_TIMEOUT.
+    """
+    if idle_timeout is None:
+        idle_timeout = DEFAULT_IDLE_TIMEOUT
+    warm_up(BACKENDS)
+    remove_stale_socket(path)
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    with Server(path, idle_timeout, cache, block_cache) as server:
+        try:
+            while not server.idle():
+                server.handle_request()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
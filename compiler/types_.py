@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from collections import namedtuple
+from types import MappingProxyType
 
 
 def align(value, to):
@@ -13,6 +13,10 @@ class Type(ABC):
     def size(self):
         ...
 
+    @abstractmethod
+    def alignment(self):
+        ...
+
 
 class Integer(Type):
     def __init__(self, size):
@@ -22,6 +26,23 @@ class Integer(Type):
     def size(self):
         return self._size // 8
 
+    def alignment(self):
+        return self.size()
+
+    def fits(self, value):
+        """Whether value can be stored in this many bits, signed or unsigned."""
+        return -(1 << (self._size - 1)) <= value < (1 << self._size)
+
+    def wrap(self, value):
+        """The signed number with the same low bits as value."""
+        value &= (1 << self._size) - 1
+        if value >> (self._size - 1):
+            value -= 1 << self._size
+        return value
+
+    def __str__(self):
+        return f"int{self._size}"
+
 
 class Pointer(Type):
     def __init__(self, target_type):
@@ -33,50 +54,154 @@ class Pointer(Type):
     def size(self):
         return 8
 
+    def alignment(self):
+        return 8
+
+
+# These are plain classes rather than namedtuples, which are slow to define
+# and would be most of the cost of importing this module.
+
+
+class FieldLayout:
+    __slots__ = ("name", "type", "offset", "size", "alignment")
+
+    def __init__(self, name, type, offset, size, alignment):
+        self.name = name
+        self.type = type
+        self.offset = offset
+        self.size = size
+        self.alignment = alignment
+
+
+class StructLayout:
+    """
+    Where each field of a struct lives. Computed once when the struct is
+    defined; `index` maps field names to positions in `fields`.
+    """
+
+    __slots__ = ("fields", "size", "alignment", "index")
+
+    def __init__(self, fields, size, alignment):
+        self.fields = tuple(fields)
+        self.size = size
+        self.alignment = alignment
+        self.index = MappingProxyType({f.name: i for i, f in enumerate(fields)})
+
+    def __reduce__(self):
+        return (StructLayout, (self.fields, self.size, self.alignment))
+
+    def field(self, name):
+        i = self.index.get(name)
+        return None if i is None else self.fields[i]
+
 
 class Struct(Type):
-    Field = namedtuple("Field", ["name", "type"])
+    class Field:
+        __slots__ = ("name", "type")
 
-    def __init__(self, name, fields, *, packed=False):
+        def __init__(self, name, type):
+            self.name = name
+            self.type = type
+
+    def __init__(self, name, fields, *, packed=False, reorder=False):
         self.name = name
         assert len(fields) != 0, "Empty struct"
-        assert len(set(fields)) == len(fields), "Duplicate field name"
+        assert len({f.name for f in fields}) == len(fields), "Duplicate field name"
         self.fields = fields
         self.packed = packed
-
-    def _field_offsets(self):
+        self.declared_layout = self._compute_layout()
+        self.reordered = reorder and not packed
+        if self.reordered:
+            self.layout = self._reordered_layout()
+        else:
+            self.layout = self.declared_layout
+
+    def _compute_layout(self):
+        layouts = []
         offset = 0
+        greatest_alignment = 0
         for field in self.fields:
             field_size = field.type.size()
-            if not self.packed and offset != 0:
-                offset = align(offset, to=field_size)
-                # offset += (field_size - (offset % field_size)) % field_size
-            yield field, offset
+            # FIXME: This aligns fields to their size rather than to their
+            # type's alignment, which is wrong for structs and arrays.
+            alignment = 1 if self.packed else field_size
+            if offset != 0:
+                offset = align(offset, to=alignment)
+            layouts.append(
+                FieldLayout(field.name, field.type, offset, field_size, alignment)
+            )
             offset += field_size
+            if field_size > greatest_alignment:
+                greatest_alignment = field_size
+        return StructLayout(
+            layouts, align(offset, to=greatest_alignment), greatest_alignment
+        )
+
+    def _reordered_layout(self):
+        """
+        The fields most aligned first, each at its natural alignment. Every
+        size is a multiple of its alignment, so the only padding is at the end.
+        """
+        fields = sorted(self.fields, key=lambda field: -field.type.alignment())
+        layouts = []
+        offset = 0
+        for field in fields:
+            size = field.type.size()
+            alignment = field.type.alignment()
+            offset = align(offset, to=alignment)
+            layouts.append(FieldLayout(field.name, field.type, offset, size, alignment))
+            offset += size
+        greatest_alignment = max(f.alignment for f in layouts)
+        return StructLayout(
+            layouts, align(offset, to=greatest_alignment), greatest_alignment
+        )
+
+    def padding(self, layout=None):
+        """(offset, size) of every gap in a layout, the current one by default."""
+        layout = layout or self.layout
+        gaps = []
+        end = 0
+        for field in sorted(layout.fields, key=lambda field: field.offset):
+            if field.offset > end:
+                gaps.append((end, field.offset - end))
+            end = max(end, field.offset + field.size)
+        if layout.size > end:
+            gaps.append((end, layout.size - end))
+        return gaps
+
+    def format_layout(self, note=None):
+        """A table of field and padding offsets, for the layout report."""
+        size = self.layout.size
+        if self.reordered:
+            header = f"struct {self.name}: {self.declared_layout.size} -> {size} bytes"
+            header += ", fields reordered"
+        else:
+            header = f"struct {self.name}: {size} bytes"
+        if note:
+            header += f" ({note})"
+        rows = [(f.offset, f.name, str(f.type), f.size) for f in self.layout.fields]
+        rows.extend((offset, "padding", "", size) for offset, size in self.padding())
+        lines = [header]
+        for offset, name, type_, size in sorted(rows):
+            lines.append(f"\t{offset:>4}  {name:<12} {type_:<8} {size:>4}")
+        return "\n".join(lines)
 
     def field_offset(self, name):
-        for field, offset in self._field_offsets():
-            if field.name == name:
-                return offset
+        field = self.layout.field(name)
+        return None if field is None else field.offset
 
     def field_type(self, name):
-        for field in self.fields:
-            if field.name == name:
-                return field.type
+        field = self.layout.field(name)
+        return None if field is None else field.type
 
     def size(self):
-        greatest_alignment = 0
+        return self.layout.size
 
-        for field, offset in self._field_offsets():
-            field_size = field.type.size()
-            if field_size > greatest_alignment:
-                greatest_alignment = field_size
+    def __str__(self):
+        return self.name
 
-        subtotal = offset + field_size
-        return align(subtotal, to=greatest_alignment)
-        # if subtotal % greatest_alignment != 0:
-        #     return subtotal + (greatest_alignment - (subtotal % greatest_alignment))
-        # return subtotal
+    def alignment(self):
+        return self.layout.alignment
 
 
 class Array(Type):
@@ -84,6 +209,7 @@ class Array(Type):
         assert length >= 0, "Negative array length"
         self.element_type = element_type
         self.length = length
+        self._size = element_type.size() * length
 
     def index_offset(self, index):
         assert abs(index) < self.length, "Index out of bounds"
@@ -91,7 +217,13 @@ class Array(Type):
         return index * self.element_type.size()
 
     def size(self):
-        return self.element_type.size() * self.length
+        return self._size
+
+    def alignment(self):
+        return self.element_type.alignment()
+
+    def __str__(self):
+        return f"{self.element_type}[{self.length}]"
 
 
 class Function(Type):
@@ -101,3 +233,6 @@ class Function(Type):
 
     def size(self):
         return 8  # pointer
+
+    def alignment(self):
+        return 8
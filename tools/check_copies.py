@@ -0,0 +1,165 @@
+"""
+Check that values of every size are copied correctly, against C.
+
+For each size there is a struct holding that many bytes, which the generated
+functions copy by initialisation, assignment, as an array field, as arguments
+in registers and on the stack, as a return value and through calls. They are
+compiled at -O0 and -O1, with and without a frame pointer, both assembled with
+`as` and written with `elf.object_file`, and linked with cc into a C program
+that checks every byte arrived. Needs binutils and a C compiler.
+
+    python -m tools.check_copies            # sizes 1 to 5000
+    python -m tools.check_copies 1 300
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+from compiler.compile import Compile
+from compiler.elf import object_file
+from compiler.parser import parse
+
+# Flags and the Compile() arguments they stand for
+LEVELS = [
+    (f"-O{level}{flag}", dict(opt_level=level, omit_frame_pointer=bool(flag)))
+    for flag in ["", " -fomit-frame-pointer"]
+    for level in [0, 1]
+]
+# Sizes compiled into one program
+BATCH = 250
+# Failures listed per batch
+SHOWN = 20
+CC = ["cc", "-w", "-Wl,-z,noexecstack"]
+
+
+def source(sizes):
+    functions = []
+    for n in sizes:
+        functions.append(
+            f"""struct S{n} {{
+    data: int8[{n}],
+}}
+
+function copy{n}(a: S{n}): S{n} {{
+    var b: S{n} = a;
+    var c: S{n};
+    c = b;
+    return c;
+}}
+
+function mix{n}(x: int32, a: S{n}, y: int16, b: S{n}, z: int32): S{n} {{
+    var r: S{n} = b;
+    r = a;
+    return r;
+}}
+
+function field{n}(a: int8[{n}], b: S{n}): S{n} {{
+    var d: int8[{n}] = a;
+    b.data = d;
+    return b;
+}}
+
+function pass{n}(a: S{n}, b: S{n}): S{n} {{
+    var r: S{n} = mix{n}(1, b, 2, a, 3);
+    return field{n}(a.data, copy{n}(r));
+}}
+"""
+        )
+    return "\n".join(functions)
+
+
+def driver(sizes):
+    """C program calling the functions from source() and checking the results."""
+    lines = ["#include <stdio.h>", "#include <string.h>", ""]
+    for n in sizes:
+        lines.append(f"typedef struct {{ char data[{n}]; }} S{n};")
+        lines.append(f"S{n} copy{n}(S{n});")
+        lines.append(f"S{n} mix{n}(int, S{n}, short, S{n}, int);")
+        # An array is passed like a struct of the same size
+        lines.append(f"S{n} field{n}(S{n}, S{n});")
+        lines.append(f"S{n} pass{n}(S{n}, S{n});")
+    lines.append("")
+    lines.append("int main(void) {")
+    lines.append("    int bad = 0;")
+    for n in sizes:
+        checks = [
+            ("copy", "(a)", "a"),
+            ("mix", "(1, b, 2, a, 3)", "b"),
+            ("field", "(b, a)", "b"),
+            ("pass", "(a, b)", "a"),
+        ]
+        lines.append("    {")
+        lines.append(f"        S{n} a, b, r;")
+        lines.append(f"        for (int i = 0; i < {n}; i++) {{")
+        lines.append("            a.data[i] = (char)(i * 7 + 1);")
+        lines.append("            b.data[i] = (char)(i * 3 + 5);")
+        lines.append("        }")
+        for name, arguments, expected in checks:
+            lines.append(f"        r = {name}{n}{arguments};")
+            lines.append(f"        if (memcmp(&r, &{expected}, {n})) {{")
+            lines.append(f'            printf("{name}{n}\\n");')
+            lines.append("            bad++;")
+            lines.append("        }")
+        lines.append("    }")
+    lines.append("    return bad != 0;")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def check(program, directory, sizes):
+    """
+    Link the program's code, assembled and encoded, with the C driver.
+    Returns the names of the functions that got a copy wrong in either.
+    """
+    c_file = os.path.join(directory, "driver.c")
+    with open(c_file, "w") as f:
+        f.write(driver(sizes))
+    assembled = os.path.join(directory, "as.o")
+    encoded = os.path.join(directory, "encoded.o")
+    subprocess.run(
+        ["as", "-o", assembled], input=f"{program}\n", check=True, text=True
+    )
+    with open(encoded, "wb") as f:
+        f.write(object_file(program))
+    failed = []
+    for obj in [assembled, encoded]:
+        executable = os.path.join(directory, "check")
+        subprocess.run(CC + ["-o", executable, c_file, obj], check=True)
+        result = subprocess.run([executable], capture_output=True, text=True)
+        label = os.path.basename(obj)
+        failed.extend(f"{label}: {name}" for name in result.stdout.split())
+        # It exits with 1 after listing what went wrong, anything else crashed
+        if result.returncode not in (0, 1):
+            failed.append(f"{label}: exit status {result.returncode}")
+    return failed
+
+
+def main(first=1, last=5000):
+    failures = 0
+    batches = [
+        range(start, min(start + BATCH, last + 1))
+        for start in range(first, last + 1, BATCH)
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        for sizes in batches:
+            tree = parse(source(sizes), backend="fast")
+            for flags, options in LEVELS:
+                c = Compile(**options)
+                c.add_file(tree)
+                failed = check(c.finish(), directory, sizes)
+                described = f"sizes {sizes[0]}-{sizes[-1]} {flags}"
+                if not failed:
+                    print(f"ok    {described}")
+                    continue
+                failures += 1
+                print(f"FAIL  {described}")
+                for name in failed[:SHOWN]:
+                    print(f"  {name}")
+                if len(failed) > SHOWN:
+                    print(f"  and {len(failed) - SHOWN} more")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*map(int, sys.argv[1:])))
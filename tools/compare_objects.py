@@ -0,0 +1,206 @@
+"""
+Check that the built-in encoder agrees with GNU as.
+
+Every file is compiled at each optimization level, with and without a frame
+pointer, then both assembled with `as` and written with `elf.object_file`, and
+`objdump -dr` of the two objects has to match. Each object is then linked
+with cc into a C program that calls every function with made-up arguments and
+prints what they return, and both programs have to print the same. Needs
+binutils and a C compiler.
+
+    python -m tools.compare_objects test.c37 corpus/*.c37
+"""
+import difflib
+import os
+import subprocess
+import sys
+import tempfile
+
+from compiler.compile import Compile
+from compiler.elf import object_file
+from compiler.parser import parse, read_source
+from compiler.types_ import Array, Integer, Struct
+
+# Flags and the Compile() arguments they stand for
+LEVELS = [
+    (f"-O{level}{flag}", dict(options, omit_frame_pointer=bool(flag)))
+    for flag in ["", " -fomit-frame-pointer"]
+    for level, options in [
+        ("0", dict(opt_level=0)),
+        ("1", dict(opt_level=1)),
+        ("2", dict(opt_level=2)),
+        ("s", dict(opt_level=2, optimize_size=True)),
+    ]
+]
+# The driver is generated, so its warnings aren't interesting
+CC = ["cc", "-w", "-Wl,-z,noexecstack"]
+RUN_TIMEOUT = 10
+
+
+def disassemble(path):
+    output = subprocess.run(
+        ["objdump", "-dr", path], check=True, capture_output=True, text=True
+    ).stdout
+    # The first lines name the file
+    return output.splitlines()[2:]
+
+
+def compare(program, directory):
+    expected = os.path.join(directory, "as.o")
+    actual = os.path.join(directory, "encoded.o")
+    subprocess.run(
+        ["as", "-o", expected], input=f"{program}\n", check=True, text=True
+    )
+    with open(actual, "wb") as f:
+        f.write(object_file(program))
+    return list(
+        difflib.unified_diff(
+            disassemble(expected), disassemble(actual), "as", "encoded", lineterm=""
+        )
+    )
+
+
+def declarator(type_, name, structs):
+    """C declaration of name as type_, adding the structs it needs to structs."""
+    if isinstance(type_, Integer):
+        return f"int{type_.size() * 8}_t {name}"
+    if isinstance(type_, Array):
+        return declarator(type_.element_type, f"{name}[{type_.length}]", structs)
+    if isinstance(type_, Struct):
+        if type_.name not in structs:
+            fields = [
+                f"    {declarator(field.type, field.name, structs)};\n"
+                for field in type_.layout.fields
+            ]
+            structs[type_.name] = f"struct s_{type_.name} {{\n{''.join(fields)}}};\n"
+        return f"struct s_{type_.name} {name}"
+    raise NotImplementedError(type(type_))
+
+
+def leaves(type_, expr):
+    """C expressions for every integer in a value of type_."""
+    if isinstance(type_, Integer):
+        yield expr
+    elif isinstance(type_, Array):
+        for i in range(type_.length):
+            yield from leaves(type_.element_type, f"{expr}[{i}]")
+    else:
+        for field in type_.layout.fields:
+            yield from leaves(field.type, f"{expr}.{field.name}")
+
+
+def driver(c):
+    """
+    C program calling every function compiled by c. The stack is filled with
+    the same bytes before each call, so functions reading locals they never
+    wrote print the same in both programs.
+    """
+    structs = {}
+    prototypes = []
+    calls = []
+    counter = 0
+    for name in c.exports:
+        function = c.functions[name]
+        types = function.argument_types + [function.return_type]
+        # C can't pass or return arrays by value
+        if any(isinstance(t, Array) for t in types):
+            continue
+        arguments = [
+            declarator(t, f"a{i}", structs)
+            for i, t in enumerate(function.argument_types)
+        ]
+        result = declarator(function.return_type, "r", structs)
+        parameters = ", ".join(
+            declarator(t, "", structs).rstrip() for t in function.argument_types
+        )
+        prototypes.append(
+            f"extern {declarator(function.return_type, name, structs)}"
+            f"({parameters or 'void'});\n"
+        )
+        body = [f"    printf(\"{name}\\n\");\n"]
+        for i, (argument, type_) in enumerate(
+            zip(arguments, function.argument_types)
+        ):
+            body.append(f"    {argument};\n")
+            for leaf in leaves(type_, f"a{i}"):
+                # Small and non-zero, so loops end and nothing divides by zero
+                counter += 1
+                body.append(f"    {leaf} = {counter % 9 + 1};\n")
+        names = ", ".join(f"a{i}" for i in range(len(arguments)))
+        body.append("    scribble();\n")
+        body.append(f"    {result} = {name}({names});\n")
+        for leaf in leaves(function.return_type, "r"):
+            body.append(f'    printf("  %lld\\n", (long long){leaf});\n')
+        calls.append("  {\n" + "".join(body) + "  }\n")
+    return (
+        "#include <stdint.h>\n#include <stdio.h>\n\n"
+        + "".join(structs.values())
+        + "".join(prototypes)
+        + "\nstatic void scribble(void) {\n"
+        + "    volatile unsigned char junk[4096];\n"
+        + "    for (unsigned i = 0; i < sizeof junk; i++)\n"
+        + "        junk[i] = 0x5a;\n"
+        + "}\n\nint main(void) {\n"
+        + "".join(calls)
+        + "    return 0;\n}\n"
+    )
+
+
+def run(c, directory):
+    """
+    Link both objects written by compare() with a driver for c and run them.
+    Returns a description of how their output differs, or None.
+    """
+    source = os.path.join(directory, "driver.c")
+    with open(source, "w") as f:
+        f.write(driver(c))
+    outcomes = []
+    for name in ["as", "encoded"]:
+        executable = os.path.join(directory, name)
+        subprocess.run(
+            CC + ["-o", executable, source, f"{executable}.o"], check=True
+        )
+        try:
+            result = subprocess.run(
+                [executable], capture_output=True, text=True, timeout=RUN_TIMEOUT
+            )
+        except subprocess.TimeoutExpired:
+            outcomes.append(("timed out", ""))
+            continue
+        outcomes.append((f"exit status {result.returncode}", result.stdout))
+    (as_status, as_output), (status, output) = outcomes
+    if as_status != status:
+        return [f"as: {as_status}", f"encoded: {status}"]
+    diff = difflib.unified_diff(
+        as_output.splitlines(), output.splitlines(), "as", "encoded", lineterm=""
+    )
+    return list(diff) or None
+
+
+def main(paths):
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for path in paths:
+            for flags, options in LEVELS:
+                # Files the compiler rejects have nothing to compare
+                try:
+                    c = Compile(**options)
+                    c.add_file(parse(read_source(path), backend="fast"))
+                except Exception as e:
+                    print(f"skip  {path} {flags} ({type(e).__name__})")
+                    continue
+                diff = compare(c.finish(), directory)
+                if not diff:
+                    diff = run(c, directory)
+                    if diff is None:
+                        print(f"ok    {path} {flags}")
+                        continue
+                failures += 1
+                print(f"FAIL  {path} {flags}")
+                for line in diff:
+                    print(f"  {line}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,41 @@
+"""
+Check that the fast parser agrees with the ANTLR one.
+
+Every file is parsed with both backends, and either the resulting trees or the
+ParseError messages have to be identical. Needs the generated ANTLR parser
+(`make parser`).
+
+    python -m tools.compare_parsers test.c37 corpus/*.c37
+"""
+import sys
+
+from compiler.ast import dump
+from compiler.parser import parse, ParseError
+
+
+def run(source, backend):
+    try:
+        return "ok", dump(parse(source, backend=backend))
+    except ParseError as e:
+        return "error", str(e)
+
+
+def main(paths):
+    failures = 0
+    for path in paths:
+        with open(path, "r") as f:
+            source = f.read()
+        expected = run(source, "antlr")
+        actual = run(source, "fast")
+        if expected == actual:
+            print(f"ok    {path}")
+            continue
+        failures += 1
+        print(f"FAIL  {path}")
+        print(f"  antlr: {expected}")
+        print(f"  fast:  {actual}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))